@@ -1,23 +1,113 @@
 #!/usr/bin/env python3
 
 import logging
+import os
+import sys
 
 from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
 from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.importers.tar import TarImporter
+from ostree_upload_server.importers.util import (
+    checkout_repository, update_repo_metadata
+)
+
+
+def find_bundles(args):
+    """Collect the bundles from the arguments, directories and stdin"""
+    bundles = list(args.bundle)
+    for directory in args.dir:
+        bundles.extend(sorted(entry.path for entry in os.scandir(directory)
+                              if entry.is_file()))
+    if args.stdin:
+        bundles.extend(line.strip() for line in sys.stdin if line.strip())
+    return bundles
+
+
+def group_by_ref(bundles):
+    """Group bundles for the same ref so they're imported in order
+
+    Bundles whose ref can't be read cheaply are in groups of their own.
+    """
+    groups = OrderedDict()
+    for bundle in bundles:
+        try:
+            peeked = BundleImporter.check_bundle(bundle)
+        except Exception:
+            # The import will report the problem
+            peeked = None
+        key = peeked[0] if peeked is not None else bundle
+        groups.setdefault(key, []).append(bundle)
+    return list(groups.values())
+
+
+def import_group(bundles, args):
+    """Import bundles one after another and return their results
+
+    Each result is a (bundle, status, ref, seconds) tuple.
+    """
+    results = []
+    for bundle in bundles:
+        start = perf_counter()
+        try:
+            ref_update = BundleImporter.import_bundle(
+                bundle, args.repo, args.gpg_homedir, args.keyring,
+                args.sign_key, update_metadata=False,
+                tar_import_mode=args.tar_import_mode)
+        except Exception as err:
+            logging.error('Importing %s failed: %s', bundle, err)
+            results.append((bundle, 'failed', '', perf_counter() - start))
+            continue
+
+        if ref_update is None:
+            status, ref = 'unchanged', ''
+        else:
+            status, ref = 'imported', ref_update.ref
+        results.append((bundle, status, ref, perf_counter() - start))
+    return results
+
+
+def print_results(results, metadata_seconds, total_seconds):
+    name_width = max([len('bundle')] + [len(r[0]) for r in results])
+    ref_width = max([len('ref')] + [len(r[2]) for r in results])
+    row_format = '{:<%d}  {:<9}  {:<%d}  {:>8}' % (name_width, ref_width)
+
+    print(row_format.format('bundle', 'status', 'ref', 'seconds'))
+    for bundle, status, ref, seconds in results:
+        print(row_format.format(bundle, status, ref,
+                                '{:.2f}'.format(seconds)))
+    if metadata_seconds is not None:
+        print('metadata update: {:.2f}s'.format(metadata_seconds))
+    print('total: {:.2f}s'.format(total_seconds))
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(
-        description='Import bundle into a local repository'
+        description='Import bundles into a local repository'
     )
     parser.add_argument('repo', help='repository name to use')
-    parser.add_argument('bundle', help='file to import')
+    parser.add_argument('bundle', nargs='*', help='files to import')
+    parser.add_argument('--dir', action='append', default=[],
+                        help='import all files in a directory')
+    parser.add_argument('--stdin', action='store_true',
+                        help='read files to import from stdin, one per '
+                             'line')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of bundles to import in parallel '
+                             '(default: %(default)s)')
     parser.add_argument('-g', '--gpg-homedir',
                         help='GPG homedir to use when looking for keyrings')
     parser.add_argument('-k', '--keyring',
                         help='additional trusted keyring file')
     parser.add_argument('-s', '--sign-key',
                         help='GPG key ID to sign the commit with')
+    parser.add_argument('--tar-import-mode', default=TarImporter.EXTRACT,
+                        choices=TarImporter.IMPORT_MODES,
+                        help='how to import tar bundles (default: '
+                             '%(default)s)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='verbose log output')
     parser.add_argument('-d', '--debug', action='store_true',
@@ -32,8 +122,37 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    BundleImporter.import_bundle(args.bundle,
-                                 args.repo,
-                                 args.gpg_homedir,
-                                 args.keyring,
-                                 args.sign_key)
+    bundles = find_bundles(args)
+    if not bundles:
+        parser.error('no bundles to import')
+    if args.jobs < 1:
+        parser.error('jobs must be at least 1')
+
+    start = perf_counter()
+
+    # Make sure the repo exists before imports race to create it. The
+    # handle is kept open for the first import to reuse.
+    with checkout_repository(args.repo):
+        pass
+
+    # libostree releases the GIL, so threads import in parallel. Each
+    # import runs its own transaction, but bundles for the same ref are
+    # kept in order in one thread so each update has the right parent.
+    with ThreadPoolExecutor(args.jobs) as executor:
+        group_results = executor.map(lambda group: import_group(group, args),
+                                     group_by_ref(bundles))
+        results = [result for group in group_results for result in group]
+
+    # Update the summary and appstream data once for all the imports
+    metadata_seconds = None
+    if any(status == 'imported' for _, status, _, _ in results):
+        metadata_start = perf_counter()
+        update_repo_metadata(args.repo, args.gpg_homedir, args.sign_key)
+        metadata_seconds = perf_counter() - metadata_start
+
+    positions = {bundle: i for i, bundle in enumerate(bundles)}
+    results.sort(key=lambda result: positions[result[0]])
+    print_results(results, metadata_seconds, perf_counter() - start)
+
+    if any(status == 'failed' for _, status, _, _ in results):
+        sys.exit(1)
@@ -2,4 +2,7 @@
 
 from ostree_upload_server.server import main
 
-main()
+# The guard keeps spawned import processes from starting another server
+# when they re-import this script.
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,69 @@
+import hashlib
+import hmac
 import logging
+import os
+
+from collections import OrderedDict
+from time import time
 
 from passlib.hash import pbkdf2_sha256
 
 
 class Authenticator(object):
-    def __init__(self, users):
+    """Check basic auth credentials against PBKDF2-SHA256 hashes
+
+    Verifying a PBKDF2 hash is deliberately slow and it runs on the
+    event loop, so checking it on every status poll limits the whole
+    server to a few hundred requests per second. Credentials that
+    verified successfully are remembered for cache_ttl seconds. The
+    cache is keyed by a BLAKE2 hash of the username and password keyed
+    with a random per-process secret, so plain passwords are never kept
+    and the keys are useless outside this process. A cached entry is
+    only used while the user's configured hash is unchanged. At most
+    cache_size entries are kept, dropping the least recently used. Set
+    cache_ttl to 0 to disable the cache.
+    """
+    DEFAULT_CACHE_TTL = 300
+    DEFAULT_CACHE_SIZE = 1000
+
+    def __init__(self, users, cache_ttl=DEFAULT_CACHE_TTL,
+                 cache_size=DEFAULT_CACHE_SIZE):
         self._users = users
+        self._cache_ttl = cache_ttl
+        self._cache_size = cache_size
+
+        # Map of credential key to (configured hash, expiry time)
+        self._cache = OrderedDict()
+        self._cache_key_secret = os.urandom(hashlib.blake2b.MAX_KEY_SIZE)
+
+    def _get_cache_key(self, username, password):
+        credentials = hashlib.blake2b(key=self._cache_key_secret)
+        # Length prefix the username so the split is unambiguous
+        username = username.encode('utf-8')
+        credentials.update(len(username).to_bytes(4, 'big'))
+        credentials.update(username)
+        credentials.update(password.encode('utf-8'))
+        return credentials.digest()
+
+    def _check_cache(self, cache_key, hashed_password):
+        entry = self._cache.get(cache_key)
+        if entry is None:
+            return False
+
+        cached_hash, expiry = entry
+        if expiry <= time() or \
+                not hmac.compare_digest(cached_hash, hashed_password):
+            del self._cache[cache_key]
+            return False
+
+        self._cache.move_to_end(cache_key)
+        return True
+
+    def _add_to_cache(self, cache_key, hashed_password):
+        self._cache[cache_key] = (hashed_password, time() + self._cache_ttl)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
 
     def authenticate(self, request):
         if not self._users:
@@ -19,8 +77,14 @@ class Authenticator(object):
         if auth.username not in self._users:
             return False
 
-        # Check the pbkdf2-sha256 encrypted password
         hashed_password = self._users[auth.username]
+        use_cache = self._cache_ttl > 0 and self._cache_size > 0
+        if use_cache:
+            cache_key = self._get_cache_key(auth.username, auth.password)
+            if self._check_cache(cache_key, hashed_password):
+                return True
+
+        # Check the pbkdf2-sha256 encrypted password
         if not pbkdf2_sha256.identify(hashed_password):
             logging.warning('Hashed password for user {} is not '
                             'valid for pbkdf2-sha256 algorithm'
@@ -30,4 +94,7 @@ class Authenticator(object):
         if not pbkdf2_sha256.verify(auth.password, hashed_password):
             return False
 
+        if use_cache:
+            self._add_to_cache(cache_key, hashed_password)
+
         return True
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from gevent import get_hub
+from gevent.event import AsyncResult
+from gevent.subprocess import check_output, CalledProcessError, STDOUT
+
+from ostree_upload_server.importers.flatpak import read_bundle_header
+from ostree_upload_server.importers.util import checkout_repository
+from ostree_upload_server.repolock import RepoLock
+
+
+def resolve_ref(repo_path, ref):
+    """Return the commit ref points to in the repo or None"""
+    with checkout_repository(repo_path) as repo:
+        _, commit = repo.resolve_rev(ref, True)
+    return commit
+
+
+def read_bundle_commit(path):
+    """Return the commit in a flatpak bundle or None if it's unreadable
+
+    This is run in a thread, where raising would make gevent report the
+    error a second time.
+    """
+    try:
+        commit, _ = read_bundle_header(path)
+    except Exception as err:
+        logging.error('Reading bundle %s failed: %s', path, err)
+        return None
+    return commit
+
+
+class BundleCache:
+    """Flatpak bundles built for pushes, cached by the commit they hold
+
+    Building a bundle with flatpak build-bundle takes time proportional
+    to the size of the commit, so pushing one release to several remotes
+    or retrying a push would repeat the same work. Bundles are instead
+    kept in cache_dir keyed by the repo, ref and commit. A request for a
+    bundle that's already being built waits for that build rather than
+    starting another.
+
+    Once the bundles take more than max_size bytes, the least recently
+    used ones are removed. Bundles in use by a push are never removed.
+    Bundles found in cache_dir at startup are reused.
+    """
+    DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+    BUNDLE_SUFFIX = '.flatpak'
+    TMP_SUFFIX = '.tmp'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+        # Map of key to bundle size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+
+        # Map of key to AsyncResult for bundles being built and number
+        # of users of each bundle
+        self._in_flight = {}
+        self._pins = Counter()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        bundles = []
+        for entry in os.scandir(self._cache_dir):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(BundleCache.TMP_SUFFIX):
+                # Left over from an interrupted build
+                os.unlink(entry.path)
+            elif entry.name.endswith(BundleCache.BUNDLE_SUFFIX):
+                stat = entry.stat()
+                key = entry.name[:-len(BundleCache.BUNDLE_SUFFIX)]
+                bundles.append((stat.st_mtime, key, stat.st_size))
+
+        for _, key, size in sorted(bundles):
+            self._entries[key] = size
+            self._size += size
+        logging.info('Found %d cached push bundles using %d bytes',
+                     len(self._entries), self._size)
+        self._evict()
+
+    @staticmethod
+    def _get_key(repo_path, ref, commit):
+        key_data = json.dumps([os.path.realpath(repo_path), ref, commit])
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._cache_dir, key + BundleCache.BUNDLE_SUFFIX)
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    @contextmanager
+    def bundle(self, repo_path, ref):
+        """Context manager providing a bundle of ref's current commit
+
+        The bundle is built unless it's already cached. The path
+        provided can be used until the context exits. Raises an
+        exception if the bundle can't be built.
+        """
+        key = self._checkout(repo_path, ref)
+        try:
+            yield self._get_path(key)
+        finally:
+            self._pins[key] -= 1
+            if self._pins[key] == 0:
+                del self._pins[key]
+            self._evict()
+
+    def _checkout(self, repo_path, ref):
+        # Resolving the ref makes blocking libostree calls
+        commit = get_hub().threadpool.apply(resolve_ref, (repo_path, ref))
+        if commit is None:
+            raise RuntimeError('Ref {} not found in {}'.format(ref,
+                                                               repo_path))
+
+        key = BundleCache._get_key(repo_path, ref, commit)
+        while key not in self._entries:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                key = self._build(key, repo_path, ref, commit)
+                break
+
+            # The bundle may have been evicted again by the time this
+            # wakes up, in which case it's rebuilt
+            logging.debug('Waiting for bundle of %s to be built', ref)
+            key = in_flight.get()
+
+        logging.info('Using cached bundle of %s', ref)
+        self._entries.move_to_end(key)
+        os.utime(self._get_path(key))
+        self._pins[key] += 1
+        return key
+
+    def _build(self, key, repo_path, ref, commit):
+        """Build a bundle while letting others wait for it"""
+        result = AsyncResult()
+        self._in_flight[key] = result
+        try:
+            built_key = self._build_bundle(repo_path, ref, commit)
+        except Exception as err:
+            result.set_exception(err)
+            raise
+        finally:
+            del self._in_flight[key]
+
+        result.set(built_key)
+        return built_key
+
+    def _build_bundle(self, repo_path, ref, commit):
+        (fd, tmp_path) = tempfile.mkstemp(dir=self._cache_dir,
+                                          suffix=BundleCache.TMP_SUFFIX)
+        os.close(fd)
+        try:
+            logging.info('Building bundle of %s at %s', ref, commit)
+            with RepoLock(repo_path):
+                try:
+                    check_output(['flatpak', 'build-bundle', repo_path,
+                                  tmp_path, ref], stderr=STDOUT)
+                except CalledProcessError as err:
+                    logging.error('Building bundle of %s failed: %s\n%s',
+                                  ref, err, err.output)
+                    raise
+
+            # The ref may have moved on since it was resolved
+            built_commit = get_hub().threadpool.apply(read_bundle_commit,
+                                                      (tmp_path,))
+            if built_commit is None:
+                raise RuntimeError('Built bundle of {} is unreadable'
+                                   .format(ref))
+            if built_commit != commit:
+                logging.info('Ref %s moved from %s to %s while building '
+                             'its bundle', ref, commit, built_commit)
+
+            key = BundleCache._get_key(repo_path, ref, built_commit)
+            if key in self._entries:
+                os.unlink(tmp_path)
+                return key
+
+            os.rename(tmp_path, self._get_path(key))
+        except:  # noqa: E722
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        size = os.path.getsize(self._get_path(key))
+        self._entries[key] = size
+        self._size += size
+        logging.info('Built bundle of %s at %s, %d bytes', ref,
+                     built_commit, size)
+        return key
+
+    def _evict(self):
+        """Remove unused bundles until the cache fits in max_size"""
+        for key in list(self._entries):
+            if self._size <= self._max_size:
+                break
+            if self._pins[key] > 0:
+                continue
+
+            logging.debug('Evicting cached bundle %s', key)
+            self._size -= self._entries.pop(key)
+            try:
+                os.unlink(self._get_path(key))
+            except FileNotFoundError:
+                pass
@@ -1,9 +1,17 @@
 import inspect
 import logging
-import magic
 
+from .importers.base import import_phase, InvalidBundle
 from .importers.flatpak import FlatpakImporter
 from .importers.tar import TarImporter, TgzImporter
+from .importers.util import checkout_repository, update_repo_metadata
+
+# libmagic is only needed for bundles that no importer recognizes from
+# its signatures
+try:
+    import magic
+except ImportError:
+    magic = None
 
 
 class BundleImporter(object):
@@ -11,14 +19,41 @@ class BundleImporter(object):
                         TarImporter,
                         TgzImporter]
 
+    # How much of the bundle importers get to sniff
+    SNIFF_SIZE = 4096
+
     @staticmethod
-    def import_bundle(bundle, repository, gpg_homedir=None, keyring=None,
-                      sign_key=None):
-        logging.info("Starting the bundle import process...")
-        for arg in inspect.getfullargspec(BundleImporter.import_bundle)[0]:
-            logging.info("Set %s = '%s'", arg, locals()[arg])
+    def register_importer(importer_class):
+        """Add an importer class after the existing ones
+
+        This returns the class so it can be used as a class decorator.
+        """
+        if importer_class not in BundleImporter.BUNDLE_IMPORTERS:
+            BundleImporter.BUNDLE_IMPORTERS.append(importer_class)
+        return importer_class
+
+    @staticmethod
+    def get_importer_class(bundle):
+        """Find the appropriate importer for a bundle
+
+        Each importer checks the start of the bundle for its signatures.
+        If none match, the importer is chosen by the mimetype libmagic
+        detects.
+        """
+        with open(bundle, 'rb') as bundle_file:
+            header = bundle_file.read(BundleImporter.SNIFF_SIZE)
+
+        for importer_class in BundleImporter.BUNDLE_IMPORTERS:
+            if importer_class.sniff(header):
+                logging.debug('%s recognized %s', importer_class.__name__,
+                              bundle)
+                return importer_class
+
+        if magic is None:
+            logging.error('ERROR! Unknown bundle type in %s', bundle)
+            raise InvalidBundle('Unknown bundle type in file {}'
+                                .format(bundle))
 
-        # Find the appropriate importer based on mimetype
         mime_type = magic.from_file(bundle, mime=True)
 
         importer_class = next(
@@ -28,10 +63,171 @@ class BundleImporter(object):
         if not importer_class:
             logging.error('ERROR! Unknown mime-type %s detected in %s',
                           mime_type, bundle)
-            raise RuntimeError('Unknown mime-type {} in file {}'
-                               .format(mime_type, bundle))
+            raise InvalidBundle('Unknown mime-type {} in file {}'
+                                .format(mime_type, bundle))
+
+        return importer_class
+
+    @staticmethod
+    def check_bundle(bundle):
+        """Cheaply check a bundle and read the ref and commit it imports
+
+        This only looks at the bundle's headers, so it's suitable for
+        rejecting bad bundles as they're uploaded. Raises InvalidBundle
+        if the bundle can't be imported. Returns a (ref, commit) tuple,
+        or None if they can't be determined without importing the
+        bundle.
+        """
+        with import_phase('detect'):
+            importer_class = BundleImporter.get_importer_class(bundle)
+        try:
+            return importer_class.peek_commit(bundle)
+        except InvalidBundle:
+            raise
+        except Exception as err:
+            logging.debug('Could not read commit from %s: %s', bundle, err)
+            return None
+
+    @staticmethod
+    def import_bundle(bundle, repository, gpg_homedir=None, keyring=None,
+                      sign_key=None, update_metadata=True,
+                      tar_import_mode=TarImporter.EXTRACT,
+                      progress_callback=None):
+        """Import a bundle into a repository
+
+        tar_import_mode selects how tar bundles are imported, see
+        TarImporter.IMPORT_MODES. progress_callback is called with the
+        phases and progress of the import, see BaseImporter. Returns a
+        RefUpdate describing the ref changed by the import, or None if
+        the ref was already at the bundle's commit.
+        """
+        logging.info("Starting the bundle import process...")
+        for arg in inspect.getfullargspec(BundleImporter.import_bundle)[0]:
+            logging.info("Set %s = '%s'", arg, locals()[arg])
+
+        with import_phase('detect', progress_callback):
+            importer_class = BundleImporter.get_importer_class(bundle)
+        importer = BundleImporter._create_importer(
+            importer_class, bundle, repository, gpg_homedir, keyring,
+            sign_key, update_metadata, tar_import_mode, progress_callback)
+        return importer.import_to_repo()
+
+    @staticmethod
+    def import_bundles(bundles, repository, gpg_homedir=None, keyring=None,
+                       sign_key=None, update_metadata=True,
+                       tar_import_mode=TarImporter.EXTRACT,
+                       progress_callback=None):
+        """Import several bundles into a repository in one transaction
+
+        Bundles are imported one after another in a single transaction
+        and the repo metadata is updated once at the end, which saves
+        the per import overhead when many bundles arrive together. A
+        bundle failing to import doesn't stop the others, but only one
+        bundle per ref can be imported. Returns a list with a
+        (RefUpdate or None, error message or None) tuple for each
+        bundle.
+
+        Objects a failed bundle staged can't be removed from the
+        transaction on their own. When a bundle fails, the transaction
+        is aborted and the bundles that succeeded are imported again in
+        a new one, so nothing of the failed bundle gets into the repo.
+        """
+        logging.info("Starting the import of %d bundles...", len(bundles))
+
+        results = [None] * len(bundles)
+        pending = list(range(len(bundles)))
+        with checkout_repository(repository) as target_repo:
+            while pending:
+                failed = BundleImporter._import_batch(
+                    bundles, pending, results, repository, target_repo,
+                    gpg_homedir, keyring, sign_key, tar_import_mode,
+                    progress_callback)
+                if not failed:
+                    break
+
+                logging.info("Importing %d bundles again without the %d "
+                             "that failed", len(pending) - len(failed),
+                             len(failed))
+                pending = [index for index in pending if index not in failed]
+
+        if update_metadata:
+            logging.info("updating summary...")
+            with import_phase('summary_update', progress_callback):
+                update_repo_metadata(repository, gpg_homedir, sign_key)
+            logging.info("updating summary done...")
+
+        return results
+
+    @staticmethod
+    def _import_batch(bundles, indexes, results, repository, target_repo,
+                      gpg_homedir, keyring, sign_key, tar_import_mode,
+                      progress_callback):
+        """Import the bundles at indexes in one transaction
+
+        The result of each bundle is stored in results. The transaction
+        is only committed if all of them were imported, otherwise it's
+        aborted and the set of indexes that failed is returned.
+        """
+        failed = set()
+        batch_refs = set()
+        target_repo.prepare_transaction(None)
+        try:
+            for index in indexes:
+                bundle = bundles[index]
+                try:
+                    with import_phase('detect', progress_callback):
+                        importer_class = \
+                            BundleImporter.get_importer_class(bundle)
+
+                    # Refs set in the transaction aren't visible until
+                    # it's committed, so a second update to the same ref
+                    # would be made against the wrong parent. Check
+                    # cheaply first, and again after importing bundles
+                    # whose ref can't be peeked.
+                    peeked = importer_class.peek_commit(bundle)
+                    if peeked is not None and peeked[0] in batch_refs:
+                        raise RuntimeError('Ref {} already imported in this '
+                                           'batch'.format(peeked[0]))
+
+                    importer = BundleImporter._create_importer(
+                        importer_class, bundle, repository, gpg_homedir,
+                        keyring, sign_key, False, tar_import_mode,
+                        progress_callback)
+                    importer.use_transaction(target_repo)
+                    ref_update = importer.import_to_repo()
+
+                    if ref_update is not None:
+                        if ref_update.ref in batch_refs:
+                            raise RuntimeError(
+                                'Ref {} already imported in this batch'
+                                .format(ref_update.ref))
+                        batch_refs.add(ref_update.ref)
+                except Exception as err:
+                    logging.error('Importing %s failed: %s', bundle, err)
+                    results[index] = (None, str(err))
+                    failed.add(index)
+                    continue
+
+                results[index] = (ref_update, None)
+
+            if failed:
+                target_repo.abort_transaction(None)
+            else:
+                with import_phase('commit', progress_callback):
+                    target_repo.commit_transaction(None)
+        except:  # noqa: E722
+            target_repo.abort_transaction(None)
+            raise
+
+        return failed
+
+    @staticmethod
+    def _create_importer(importer_class, bundle, repository, gpg_homedir,
+                         keyring, sign_key, update_metadata,
+                         tar_import_mode, progress_callback=None):
+        importer_kwargs = {'progress_callback': progress_callback}
+        if issubclass(importer_class, TarImporter):
+            importer_kwargs['import_mode'] = tar_import_mode
 
-        # Instantiate the importer and run it
-        importer = importer_class(bundle, repository, gpg_homedir, keyring,
-                                  sign_key)
-        importer.import_to_repo()
+        return importer_class(bundle, repository, gpg_homedir, keyring,
+                              sign_key, update_metadata, **importer_kwargs)
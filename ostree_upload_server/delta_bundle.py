@@ -0,0 +1,338 @@
+import logging
+import os
+
+from collections import namedtuple
+
+import gi
+
+from ostree_upload_server.importers.flatpak import (
+    OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT
+)
+from ostree_upload_server.importers.util import (
+    checkout_repository, generate_static_deltas, get_metadata_contents,
+    get_static_delta_path
+)
+from ostree_upload_server.repolock import RepoLock
+
+gi.require_version('OSTree', '1.0')
+from gi.repository import GLib  # noqa: E402
+
+# Value of the flatpak key flatpak build-bundle starts bundles with
+FLATPAK_BUNDLE_MAGIC = 0xe5890001
+
+# Alignment of each superblock member and whether it's fixed size
+SUPERBLOCK_MEMBERS = [
+    (8, False),  # metadata a{sv}
+    (8, True),   # timestamp t
+    (1, False),  # from checksum ay
+    (1, False),  # to checksum ay
+    (8, False),  # commit
+    (1, False),  # recursive deltas ay
+    (8, False),  # part descriptors
+    (8, False),  # fallback objects
+]
+SUPERBLOCK_PARTS_INDEX = 6
+SUPERBLOCK_FALLBACKS_INDEX = 7
+
+# Alignment of the {sv} dictionary entries in the superblock metadata
+DICT_ENTRY_ALIGNMENT = 8
+
+# Type of a part, a compression type byte followed by the payload
+DELTA_PART_TYPE = b'(yay)'
+
+# A range of an open file in the serialized bundle
+_FileSegment = namedtuple('_FileSegment', ['fd', 'size'])
+
+
+class DeltaNotBundleable(Exception):
+    """The static delta can't be sent as a flatpak bundle"""
+    pass
+
+
+def _offset_size(container_size):
+    """Size of the framing offsets of a serialized GVariant container"""
+    if container_size > 0xffffffff:
+        return 8
+    elif container_size > 0xffff:
+        return 4
+    elif container_size > 0xff:
+        return 2
+    elif container_size > 0:
+        return 1
+    return 0
+
+
+def _container_size(body_size, n_offsets):
+    """Size of a container with body_size bytes of children
+
+    The framing offsets are as small as the resulting size allows.
+    """
+    for offset_size in (1, 2, 4):
+        size = body_size + offset_size * n_offsets
+        if size < 1 << (8 * offset_size):
+            return size
+    return body_size + 8 * n_offsets
+
+
+def _pack_offsets(offsets, container_size):
+    offset_size = _offset_size(container_size)
+    return b''.join(offset.to_bytes(offset_size, 'little')
+                    for offset in offsets)
+
+
+def _serialize_dict_entry(key, value):
+    data = GLib.Variant('{sv}', (key, value)).get_data_as_bytes()
+    return data.get_data() or b''
+
+
+class _BundleWriter:
+    """Lay out a serialized superblock as bytes and open file ranges
+
+    This writes GVariant's serialization format by hand so the parts
+    don't have to be read. They're written as ranges of their files,
+    and the framing offsets that follow the variable size members of a
+    container are computed from the parts' sizes.
+    """
+    def __init__(self):
+        self.segments = []
+        self.size = 0
+
+    def write(self, data):
+        if data:
+            self.segments.append(data)
+            self.size += len(data)
+
+    def write_file(self, fd, size):
+        if size:
+            self.segments.append(_FileSegment(fd, size))
+            self.size += size
+
+    def align(self, alignment):
+        self.write(b'\0' * (-self.size % alignment))
+
+    def write_part_entry(self, key, fd, size):
+        """Write a {sv} entry holding a part inline as a (yay)"""
+        start = self.size
+        key_data = key.encode('utf-8') + b'\0'
+        self.write(key_data)
+        self.align(DICT_ENTRY_ALIGNMENT)
+        self.write_file(fd, size)
+        self.write(b'\0' + DELTA_PART_TYPE)
+
+        # The entry's only framing offset is the end of the key
+        entry_size = _container_size(self.size - start, 1)
+        self.write(_pack_offsets([len(key_data)], entry_size))
+
+    def write_superblock(self, superblock, entries):
+        """Write superblock with entries as its metadata
+
+        entries are serialized {sv} dictionary entries or (key, fd,
+        size) tuples of inline parts. The superblock's other members
+        are copied. This has to be the first thing written.
+        """
+        # Dictionary entries are followed by all their end offsets
+        ends = []
+        for entry in entries:
+            self.align(DICT_ENTRY_ALIGNMENT)
+            if isinstance(entry, bytes):
+                self.write(entry)
+            else:
+                self.write_part_entry(*entry)
+            ends.append(self.size)
+        self.write(_pack_offsets(ends, _container_size(self.size,
+                                                       len(ends))))
+
+        # Tuples are followed by the end offsets of their variable size
+        # members other than the last, last first
+        ends = [self.size]
+        last = len(SUPERBLOCK_MEMBERS) - 1
+        for index in range(1, len(SUPERBLOCK_MEMBERS)):
+            alignment, fixed_size = SUPERBLOCK_MEMBERS[index]
+            self.align(alignment)
+            data = superblock.get_child_value(index).get_data_as_bytes()
+            self.write(data.get_data() or b'')
+            if not fixed_size and index != last:
+                ends.append(self.size)
+        self.write(_pack_offsets(reversed(ends),
+                                 _container_size(self.size, len(ends))))
+
+
+class DeltaBundleReader:
+    """File-like reader of a DeltaBundle
+
+    This provides what HTTP clients need to send a body of known
+    length: read() and len(), which is the number of bytes left to
+    read as the multipart encoder expects. Closing it leaves the
+    bundle's files open for other readers.
+    """
+    def __init__(self, segments, size):
+        self._segments = segments
+        self._size = size
+        self._pos = 0
+
+        # Current segment and the position in it
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self._size - self._pos
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+
+        chunks = []
+        while size > 0 and self._index < len(self._segments):
+            segment = self._segments[self._index]
+            if isinstance(segment, bytes):
+                chunk = segment[self._offset:self._offset + size]
+                segment_size = len(segment)
+            else:
+                chunk = os.pread(segment.fd,
+                                 min(size, segment.size - self._offset),
+                                 self._offset)
+                if not chunk:
+                    raise IOError('Static delta part is truncated')
+                segment_size = segment.size
+
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._pos += len(chunk)
+            self._offset += len(chunk)
+            if self._offset == segment_size:
+                self._index += 1
+                self._offset = 0
+
+        return b''.join(chunks)
+
+
+class DeltaBundle:
+    """Flatpak bundle of a commit streamed from the repo's static delta
+
+    flatpak build-bundle writes the commit's delta from scratch to a
+    file with its parts inline in the superblock. The same bundle is
+    instead generated from the repo's own delta from scratch, which
+    has the parts in separate files, when a reader is read. Nothing is
+    written besides the delta, and that's only generated if the repo
+    doesn't have it yet.
+
+    The bundle has the flatpak, ref and metadata keys read by
+    importers, but not the appstream data and icons flatpak
+    build-bundle adds for display when installing it. The commit's
+    detached metadata is taken from the repo rather than the delta so
+    that its signatures are current.
+
+    The part files are kept open until the bundle is closed, so it
+    stays valid if the delta is regenerated or pruned. Each reader
+    returned by open() reads the bundle from the start.
+    """
+    def __init__(self, name, segments, size, fds):
+        self.name = name
+        self._segments = segments
+        self._size = size
+        self._fds = fds
+
+    def __len__(self):
+        return self._size
+
+    def open(self):
+        return DeltaBundleReader(self._segments, self._size)
+
+    def close(self):
+        while self._fds:
+            os.close(self._fds.pop())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_delta_bundle(repo_path, ref):
+    """Prepare a DeltaBundle of the commit ref points to
+
+    The delta from scratch to the commit is generated if needed. This
+    blocks, so it should be run in a thread. Raises
+    DeltaNotBundleable if the repo's delta has fallback objects, which
+    a bundle can't hold.
+    """
+    fds = []
+    try:
+        with RepoLock(repo_path), checkout_repository(repo_path) as repo:
+            _, commit = repo.resolve_rev(ref, True)
+            if commit is None:
+                raise RuntimeError('Ref {} not found in {}'.format(
+                    ref, repo_path))
+
+            generate_static_deltas(repo, [(None, commit)])
+            metadata_contents = get_metadata_contents(repo, commit)
+            _, detached_metadata = repo.read_commit_detached_metadata(
+                commit, None)
+
+            superblock_path = os.path.join(
+                repo_path, get_static_delta_path(None, commit, 'superblock'))
+            mapped_file = GLib.MappedFile.new(superblock_path, False)
+            superblock = GLib.Variant.new_from_bytes(
+                GLib.VariantType(OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT),
+                mapped_file.get_bytes(),
+                False)
+            if superblock.get_child_value(
+                    SUPERBLOCK_FALLBACKS_INDEX).n_children() > 0:
+                raise DeltaNotBundleable(
+                    'Static delta of {} has fallback objects'.format(commit))
+
+            # Open the parts while the lock keeps maintenance from
+            # replacing them
+            parts = []
+            n_parts = superblock.get_child_value(
+                SUPERBLOCK_PARTS_INDEX).n_children()
+            for index in range(n_parts):
+                part_path = get_static_delta_path(None, commit, str(index))
+                fd = os.open(os.path.join(repo_path, part_path),
+                             os.O_RDONLY | os.O_CLOEXEC)
+                fds.append(fd)
+                parts.append((part_path, fd, os.fstat(fd).st_size))
+
+        # flatpak build-bundle puts the flatpak key first so that it
+        # starts the file
+        commitmeta_key = get_static_delta_path(None, commit, 'commitmeta')
+        entries = [
+            _serialize_dict_entry('flatpak',
+                                  GLib.Variant('u', FLATPAK_BUNDLE_MAGIC)),
+            _serialize_dict_entry('ref', GLib.Variant('s', ref)),
+            _serialize_dict_entry('metadata',
+                                  GLib.Variant('s', metadata_contents)),
+        ]
+        replaced_keys = {'flatpak', 'ref', 'metadata', commitmeta_key}
+        metadata = superblock.get_child_value(0)
+        for index in range(metadata.n_children()):
+            entry = metadata.get_child_value(index)
+            if entry.get_child_value(0).get_string() not in replaced_keys:
+                entries.append(entry.get_data_as_bytes().get_data())
+        if detached_metadata is not None:
+            entries.append(_serialize_dict_entry(commitmeta_key,
+                                                 detached_metadata))
+        entries.extend(parts)
+
+        writer = _BundleWriter()
+        writer.write_superblock(superblock, entries)
+    except:  # noqa: E722
+        for fd in fds:
+            os.close(fd)
+        raise
+
+    logging.info('Streaming bundle of %s at %s from its static delta, '
+                 '%d bytes in %d parts', ref, commit, writer.size,
+                 len(parts))
+    return DeltaBundle(commit + '.flatpak', writer.segments, writer.size,
+                       fds)
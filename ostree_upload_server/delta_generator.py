@@ -0,0 +1,127 @@
+import logging
+
+from time import time
+
+from gevent import Greenlet
+from gevent.event import Event
+
+from ostree_upload_server.importers.util import (
+    checkout_repository, generate_static_deltas
+)
+from ostree_upload_server.repolock import RepoLock
+
+
+def generate_repo_deltas(repo_path, deltas):
+    """Generate static deltas in a repo while holding a shared lock
+
+    This blocks until complete, so it should be run in an executor.
+    """
+    with RepoLock(repo_path):
+        with checkout_repository(repo_path) as repo:
+            generate_static_deltas(repo, deltas)
+
+
+class DeltaGenerator:
+    """Generate static deltas for refs changed by imports
+
+    Regenerating deltas for every ref during maintenance costs time
+    proportional to the size of the repo. Instead, the ref updates from
+    each import are collected and the deltas to the new commits are
+    generated delay seconds later, both from scratch and from each
+    commit the ref previously pointed to. If a ref is updated again
+    before its deltas are generated, the superseded commit becomes
+    another delta source rather than a delta target. Deltas still
+    pending when the generator is stopped are generated immediately.
+    """
+    DEFAULT_DELAY = 10
+
+    def __init__(self, executor, metadata_updater, delay=DEFAULT_DELAY):
+        self._executor = executor
+        self._metadata_updater = metadata_updater
+        self._delay = delay
+
+        # Map of repo path to dict of ref to (from commits, to commit)
+        self._pending = {}
+        self._due_times = {}
+        self._wakeup = Event()
+        self._stopping = False
+        self._greenlet = None
+
+    def start(self):
+        self._stopping = False
+        self._greenlet = Greenlet.spawn(self._run)
+
+    def stop(self):
+        # Let any in progress generation finish
+        if self._greenlet is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._greenlet.join()
+            self._greenlet = None
+
+        # Maintenance doesn't generate deltas when they're generated
+        # here, so generate the pending deltas rather than losing them
+        self._due_times.clear()
+        for repo_path in list(self._pending):
+            repo_pending = self._pending.pop(repo_path)
+            try:
+                self._generate(repo_path, repo_pending)
+            except Exception as err:
+                logging.error('Generating %s static deltas failed: %s',
+                              repo_path, err)
+
+    def add_ref_update(self, repo_path, ref_update):
+        """Schedule delta generation for a RefUpdate"""
+        ref, old_commit, new_commit = ref_update
+        repo_pending = self._pending.setdefault(repo_path, {})
+        from_commits, to_commit = repo_pending.get(ref, (set(), None))
+        if to_commit is not None:
+            from_commits.add(to_commit)
+        if old_commit is not None:
+            from_commits.add(old_commit)
+        repo_pending[ref] = (from_commits, new_commit)
+
+        logging.debug('Scheduled static deltas for %s in %s', ref,
+                      repo_path)
+        self._due_times.setdefault(repo_path, time() + self._delay)
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            now = time()
+            for repo_path, due_time in list(self._due_times.items()):
+                if self._stopping:
+                    break
+                if due_time > now:
+                    continue
+
+                del self._due_times[repo_path]
+                repo_pending = self._pending.pop(repo_path)
+                try:
+                    self._generate(repo_path, repo_pending)
+                except Exception as err:
+                    logging.error('Generating %s static deltas failed: %s',
+                                  repo_path, err)
+
+            # Sleep until the next repo is due or a ref is updated
+            timeout = None
+            if self._due_times:
+                timeout = max(min(self._due_times.values()) - time(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _generate(self, repo_path, repo_pending):
+        deltas = []
+        for ref, (from_commits, to_commit) in sorted(repo_pending.items()):
+            deltas.append((None, to_commit))
+            deltas.extend((from_commit, to_commit)
+                          for from_commit in sorted(from_commits)
+                          if from_commit != to_commit)
+
+        logging.info('Generating %d static deltas in %s', len(deltas),
+                     repo_path)
+        self._executor.run(generate_repo_deltas, repo_path, deltas)
+        logging.info('Generated static deltas in %s', repo_path)
+
+        # The summary lists the available deltas
+        self._metadata_updater.mark_dirty(repo_path)
@@ -0,0 +1,141 @@
+import logging
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from gevent import get_hub
+from gevent.threadpool import ThreadPool
+
+
+def _call_in_thread(func, args, kwargs):
+    """Call func and return its exception rather than raising it
+
+    gevent reports exceptions escaping a threadpool function to the hub
+    before re-raising them in the waiting greenlet, which would log
+    every failed import twice.
+    """
+    try:
+        return func(*args, **kwargs), None
+    except Exception as err:
+        return None, err
+
+
+def _init_process_worker(log_level):
+    """Configure logging in a freshly spawned import process"""
+    logging.basicConfig(level=log_level)
+
+
+class ImportExecutor:
+    """Run blocking import work outside of the gevent event loop
+
+    libostree and GLib calls don't cooperate with gevent, so running
+    them directly in a worker greenlet stalls the whole server
+    including the HTTP listener. Work handed to run() is executed in
+    either a pool of native threads or a pool of separate processes
+    while the calling greenlet waits cooperatively for the result.
+    """
+    THREAD = 'thread'
+    PROCESS = 'process'
+    EXECUTOR_TYPES = [THREAD, PROCESS]
+
+    DEFAULT_EXECUTOR_TYPE = THREAD
+    DEFAULT_WORKER_COUNT = 4
+
+    def __init__(self, executor_type=DEFAULT_EXECUTOR_TYPE,
+                 worker_count=DEFAULT_WORKER_COUNT):
+        if executor_type not in ImportExecutor.EXECUTOR_TYPES:
+            raise ValueError('Unknown import executor type {}'
+                             .format(executor_type))
+
+        self._executor_type = executor_type
+        self._worker_count = worker_count
+        self._pool = None
+
+    @property
+    def executor_type(self):
+        return self._executor_type
+
+    def start(self):
+        logging.info('Starting %s import executor with %d workers',
+                     self._executor_type, self._worker_count)
+
+        if self._executor_type == ImportExecutor.THREAD:
+            self._pool = ThreadPool(self._worker_count)
+        else:
+            # Forking a process that has GLib threads running leaves
+            # them in an undefined state, so always start fresh
+            # interpreters for the import processes.
+            context = multiprocessing.get_context('spawn')
+            self._pool = ProcessPoolExecutor(
+                self._worker_count,
+                mp_context=context,
+                initializer=_init_process_worker,
+                initargs=(logging.getLogger().getEffectiveLevel(),))
+
+    def stop(self):
+        if self._pool is None:
+            return
+
+        logging.info('Stopping %s import executor', self._executor_type)
+
+        if self._executor_type == ImportExecutor.THREAD:
+            self._pool.join()
+            self._pool.kill()
+        else:
+            self._pool.shutdown(wait=True)
+
+        self._pool = None
+
+    def run(self, func, *args, **kwargs):
+        """Run func in the executor and return its result
+
+        The calling greenlet blocks until the result is available while
+        other greenlets continue to run. Exceptions raised by func are
+        raised again in the caller. In process mode func and its
+        arguments must be picklable.
+        """
+        if self._pool is None:
+            raise RuntimeError('Import executor has not been started')
+
+        if self._executor_type == ImportExecutor.THREAD:
+            result, err = self._pool.apply(_call_in_thread,
+                                           (func, args, kwargs))
+        else:
+            # Wait on the future from the hub's threadpool so only the
+            # calling greenlet is blocked
+            future = self._pool.submit(func, *args, **kwargs)
+            result, err = get_hub().threadpool.apply(
+                _call_in_thread, (future.result, (), {}))
+
+        if err is not None:
+            raise err
+        return result
+
+    def run_with_progress(self, func, progress_callback, *args, **kwargs):
+        """Run func in the executor while it reports progress
+
+        In thread mode func is passed a progress_callback keyword
+        argument that can be called from the executor thread. Each call
+        is handed to the event loop, where progress_callback is called
+        with the same arguments. Calls arriving after func has returned
+        are dropped. Callbacks can't be passed to import processes, so
+        in process mode func is run as by run() and progress_callback
+        is never called.
+        """
+        if self._executor_type != ImportExecutor.THREAD:
+            return self.run(func, *args, **kwargs)
+
+        loop = get_hub().loop
+        running = True
+
+        def call_in_loop(*callback_args):
+            if running:
+                progress_callback(*callback_args)
+
+        def report(*callback_args):
+            loop.run_callback_threadsafe(call_in_loop, *callback_args)
+
+        try:
+            return self.run(func, *args, progress_callback=report, **kwargs)
+        finally:
+            running = False
@@ -1,82 +1,200 @@
 import logging
 
 from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
 
 from gi.repository import GLib, Gio
 
+from ..metrics import IMPORT_PHASE_SECONDS
 from .util import (
-    copy_commit, open_repository, update_repo_metadata, verify_commit_sig
+    checkout_repository, copy_commit, update_repo_metadata, verify_commit_sig
 )
 
+# A ref moved by an import. old_commit is None for new refs.
+RefUpdate = namedtuple('RefUpdate', ['ref', 'old_commit', 'new_commit'])
+
+
+class InvalidBundle(RuntimeError):
+    """The bundle can't be imported by any importer"""
+    pass
+
+
+@contextmanager
+def import_phase(name, progress_callback=None):
+    """Context manager timing a phase of an import
+
+    The duration is recorded in the import phase metrics. If
+    progress_callback is set, it's called with the phase name and None
+    as the phase starts.
+    """
+    if progress_callback is not None:
+        progress_callback(name, None)
+    with IMPORT_PHASE_SECONDS.time(phase=name):
+        yield
+
 
 class BaseImporter(object, metaclass=ABCMeta):
     def __init__(self, src_path, repository_path, gpg_homedir, keyring,
-                 sign_key):
+                 sign_key, update_metadata=True, progress_callback=None):
         self._src_path = src_path
         self._repo_path = repository_path
         self._gpg_homedir = gpg_homedir
         self._keyring = keyring
         self._sign_key = sign_key
+        self._update_metadata = update_metadata
+        self._transaction_repo = None
+
+        # Called with (phase name, None) as each phase of the import
+        # starts and (None, dict of counters) to report progress
+        self._progress_callback = progress_callback
+
+    # List of (offset, bytes) signatures identifying this importer's
+    # bundles from the start of the file
+    SIGNATURES = []
 
     @property
     def MIME_TYPE(self):
         raise NotImplementedError()
 
+    @classmethod
+    def sniff(cls, header):
+        """Check if header, the start of a file, is one of our bundles"""
+        return any(header[offset:offset + len(signature)] == signature
+                   for offset, signature in cls.SIGNATURES)
+
+    @classmethod
+    def peek_commit(cls, src_path):
+        """Cheaply read the ref and commit a bundle would import
+
+        Returns a (ref, commit) tuple, or None if they can't be
+        determined without importing the bundle. Raises InvalidBundle
+        if the bundle is found to be unusable.
+        """
+        return None
+
     @abstractmethod
     def import_to_repo(self):
+        """Import the bundle and return a RefUpdate or None"""
         pass
 
+    def use_transaction(self, target_repo):
+        """Import into a transaction the caller manages in target_repo
+
+        The ref is only staged in the transaction and the repo metadata
+        isn't updated, so several bundles can be imported in one
+        transaction. If the import fails, the transaction is left for
+        the caller to abort or continue with.
+        """
+        self._transaction_repo = target_repo
+
+    @contextmanager
+    def _open_target_repo(self):
+        if self._transaction_repo is not None:
+            yield self._transaction_repo
+        else:
+            with checkout_repository(self._repo_path) as target_repo:
+                yield target_repo
+
+    def _phase(self, name):
+        return import_phase(name, self._progress_callback)
+
+    def _report_progress(self, **progress):
+        if self._progress_callback is not None:
+            self._progress_callback(None, progress)
+
+    def _prepare_transaction(self, target_repo):
+        if self._transaction_repo is None:
+            target_repo.prepare_transaction(None)
+
+    def _commit_transaction(self, target_repo):
+        if self._transaction_repo is None:
+            _, stats = target_repo.commit_transaction(None)
+            self._report_progress(
+                objects_written=(stats.metadata_objects_written +
+                                 stats.content_objects_written),
+                bytes_written=stats.content_bytes_written)
+
+    def _abort_transaction(self, target_repo):
+        if self._transaction_repo is None:
+            target_repo.abort_transaction(None)
+
     @abstractmethod
     def _import_commit(self, commit, src_path_obj, target_repo):
         pass
 
     def _apply_commit_to_repo(self, commit, ref):
-        target_repo = open_repository(self._repo_path)
-
-        # Skip the rest of processing if the current ref is the same as
-        # in delta
-        _, current_rev = target_repo.resolve_rev(ref, allow_noent=True)
-        logging.debug('Current %s commit: %s', ref, current_rev)
-        if current_rev == commit:
-            logging.info('Ref %s already at commit %s. Skipping changes.',
-                         ref, commit)
-            return
-
-        # Prepare the transaction
-        target_repo.prepare_transaction(None)
-
-        # Apply the delta to our target repo
-        try:
-            src_path_obj = Gio.File.new_for_path(self._src_path)
-
-            # Importer-specific way to get data from provided commit in
-            # source repo into the target_repo
-            self._import_commit(commit, src_path_obj, target_repo)
-
-            # Verify that the commit signature is valid
+        """Import commit to ref in the repo
+
+        Returns a RefUpdate describing the change to ref, or None if
+        ref was already at commit.
+        """
+        with self._open_target_repo() as target_repo:
+            # Skip the rest of processing if the current ref is the same
+            # as in delta
+            _, current_rev = target_repo.resolve_rev(ref, allow_noent=True)
+            logging.debug('Current %s commit: %s', ref, current_rev)
+            if current_rev == commit:
+                logging.info('Ref %s already at commit %s. Skipping '
+                             'changes.', ref, commit)
+                return None
+
+            # Prepare the transaction
+            self._prepare_transaction(target_repo)
+
+            # Apply the delta to our target repo
+            try:
+                src_path_obj = Gio.File.new_for_path(self._src_path)
+
+                # Importer-specific way to get data from provided commit
+                # in source repo into the target_repo
+                with self._phase('apply'):
+                    self._import_commit(commit, src_path_obj,
+                                        target_repo)
+
+                new_commit = self._commit_to_ref(target_repo, commit, ref)
+            except:  # noqa: E722
+                self._abort_transaction(target_repo)
+                raise
+
+        return self._finish_import(ref, current_rev, new_commit)
+
+    def _commit_to_ref(self, target_repo, commit, ref):
+        """Verify the imported commit and commit it to ref
+
+        The caller must have prepared a transaction in target_repo and
+        imported commit in it. The commit is copied to get this repo's
+        bindings, signed and the transaction is committed. Returns the
+        checksum of the new commit.
+        """
+        # Verify that the commit signature is valid
+        with self._phase('verify'):
             verify_commit_sig(target_repo, commit, self._gpg_homedir,
                               self._keyring)
 
-            # Copy the commit to get correct collection and ref bindings
+        # Copy the commit to get correct collection and ref bindings
+        with self._phase('copy_commit'):
             new_commit = copy_commit(target_repo, commit, ref)
 
-            # Sign this new commit
-            if self._sign_key:
-                logging.info("Signing with key %s from %s", self._sign_key,
-                             self._gpg_homedir)
-                try:
+        # Sign this new commit
+        if self._sign_key:
+            logging.info("Signing with key %s from %s", self._sign_key,
+                         self._gpg_homedir)
+            try:
+                with self._phase('sign'):
                     target_repo.sign_commit(commit_checksum=new_commit,
                                             key_id=self._sign_key,
                                             homedir=self._gpg_homedir,
                                             cancellable=None)
-                except GLib.Error as err:
-                    # Only ignore error if it's already signed with this key
-                    if not err.matches(Gio.io_error_quark(),
-                                       Gio.IOErrorEnum.EXISTS):
-                        raise
+            except GLib.Error as err:
+                # Only ignore error if it's already signed with this key
+                if not err.matches(Gio.io_error_quark(),
+                                   Gio.IOErrorEnum.EXISTS):
+                    raise
 
-                    logging.debug("Already signed with key %s", self._sign_key)
+                logging.debug("Already signed with key %s", self._sign_key)
 
+        with self._phase('commit'):
             # Set the ref to the new commit. Ideally this would use
             # transaction_set_collection_ref, but that's not available
             # on SOMA and the commit was set to use this repo's
@@ -84,13 +202,24 @@ class BaseImporter(object, metaclass=ABCMeta):
             target_repo.transaction_set_ref(None, ref, new_commit)
 
             # Commit the transaction
-            target_repo.commit_transaction(None)
+            self._commit_transaction(target_repo)
 
-        except:  # noqa: E722
-            target_repo.abort_transaction(None)
-            raise
+        return new_commit
+
+    def _finish_import(self, ref, current_rev, new_commit):
+        """Update the repo metadata if needed and return the RefUpdate"""
+        ref_update = RefUpdate(ref, current_rev, new_commit)
+
+        # The caller may prefer to coalesce metadata updates for
+        # several imports
+        if not self._update_metadata or self._transaction_repo is not None:
+            logging.info("Skipping summary update")
+            return ref_update
 
         logging.info("updating summary...")
-        update_repo_metadata(self._repo_path, self._gpg_homedir,
-                             self._sign_key)
+        with self._phase('summary_update'):
+            update_repo_metadata(self._repo_path, self._gpg_homedir,
+                                 self._sign_key)
         logging.info("updating summary done...")
+
+        return ref_update
@@ -2,7 +2,7 @@ import logging
 
 import gi
 
-from .base import BaseImporter
+from .base import BaseImporter, InvalidBundle
 from .util import get_metadata_contents
 
 gi.require_version('OSTree', '1.0')
@@ -20,16 +20,82 @@ OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT = \
     "a" + OSTREE_STATIC_DELTA_FALLBACK_FORMAT + \
     ")"
 
+METADATA_KEYS = ['ref',
+                 'flatpak',
+                 'origin',
+                 'runtime-repo',
+                 'metadata',
+                 'gpg-keys']
+
+
+def read_bundle_header(bundle_path):
+    """Read the commit and metadata from a flatpak bundle's superblock
+
+    The bundle is mapped rather than read, so only the parts of the
+    file holding the header are touched. Returns the commit checksum and
+    a dict of METADATA_KEYS values with missing keys set to ''. Raises
+    InvalidBundle if the header is malformed, the ref isn't a flatpak
+    app or runtime ref or the metadata is missing.
+    """
+    # Mmap the flatpak file and create a GLib.Variant from it
+    mapped_file = GLib.MappedFile.new(bundle_path, False)
+    delta = GLib.Variant.new_from_bytes(
+        GLib.VariantType(OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT),
+        mapped_file.get_bytes(),
+        False)
+
+    # Parse flatpak metadata
+    # Use get_child_value instead of array index to avoid
+    # slowdown (constructing the whole array?)
+    checksum_variant = delta.get_child_value(3)
+    try:
+        OSTree.validate_structureof_csum_v(checksum_variant)
+    except GLib.Error as err:
+        raise InvalidBundle('Invalid flatpak bundle header: {}'
+                            .format(err.message)) from err
+
+    metadata_variant = delta.get_child_value(0)
+    logging.debug("Metadata keys: %s", list(metadata_variant.keys()))
+
+    commit = OSTree.checksum_from_bytes_v(checksum_variant)
+
+    metadata = {}
+    logging.debug("===== Start Metadata =====")
+    for key in METADATA_KEYS:
+        try:
+            metadata[key] = metadata_variant[key]
+        except KeyError:
+            metadata[key] = ''
+
+        logging.debug(" %s: %s", key, metadata[key])
+    logging.debug("===== End Metadata =====")
+
+    ref = metadata['ref']
+    ref_parts = ref.split('/') if isinstance(ref, str) else []
+    if len(ref_parts) != 4 or ref_parts[0] not in ('app', 'runtime') or \
+            not all(ref_parts):
+        raise InvalidBundle('Invalid flatpak bundle ref {!r}'.format(ref))
+
+    if not metadata['metadata']:
+        raise InvalidBundle('Flatpak bundle for {} has no metadata'
+                            .format(ref))
+
+    return commit, metadata
+
 
 class FlatpakImporter(BaseImporter):
     MIME_TYPE = 'application/octet-stream'
 
-    METADATA_KEYS = ['ref',
-                     'flatpak',
-                     'origin',
-                     'runtime-repo',
-                     'metadata',
-                     'gpg-keys']
+    # flatpak build-bundle adds the flatpak key to the superblock
+    # metadata first so that its name starts the file
+    SIGNATURES = [(0, b'flatpak\x00')]
+
+    METADATA_KEYS = METADATA_KEYS
+
+    @classmethod
+    def peek_commit(cls, src_path):
+        commit, metadata = read_bundle_header(src_path)
+        return metadata['ref'], commit
 
     def _import_commit(self, commit, src_path_obj, target_repo):
         # Apply the delta to the target repo
@@ -47,33 +113,6 @@ class FlatpakImporter(BaseImporter):
     def import_to_repo(self):
         logging.info("Trying to use %s extractor...", self.__class__.__name__)
 
-        # Mmap the flatpak file and create a GLib.Variant from it
-        mapped_file = GLib.MappedFile.new(self._src_path, False)
-        delta = GLib.Variant.new_from_bytes(
-            GLib.VariantType(OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT),
-            mapped_file.get_bytes(),
-            False)
-
-        # Parse flatpak metadata
-        # Use get_child_value instead of array index to avoid
-        # slowdown (constructing the whole array?)
-        checksum_variant = delta.get_child_value(3)
-        OSTree.validate_structureof_csum_v(checksum_variant)
-
-        metadata_variant = delta.get_child_value(0)
-        logging.debug("Metadata keys: %s", list(metadata_variant.keys()))
-
-        commit = OSTree.checksum_from_bytes_v(checksum_variant)
-
-        self._metadata = {}
-        logging.debug("===== Start Metadata =====")
-        for key in FlatpakImporter.METADATA_KEYS:
-            try:
-                self._metadata[key] = metadata_variant[key]
-            except KeyError:
-                self._metadata[key] = ''
-
-            logging.debug(" %s: %s", key, self._metadata[key])
-        logging.debug("===== End Metadata =====")
+        commit, self._metadata = read_bundle_header(self._src_path)
 
-        self._apply_commit_to_repo(commit, self._metadata['ref'])
+        return self._apply_commit_to_repo(commit, self._metadata['ref'])
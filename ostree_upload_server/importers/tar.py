@@ -1,27 +1,157 @@
+import bz2
+import gzip
 import logging
+import lzma
+import re
+import shutil
 import tempfile
 import tarfile
 
+from contextlib import contextmanager
+from gevent.monkey import get_original
 from urllib.parse import urljoin
 from urllib.request import pathname2url
 
-from gi.repository import GLib
+from os import (
+    close, fdopen, makedirs, path, pipe, sep as path_separator, stat
+)
 
-from os import makedirs, path, sep as path_separator
+import gi
 
 from .base import BaseImporter
-from .util import find_repo, open_repository
+from .util import find_missing_objects, find_repo, open_repository
+
+gi.require_version('OSTree', '1.0')
+from gi.repository import Gio, GLib, OSTree  # noqa: E402
+
+# Decompressors for the compressed tar formats by their magic numbers
+DECOMPRESSORS = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+]
+
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# The reader blocks on the pipe, so decompression has to run in a real
+# thread even if threading has been monkey patched by gevent
+_start_new_thread, _allocate_lock = get_original(
+    '_thread', ['start_new_thread', 'allocate_lock'])
+
+
+def get_decompressor(src_path):
+    """Return the function to open the compressed file or None"""
+    with open(src_path, 'rb') as src:
+        magic = src.read(8)
+    return next((func for prefix, func in DECOMPRESSORS
+                 if magic.startswith(prefix)), None)
+
+
+def _decompress_to_fd(src_path, open_func, fd, errors, done):
+    try:
+        with open_func(src_path, 'rb') as src, fdopen(fd, 'wb') as dest:
+            shutil.copyfileobj(src, dest, DECOMPRESS_CHUNK_SIZE)
+    except BrokenPipeError:
+        # The reader stopped early and will report why
+        pass
+    except Exception as err:
+        errors.append(err)
+    finally:
+        done.release()
+
+
+@contextmanager
+def open_decompressed(src_path):
+    """Open a possibly compressed file for streaming reads
+
+    Compressed files are decompressed in a separate thread and read
+    through a pipe, so decompression overlaps with processing the data.
+    Errors from decompression are raised when the context exits
+    normally and logged if it exits with an exception.
+    """
+    open_func = get_decompressor(src_path)
+    if open_func is None:
+        with open(src_path, 'rb') as src:
+            yield src
+        return
+
+    read_fd, write_fd = pipe()
+    errors = []
+    done = _allocate_lock()
+    done.acquire()
+    try:
+        _start_new_thread(_decompress_to_fd,
+                          (src_path, open_func, write_fd, errors, done))
+    except Exception:
+        close(read_fd)
+        close(write_fd)
+        raise
+
+    try:
+        with fdopen(read_fd, 'rb') as stream:
+            yield stream
+    except BaseException:
+        # Closing the read end stops the thread if it's not done. Don't
+        # mask the error already being raised with the thread's.
+        done.acquire()
+        if errors:
+            logging.error('Decompressing %s failed: %s', src_path, errors[0])
+        raise
+
+    done.acquire()
+    if errors:
+        raise errors[0]
 
 
 class TarImporter(BaseImporter):
     MIME_TYPE = 'application/x-tar'
 
+    # POSIX and GNU tar headers have a ustar magic
+    SIGNATURES = [(257, b'ustar')]
+
+    # Import modes. EXTRACT extracts the whole archive and pulls from
+    # it. STREAM reads the archive once, writing objects directly to
+    # the target repo.
+    EXTRACT = 'extract'
+    STREAM = 'stream'
+    IMPORT_MODES = [EXTRACT, STREAM]
+
+    # Repo paths in the archive, either at the top level or in a single
+    # directory
+    OBJECT_PATH_RE = re.compile(r'^(?:(?P<root>[^/]+)/)?objects/'
+                                r'(?P<prefix>[0-9a-f]{2})/'
+                                r'(?P<rest>[0-9a-f]{62})\.(?P<ext>[a-z]+)$')
+    REF_PATH_RE = re.compile(r'^(?:(?P<root>[^/]+)/)?refs/heads/(?P<ref>.+)$')
+    CHECKSUM_RE = re.compile(r'^[0-9a-f]{64}$')
+
+    # Metadata object types by loose object file extension
+    METADATA_OBJECT_TYPES = {
+        'commit': OSTree.ObjectType.COMMIT,
+        'dirtree': OSTree.ObjectType.DIR_TREE,
+        'dirmeta': OSTree.ObjectType.DIR_META,
+    }
+
+    # Larger content objects are spooled to a temporary file
+    MAX_IN_MEMORY_OBJECT_SIZE = 4 * 1024 * 1024
+
+    # How far into a compressed archive to look for the ref
+    PEEK_MAX_BYTES = 64 * 1024 * 1024
+
+    # Number of objects between progress reports when streaming
+    PROGRESS_INTERVAL = 500
+
     TEMP_DIR_PREFIX = path.abspath(path.join(path_separator,
                                              'var',
                                              'tmp',
                                              'ostree-upload-server',
                                              'tar'))
 
+    def __init__(self, *args, import_mode=EXTRACT, **kwargs):
+        super().__init__(*args, **kwargs)
+        if import_mode not in TarImporter.IMPORT_MODES:
+            raise ValueError('Unknown tar import mode {}'.format(import_mode))
+        self._import_mode = import_mode
+
     def _import_commit(self, commit, src_path_obj, target_repo):
         if not self._source_repo_path:
             raise RuntimeError("Cannot invoke _import_commit without calling "
@@ -35,6 +165,13 @@ class TarImporter(BaseImporter):
                       commit,
                       target_repo.get_path().get_uri())
 
+        # A local pull hardlinks objects when the repos have the same
+        # mode and are on the same filesystem, otherwise it has to copy
+        # them
+        if self._source_repo.get_mode() != target_repo.get_mode():
+            logging.info("Source repo mode differs from target, objects "
+                         "will be copied")
+
         options = GLib.Variant('a{sv}', {
             'refs': GLib.Variant('as', [commit]),
             'inherit-transaction': GLib.Variant('b', True),
@@ -42,54 +179,331 @@ class TarImporter(BaseImporter):
 
         source_repo_uri = urljoin('file:',
                                   pathname2url(self._source_repo_path))
-        target_repo.pull_with_options(source_repo_uri,
-                                      options,
-                                      None, None)
+
+        # The pull iterates the thread default main context, where the
+        # progress changes are also dispatched. Use a context of our own
+        # so imports in other threads don't dispatch them.
+        context = GLib.MainContext.new()
+        context.push_thread_default()
+        try:
+            progress = OSTree.AsyncProgress.new()
+            progress.connect('changed', self._report_pull_progress)
+            target_repo.pull_with_options(source_repo_uri,
+                                          options,
+                                          progress, None)
+            progress.finish()
+        finally:
+            context.pop_thread_default()
 
         logging.info("Importing complete.")
 
-    def import_to_repo(self):
-        logging.info('Trying to use %s extractor...', self.__class__.__name__)
+    def _report_pull_progress(self, progress):
+        self._report_progress(
+            objects_fetched=progress.get_uint('fetched'),
+            objects_requested=progress.get_uint('requested'),
+            bytes_transferred=progress.get_uint64('bytes-transferred'))
+
+    def _get_staging_dir(self):
+        """Choose the directory to extract the archive in
 
+        The target repo's tmp directory is on the same filesystem as its
+        objects, which allows the extracted objects to be hardlinked
+        into the repo instead of written a second time. If it's
+        somewhere else, extract to TEMP_DIR_PREFIX.
+        """
+        repo_tmp_dir = path.join(self._repo_path, 'tmp')
+        repo_objects_dir = path.join(self._repo_path, 'objects')
+        try:
+            if (stat(repo_tmp_dir).st_dev ==
+                    stat(repo_objects_dir).st_dev):
+                return repo_tmp_dir
+        except OSError as err:
+            logging.debug('Cannot stage in %s: %s', repo_tmp_dir, err)
+
+        logging.info('%s is not on the same filesystem as %s, objects will '
+                     'be copied', repo_tmp_dir, repo_objects_dir)
         if not path.isdir(self.__class__.TEMP_DIR_PREFIX):
             makedirs(self.__class__.TEMP_DIR_PREFIX, 0o0755)
+        return self.__class__.TEMP_DIR_PREFIX
+
+    @classmethod
+    def peek_commit(cls, src_path):
+        """Find the archive's ref by scanning the member headers
+
+        Uncompressed archives are scanned by seeking over the member
+        data. Compressed archives have to be decompressed to find the
+        headers, so only the first PEEK_MAX_BYTES are scanned.
+        """
+        max_offset = None
+        if get_decompressor(src_path) is not None:
+            max_offset = TarImporter.PEEK_MAX_BYTES
+
+        with tarfile.open(src_path) as tar_archive:
+            for member in tar_archive:
+                if max_offset is not None and member.offset > max_offset:
+                    break
+                if not member.isfile():
+                    continue
+
+                name = member.name
+                if name.startswith('./'):
+                    name = name[2:]
+                ref_match = TarImporter.REF_PATH_RE.match(name)
+                if ref_match is None:
+                    continue
+
+                ref_file = tar_archive.extractfile(member)
+                commit = ref_file.read().decode('ascii').strip()
+                if not TarImporter.CHECKSUM_RE.match(commit):
+                    return None
+                return ref_match.group('ref'), commit
+
+        return None
+
+    @staticmethod
+    def _get_single_ref(refs):
+        logging.debug("Refs: %r", refs)
 
+        if not refs:
+            logging.error("Could not find any refs in the source repo!")
+            raise RuntimeError("Missing refs in Tar ostree repository!")
+
+        # We only process the first ref in the repo provided - all
+        # other variations are currently unsupported.
+        if len(refs) > 1:
+            error_msg = ("Multiple refs ({}) found in Tar archive!"
+                         .format(refs))
+            logging.error(error_msg)
+            raise RuntimeError(error_msg)
+
+        ref, commit = refs.popitem()
+        logging.info("Ref: %s", ref)
+        logging.info("Commit: %s", commit)
+        return ref, commit
+
+    def import_to_repo(self):
+        logging.info('Trying to use %s extractor...', self.__class__.__name__)
+
+        if self._import_mode == TarImporter.STREAM:
+            ref_update = self._stream_to_repo()
+        else:
+            ref_update = self._extract_to_repo()
+
+        logging.info('Import complete of \'%s\' into %s!', self._src_path,
+                     self._repo_path)
+
+        return ref_update
+
+    def _extract_to_repo(self):
         with tempfile.TemporaryDirectory(
                 prefix=self.__class__.__name__,
-                dir=self.__class__.TEMP_DIR_PREFIX) as dest_path:
+                dir=self._get_staging_dir()) as dest_path:
             logging.info('Extracting \'%s\' to a temp dir in %s...',
                          self._src_path, dest_path)
-            with tarfile.open(self._src_path) as tar_archive:
+            with self._phase('extract'), \
+                    tarfile.open(self._src_path) as tar_archive:
                 tar_archive.extractall(path=dest_path)
 
             self._source_repo_path = find_repo(dest_path)
             source_repo = open_repository(self._source_repo_path)
+            self._source_repo = source_repo
 
             refs = source_repo.list_refs().out_all_refs
-            logging.debug("Refs: %r", refs)
+            ref, commit = self._get_single_ref(refs)
 
-            if not refs:
-                logging.error("Could not find any refs in the source repo!")
-                raise RuntimeError("Missing refs in Tar ostree repository!")
+            return self._apply_commit_to_repo(commit, ref)
 
-            # We only process the first ref in the repo provided - all
-            # other variations are currently unsupported.
-            if len(refs) > 1:
-                error_msg = ("Multiple refs ({}) found in Tar archive!"
-                             .format(refs))
-                logging.error(error_msg)
-                raise RuntimeError(error_msg)
+    def _stream_to_repo(self):
+        """Import the archive in a single pass without extracting it
 
-            ref, commit = refs.popitem()
-            logging.info("Ref: %s", ref)
-            logging.info("Commit: %s", commit)
+        Each object in the archive's repo is validated and written to a
+        transaction in the target repo as it's read. Only objects the
+        target repo doesn't have are written. Once the archive has been
+        read, the commit the ref points to is checked to be complete
+        before it's verified and committed like any other import.
+        """
+        logging.info('Streaming \'%s\' into %s...', self._src_path,
+                     self._repo_path)
+        with self._open_target_repo() as target_repo:
+            self._prepare_transaction(target_repo)
+            try:
+                with self._phase('apply'):
+                    refs, detached_metadata = self._stream_objects(
+                        target_repo)
+                ref, commit = self._get_single_ref(refs)
 
-            self._apply_commit_to_repo(commit, ref)
+                _, current_rev = target_repo.resolve_rev(ref,
+                                                         allow_noent=True)
+                logging.debug('Current %s commit: %s', ref, current_rev)
+                if current_rev == commit:
+                    logging.info('Ref %s already at commit %s. Skipping '
+                                 'changes.', ref, commit)
+                    self._abort_transaction(target_repo)
+                    return None
 
-        logging.info('Import complete of \'%s\' into %s!', self._src_path,
-                     self._repo_path)
+                # Detached metadata holds the commit's GPG signatures
+                if commit in detached_metadata:
+                    target_repo.write_commit_detached_metadata(
+                        commit, detached_metadata[commit], None)
+
+                missing = find_missing_objects(target_repo, commit)
+                if missing:
+                    raise RuntimeError('Commit {} in Tar archive is missing '
+                                       '{} objects'.format(commit,
+                                                           len(missing)))
+
+                new_commit = self._commit_to_ref(target_repo, commit, ref)
+            except:  # noqa: E722
+                self._abort_transaction(target_repo)
+                raise
+
+        return self._finish_import(ref, current_rev, new_commit)
 
+    def _stream_objects(self, target_repo):
+        """Write the archive's objects to the target repo
 
-# This works with the same code so we just override the mimetype
+        Returns a dict of refs to commits and a dict of commits to their
+        detached metadata.
+        """
+        refs = {}
+        detached_metadata = {}
+        repo_root = None
+        written = 0
+        skipped = 0
+        bytes_read = 0
+        last_reported = None
+
+        with open_decompressed(self._src_path) as stream, \
+                tarfile.open(fileobj=stream, mode='r|') as tar_archive:
+            for member in tar_archive:
+                if not member.isfile():
+                    continue
+
+                name = member.name
+                if name.startswith('./'):
+                    name = name[2:]
+                object_match = TarImporter.OBJECT_PATH_RE.match(name)
+                ref_match = TarImporter.REF_PATH_RE.match(name)
+                match = object_match or ref_match
+                if match is None:
+                    logging.debug('Ignoring %s', member.name)
+                    continue
+
+                # Everything has to come from the same repo
+                root = match.group('root')
+                if repo_root is None:
+                    repo_root = root
+                elif root != repo_root:
+                    raise RuntimeError('Multiple repos found in Tar archive!')
+
+                if ref_match is not None:
+                    ref_file = tar_archive.extractfile(member)
+                    commit = ref_file.read().decode('ascii').strip()
+                    if not TarImporter.CHECKSUM_RE.match(commit):
+                        raise RuntimeError('Invalid commit {!r} for ref {}'
+                                           .format(commit,
+                                                   ref_match.group('ref')))
+                    refs[ref_match.group('ref')] = commit
+                    continue
+
+                checksum = object_match.group('prefix') + \
+                    object_match.group('rest')
+                ext = object_match.group('ext')
+                bytes_read += member.size
+                counted = written + skipped
+                if ext == 'commitmeta':
+                    data = tar_archive.extractfile(member).read()
+                    detached_metadata[checksum] = GLib.Variant.new_from_bytes(
+                        GLib.VariantType('a{sv}'), GLib.Bytes.new(data),
+                        False)
+                elif ext in TarImporter.METADATA_OBJECT_TYPES:
+                    objtype = TarImporter.METADATA_OBJECT_TYPES[ext]
+                    if target_repo.has_object(objtype, checksum, None)[1]:
+                        skipped += 1
+                    else:
+                        self._write_metadata_object(target_repo, tar_archive,
+                                                    member, objtype, checksum)
+                        written += 1
+                elif ext == 'filez':
+                    if target_repo.has_object(OSTree.ObjectType.FILE,
+                                              checksum, None)[1]:
+                        skipped += 1
+                    else:
+                        self._write_content_object(target_repo, tar_archive,
+                                                   member, checksum)
+                        written += 1
+                elif ext == 'file':
+                    raise RuntimeError('Streaming import requires an archive '
+                                       'mode repo in the Tar archive')
+                else:
+                    logging.debug('Ignoring %s', member.name)
+
+                # Only report when an object was counted so members like
+                # detached metadata don't repeat the last report
+                if (written + skipped != counted and
+                        (written + skipped) %
+                        TarImporter.PROGRESS_INTERVAL == 0):
+                    self._report_progress(objects_written=written,
+                                          objects_skipped=skipped,
+                                          bytes_read=bytes_read)
+                    last_reported = (written, skipped)
+
+        logging.info('Wrote %d objects, %d already present', written,
+                     skipped)
+        if (written, skipped) != last_reported:
+            self._report_progress(objects_written=written,
+                                  objects_skipped=skipped,
+                                  bytes_read=bytes_read)
+        return refs, detached_metadata
+
+    @staticmethod
+    def _write_metadata_object(target_repo, tar_archive, member, objtype,
+                               checksum):
+        data = tar_archive.extractfile(member).read()
+        variant = GLib.Variant.new_from_bytes(
+            OSTree.metadata_variant_type(objtype), GLib.Bytes.new(data),
+            False)
+
+        # The expected checksum is verified against the written object
+        target_repo.write_metadata(objtype, checksum, variant, None)
+
+    @contextmanager
+    def _open_member_stream(self, tar_archive, member):
+        """Open a tar member as a Gio.InputStream"""
+        member_file = tar_archive.extractfile(member)
+        if member.size <= TarImporter.MAX_IN_MEMORY_OBJECT_SIZE:
+            data = member_file.read()
+            yield Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+            return
+
+        with tempfile.NamedTemporaryFile(
+                prefix=self.__class__.__name__,
+                dir=self._get_staging_dir()) as object_file:
+            shutil.copyfileobj(member_file, object_file)
+            object_file.flush()
+            object_input = Gio.File.new_for_path(object_file.name).read(None)
+            try:
+                yield object_input
+            finally:
+                object_input.close(None)
+
+    def _write_content_object(self, target_repo, tar_archive, member,
+                              checksum):
+        # Convert the archive mode object to a canonical content stream
+        with self._open_member_stream(tar_archive, member) as object_input:
+            _, content_input, file_info, xattrs = \
+                OSTree.content_stream_parse(True, object_input, member.size,
+                                            False, None)
+            _, object_input, length = OSTree.raw_file_to_content_stream(
+                content_input, file_info, xattrs, None)
+
+            # The expected checksum is verified against the written object
+            target_repo.write_content(checksum, object_input, length, None)
+
+
+# This works with the same code so we just override the mimetype and
+# signatures. Besides gzip, bzip2 and xz compressed archives work.
 class TgzImporter(TarImporter):
     MIME_TYPE = 'application/gzip'
+
+    SIGNATURES = [(0, prefix) for prefix, _ in DECOMPRESSORS]
@@ -1,7 +1,12 @@
+import base64
 import errno
 import logging
 import os
 import subprocess
+import tempfile
+import threading
+
+from contextlib import contextmanager
 
 import gi
 gi.require_version('OSTree', '1.0')
@@ -164,6 +169,129 @@ def open_repository(repo_path):
     return repo
 
 
+class RepositoryCache:
+    """Reuse open OSTree.Repo handles for each repo path
+
+    Opening a repo parses its config and sets up its directories, which
+    is a fixed cost on every import that grows with the number of
+    remotes in the config. Handles are instead kept after use and
+    handed out again by checkout().
+
+    A handle is only used by one checkout at a time, so transactions in
+    concurrent imports are never mixed in one handle. At most max_idle
+    handles are kept for each repo. A handle is reopened when the
+    repo's config file has changed since it was opened. invalidate()
+    replaces the repo's GENERATION_FILE so all handles for the repo
+    are reopened, including those cached by other processes, such as
+    after maintenance. Handles used by an import that raised are
+    dropped rather than reused since they may be left in a transaction.
+    """
+    DEFAULT_MAX_IDLE = 4
+
+    # File owned by the server marking the repo's handles stale when
+    # it's replaced
+    GENERATION_FILE = '.eos-repo-generation'
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE):
+        self._max_idle = max_idle
+
+        # Map of repo path to list of idle (config stamp, repo) tuples
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _get_config_stamp(cls, repo_path):
+        stamp = []
+        for name in ('config', cls.GENERATION_FILE):
+            try:
+                st = os.stat(os.path.join(repo_path, name))
+            except FileNotFoundError:
+                stamp.append(None)
+                continue
+            stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        return tuple(stamp)
+
+    @contextmanager
+    def checkout(self, repo_path):
+        """Context manager providing an open repo for exclusive use
+
+        The repo is created if it doesn't exist.
+        """
+        repo_path = os.path.abspath(repo_path)
+        stamp = self._get_config_stamp(repo_path)
+        repo = None
+        with self._lock:
+            idle = self._idle.get(repo_path, [])
+            while idle:
+                idle_stamp, idle_repo = idle.pop()
+                if idle_stamp == stamp:
+                    repo = idle_repo
+                    break
+
+        if repo is None:
+            repo = open_repository(repo_path)
+            stamp = self._get_config_stamp(repo_path)
+        else:
+            logging.debug('Reusing open repo at %s', repo_path)
+
+        yield repo
+
+        # Drop handles opened before the config changed or the repo
+        # was invalidated
+        if self._get_config_stamp(repo_path) != stamp:
+            return
+        with self._lock:
+            idle = self._idle.setdefault(repo_path, [])
+            if len(idle) < self._max_idle:
+                idle.append((stamp, repo))
+
+    def invalidate(self, repo_path):
+        """Reopen the handles for a repo on their next use
+
+        The repo's GENERATION_FILE is replaced so handles cached by
+        other processes are reopened as well.
+        """
+        repo_path = os.path.abspath(repo_path)
+        if os.path.isdir(repo_path):
+            generation_path = os.path.join(repo_path, self.GENERATION_FILE)
+            try:
+                with open(generation_path) as generation_file:
+                    generation = int(generation_file.read())
+            except (FileNotFoundError, ValueError):
+                generation = 0
+
+            # Replace rather than rewrite the file so its inode changes
+            fd, tmp_path = tempfile.mkstemp(dir=repo_path,
+                                            prefix=self.GENERATION_FILE)
+            try:
+                with os.fdopen(fd, 'w') as tmp_file:
+                    tmp_file.write('{}\n'.format(generation + 1))
+                os.replace(tmp_path, generation_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        with self._lock:
+            self._idle.pop(repo_path, None)
+
+
+# Handles shared by all the imports in this process
+_repository_cache = RepositoryCache()
+
+
+def checkout_repository(repo_path):
+    """Open a repo from the process wide RepositoryCache
+
+    Returns a context manager providing the repo. It must not be used
+    after the context exits.
+    """
+    return _repository_cache.checkout(repo_path)
+
+
+def invalidate_repository(repo_path):
+    """Reopen cached handles for a repo after it's changed externally"""
+    _repository_cache.invalidate(repo_path)
+
+
 def verify_commit_sig(repo, commit, gpg_homedir, keyring):
     # Verify gpg signature
     keyring_dir = None
@@ -202,6 +330,197 @@ def update_repo_metadata(repository_path, gpg_homedir, sign_key):
     subprocess.check_call(cmd)
 
 
+# Prune the repo and regenerate the metadata and optionally all static
+# deltas. This can take a long time on large repos. The exit status of
+# flatpak build-update-repo is returned.
+def perform_repo_maintenance(repository_path, gpg_homedir, sign_key,
+                             generate_deltas=True):
+    cmd = ['flatpak', 'build-update-repo', '--prune']
+    if generate_deltas:
+        cmd.append('--generate-static-deltas')
+    if gpg_homedir:
+        cmd.append('--gpg-homedir={}'.format(gpg_homedir))
+    if sign_key:
+        cmd.append('--gpg-sign={}'.format(sign_key))
+    cmd.append(repository_path)
+
+    logging.info('Performing maintenance on %s', repository_path)
+    logging.debug('Executing %s', ' '.join(cmd))
+
+    return subprocess.call(cmd)
+
+
+def _checksum_to_b64(checksum):
+    # libostree's modified base64 with _ in place of / and no padding
+    return base64.b64encode(bytes.fromhex(checksum)).decode(
+        'ascii').rstrip('=').replace('/', '_')
+
+
+def get_static_delta_path(from_commit, to_commit, target=None):
+    """Return the path of a static delta relative to its repo
+
+    The layout follows libostree's. target names a file in the delta's
+    directory, such as superblock or a part number.
+    """
+    to_b64 = _checksum_to_b64(to_commit)
+    if from_commit is None:
+        path = 'deltas/{}/{}'.format(to_b64[:2], to_b64[2:])
+    else:
+        from_b64 = _checksum_to_b64(from_commit)
+        path = 'deltas/{}/{}-{}'.format(from_b64[:2], from_b64[2:], to_b64)
+    if target is not None:
+        path += '/' + target
+    return path
+
+
+def generate_static_deltas(repo, deltas):
+    """Generate static deltas for (from_commit, to_commit) pairs
+
+    A from_commit of None generates a delta from scratch. Deltas that
+    already exist are skipped. Deltas from scratch have no fallback
+    objects, which clients would fetch separately, so they hold the
+    whole commit and can be sent as a flatpak bundle.
+    """
+    existing = set(repo.list_static_delta_names()[1])
+    for from_commit, to_commit in deltas:
+        if from_commit is None:
+            delta_name = to_commit
+        else:
+            delta_name = '{}-{}'.format(from_commit, to_commit)
+        if delta_name in existing:
+            logging.debug('Static delta %s already exists', delta_name)
+            continue
+
+        logging.info('Generating static delta %s', delta_name)
+        params = {}
+        if from_commit is None:
+            params['min-fallback-size'] = GLib.Variant('u', 0)
+        params = GLib.Variant('a{sv}', params)
+        repo.static_delta_generate(OSTree.StaticDeltaGenerateOpt.MAJOR,
+                                   from_commit, to_commit, None, params,
+                                   None)
+        existing.add(delta_name)
+
+
+def _walk_commit_tree(repo, commit, visit):
+    """Call visit(object type, checksum) for the objects in commit's tree
+
+    Each object is visited once. Only the objects needed to check out
+    the commit are visited, not its parents. A directory's contents are
+    only visited if visit returns True for its dirtree.
+    """
+    _, commit_variant, _ = repo.load_commit(commit)
+    dirs = [(
+        OSTree.checksum_from_bytes_v(commit_variant.get_child_value(
+            COMMIT_TREE_CONTENT_CHECKSUM_INDEX)),
+        OSTree.checksum_from_bytes_v(commit_variant.get_child_value(
+            COMMIT_TREE_METADATA_CHECKSUM_INDEX)),
+    )]
+    seen = set()
+
+    def check(objtype, checksum):
+        if (objtype, checksum) in seen:
+            return False
+        seen.add((objtype, checksum))
+        return visit(objtype, checksum)
+
+    while dirs:
+        tree_checksum, meta_checksum = dirs.pop()
+        check(OSTree.ObjectType.DIR_META, meta_checksum)
+        if not check(OSTree.ObjectType.DIR_TREE, tree_checksum):
+            continue
+
+        # Dirtree format is (a(say)a(sayay)) for files and subdirs
+        _, tree = repo.load_variant(OSTree.ObjectType.DIR_TREE,
+                                    tree_checksum)
+        files = tree.get_child_value(0)
+        for i in range(files.n_children()):
+            check(OSTree.ObjectType.FILE,
+                  OSTree.checksum_from_bytes_v(
+                      files.get_child_value(i).get_child_value(1)))
+        subdirs = tree.get_child_value(1)
+        for i in range(subdirs.n_children()):
+            subdir = subdirs.get_child_value(i)
+            dirs.append((
+                OSTree.checksum_from_bytes_v(subdir.get_child_value(1)),
+                OSTree.checksum_from_bytes_v(subdir.get_child_value(2)),
+            ))
+
+
+def find_missing_objects(repo, commit):
+    """Return (object type, checksum) pairs missing from commit's tree
+
+    Only the objects needed to check out the commit are considered, not
+    its parents.
+    """
+    missing = []
+
+    def check(objtype, checksum):
+        _, have_object = repo.has_object(objtype, checksum, None)
+        if not have_object:
+            missing.append((objtype, checksum))
+        return have_object
+
+    _walk_commit_tree(repo, commit, check)
+    return missing
+
+
+def find_new_objects(repo, commit, base_commit=None):
+    """Return (object type, checksum) pairs commit adds to base_commit
+
+    These are the commit object and the objects in its tree that aren't
+    in base_commit's tree, which is all a repo that has base_commit
+    needs to have commit too. Directories whose dirtree is the same as
+    one in base_commit aren't walked. Without a base_commit, all of the
+    commit's objects are returned.
+    """
+    base_objects = set()
+    if base_commit is not None:
+        def add(objtype, checksum):
+            base_objects.add((objtype, checksum))
+            return True
+
+        _walk_commit_tree(repo, base_commit, add)
+
+    new_objects = [(OSTree.ObjectType.COMMIT, commit)]
+
+    def check(objtype, checksum):
+        if (objtype, checksum) in base_objects:
+            return False
+        new_objects.append((objtype, checksum))
+        return True
+
+    _walk_commit_tree(repo, commit, check)
+    return new_objects
+
+
+def get_from_commit(repo, commit):
+    """Return the commit that commit was copied from or None
+
+    copy_commit records the source commit in the xa.from_commit
+    metadata, so this finds the commit that was uploaded to make it.
+    """
+    _, commit_variant, _ = repo.load_commit(commit)
+    commit_metadata = GLib.VariantDict.new(commit_variant.get_child_value(0))
+    from_commit = commit_metadata.lookup_value('xa.from_commit',
+                                               GLib.VariantType('s'))
+    if from_commit is None:
+        return None
+    return from_commit.get_string()
+
+
+def get_ref_commits(repo_path, ref):
+    """Return the commit ref points to and the commit it was copied from
+
+    Both are None if the ref doesn't exist in the repo.
+    """
+    with checkout_repository(repo_path) as repo:
+        _, commit = repo.resolve_rev(ref, True)
+        if commit is None:
+            return None, None
+        return commit, get_from_commit(repo, commit)
+
+
 def find_repo(start_path):
     refs_suffix = os.path.join('refs', 'heads')
 
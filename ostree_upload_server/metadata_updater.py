@@ -0,0 +1,124 @@
+import logging
+
+from time import time
+
+from gevent import Greenlet
+from gevent.event import Event
+from gevent.lock import RLock
+
+from ostree_upload_server.importers.util import update_repo_metadata
+from ostree_upload_server.metrics import IMPORT_PHASE_SECONDS
+from ostree_upload_server.repolock import RepoLock
+
+
+class MetadataUpdater:
+    """Coalesce repository metadata updates from many imports
+
+    Regenerating the summary and appstream data with flatpak
+    build-update-repo takes time proportional to the size of the repo,
+    so doing it after every import dominates the time spent on bursts
+    of uploads. Instead, imports mark their repo as dirty and the
+    metadata is regenerated once no further imports have arrived for
+    the debounce period. To keep clients from waiting indefinitely
+    during a long burst, a dirty repo is always updated once it has
+    been dirty for max_staleness seconds.
+    """
+    DEFAULT_DEBOUNCE = 5
+    DEFAULT_MAX_STALENESS = 60
+
+    def __init__(self, executor, gpg_homedir=None, sign_key=None,
+                 debounce=DEFAULT_DEBOUNCE,
+                 max_staleness=DEFAULT_MAX_STALENESS):
+        self._executor = executor
+        self._gpg_homedir = gpg_homedir
+        self._sign_key = sign_key
+        self._debounce = debounce
+        self._max_staleness = max_staleness
+
+        # Map of dirty repo path to (first dirty time, last dirty time)
+        self._dirty = {}
+        self._repo_locks = {}
+        self._wakeup = Event()
+        self._stopping = False
+        self._greenlet = None
+
+    def start(self):
+        self._stopping = False
+        self._greenlet = Greenlet.spawn(self._run)
+
+    def stop(self):
+        # Let any in progress update finish
+        if self._greenlet is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._greenlet.join()
+            self._greenlet = None
+
+        # Don't leave any repos with stale metadata
+        for repo_path in list(self._dirty):
+            try:
+                self.update_now(repo_path)
+            except Exception as err:
+                logging.error('Updating %s metadata failed: %s',
+                              repo_path, err)
+
+    def mark_dirty(self, repo_path):
+        """Schedule a metadata update for the repo"""
+        now = time()
+        first_dirty, _ = self._dirty.get(repo_path, (now, now))
+        self._dirty[repo_path] = (first_dirty, now)
+        logging.debug('Marked %s metadata dirty', repo_path)
+        self._wakeup.set()
+
+    def update_now(self, repo_path):
+        """Update the repo metadata immediately and wait for completion"""
+        self._dirty.pop(repo_path, None)
+        self._update(repo_path)
+
+    def repo_lock(self, repo_path):
+        """Get the lock serializing metadata updates for the repo
+
+        Holding it keeps the updater from touching the repo, which is
+        useful while maintenance regenerates the metadata itself.
+        """
+        return self._repo_locks.setdefault(repo_path, RLock())
+
+    def _get_due_time(self, repo_path):
+        first_dirty, last_dirty = self._dirty[repo_path]
+        return min(last_dirty + self._debounce,
+                   first_dirty + self._max_staleness)
+
+    def _run(self):
+        while not self._stopping:
+            now = time()
+            for repo_path in list(self._dirty):
+                if self._stopping:
+                    break
+                if self._get_due_time(repo_path) > now:
+                    continue
+
+                del self._dirty[repo_path]
+                try:
+                    self._update(repo_path)
+                except Exception as err:
+                    # The next import or maintenance will try again
+                    logging.error('Updating %s metadata failed: %s',
+                                  repo_path, err)
+
+            # Sleep until the next update is due or a repo is marked
+            timeout = None
+            if self._dirty:
+                next_due = min(map(self._get_due_time, self._dirty))
+                timeout = max(next_due - time(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _update(self, repo_path):
+        # An update started after an import has to run to completion
+        # after any in progress update to be sure it includes it
+        with self.repo_lock(repo_path), RepoLock(repo_path):
+            logging.info('Updating %s metadata', repo_path)
+            with IMPORT_PHASE_SECONDS.time(phase='summary_update'):
+                self._executor.run(update_repo_metadata, repo_path,
+                                   self._gpg_homedir, self._sign_key)
+            logging.info('Updated %s metadata', repo_path)
@@ -0,0 +1,230 @@
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import monotonic
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape_label_value(value))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class for metrics with optional labels
+
+    Values are kept per combination of label values, which are passed
+    as keyword arguments when updating the metric.
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def _get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} requires labels {}, got {}'.format(
+                self.name, ', '.join(self.labelnames),
+                ', '.join(sorted(labels))))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_pairs(self, key, *extra):
+        return tuple(zip(self.labelnames, key)) + extra
+
+    def clear(self):
+        """Remove the values for all label combinations"""
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self):
+        """Return a list of (suffix, label pairs, value) tuples"""
+        with self._lock:
+            return [('', self._label_pairs(key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.TYPE),
+        ]
+        for suffix, labels, value in self._samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            _format_labels(labels),
+                                            _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only be increased')
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in fixed buckets
+
+    Each observation is counted in the first bucket it fits in, and the
+    cumulative counts Prometheus expects are only computed when the
+    histogram is rendered.
+    """
+    TYPE = 'histogram'
+
+    # Durations from a millisecond to an hour
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30,
+                       60, 300, 900, 3600)
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=None):
+        self._buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                                        registry)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Bucket counts with a final +Inf bucket and the sum
+                entry = self._values[key] = [
+                    [0] * (len(self._buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager observing the time spent in its body
+
+        The time is observed even if the body raises.
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts), total)
+                      for key, (counts, total)
+                      in sorted(self._values.items())]
+
+        samples = []
+        bounds = self._buckets + (float('inf'),)
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                samples.append(('_bucket',
+                                self._label_pairs(
+                                    key, ('le', _format_value(bound))),
+                                cumulative))
+            samples.append(('_sum', self._label_pairs(key), total))
+            samples.append(('_count', self._label_pairs(key), cumulative))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format
+
+    Metrics register themselves in the process wide REGISTRY, which is
+    rendered by the server's /metrics endpoint. Updating a metric only
+    takes a lock and touches a few numbers, so they're cheap enough to
+    leave on. Metrics are updated from both greenlets and import
+    executor threads. Those updated in import executor processes stay
+    in that process and aren't reported.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric {} already registered'
+                                 .format(metric.name))
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        """Return all the metrics in the text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(),
+                             key=lambda metric: metric.name)
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+QUEUE_DEPTH = Gauge(
+    'ostree_upload_queue_depth',
+    'Tasks waiting to be run',
+    ['type'])
+ACTIVE_UPLOADS = Gauge(
+    'ostree_upload_active_uploads',
+    'Uploads currently being received')
+TASK_REGISTRY_SIZE = Gauge(
+    'ostree_upload_task_registry_size',
+    'Tasks and finished task records kept in memory')
+RECEIVED_BYTES = Counter(
+    'ostree_upload_received_bytes_total',
+    'Bytes of uploaded bundles received')
+IMPORT_PHASE_SECONDS = Histogram(
+    'ostree_upload_import_phase_seconds',
+    'Time spent in each phase of importing uploads',
+    ['phase'])
+REPO_LOCK_WAIT_SECONDS = Histogram(
+    'ostree_upload_repo_lock_wait_seconds',
+    'Time spent waiting to lock a repo',
+    ['mode'])
+PUSH_SECONDS = Histogram(
+    'ostree_upload_push_seconds',
+    'Time spent pushing bundles to remotes',
+    ['adapter', 'remote', 'result'])
@@ -1,10 +1,24 @@
 from abc import ABCMeta, abstractmethod
 
 
+class BundleRequired(Exception):
+    """Raised by push_ref when the ref has to be pushed as a bundle"""
+    pass
+
+
 class BasePushAdapter(metaclass=ABCMeta):
+    # Adapters that send a repo's objects themselves rather than a
+    # bundle of the ref set this to False and implement push_ref. It can
+    # raise BundleRequired to be given a bundle after all.
+    needs_bundle = True
+
     def __init__(self, name):
         self._name = name
 
+    @property
+    def remote_name(self):
+        return self._name
+
     def __str__(self):
         return 'PushAdapter({0})'.format(self._name)
 
@@ -12,3 +26,7 @@ class BasePushAdapter(metaclass=ABCMeta):
     def push(self, bundle):
         raise NotImplementedError(
             'Cannot invoke BasePushAdapter.push() method!')
+
+    def push_ref(self, repo_path, ref):
+        raise NotImplementedError(
+            'Cannot invoke BasePushAdapter.push_ref() method!')
@@ -1,36 +1,173 @@
 import logging
 import os.path
 
+from configparser import ConfigParser
+from time import sleep
+
 import requests
+from requests.adapters import HTTPAdapter
 from requests_toolbelt.multipart import MultipartEncoder
 
-from ostree_upload_server.push_adapter.base import BasePushAdapter
+from ostree_upload_server.delta_bundle import (
+    DeltaNotBundleable, open_delta_bundle
+)
+from ostree_upload_server.push_adapter.base import (
+    BasePushAdapter, BundleRequired
+)
+
+
+class _BlockSizeHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter sending request bodies in blocks of blocksize bytes"""
+    def __init__(self, blocksize, **kwargs):
+        self._blocksize = blocksize
+        super(_BlockSizeHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['blocksize'] = self._blocksize
+        super(_BlockSizeHTTPAdapter, self).init_poolmanager(*args, **kwargs)
 
 
 class HttpPushAdapter(BasePushAdapter):
+    """Push bundles to a remote over HTTP
+
+    By default the bundle is POSTed as the file field of a multipart
+    form. With method set to put it's instead sent as the raw body of a
+    PUT with the filename in the query, as another ostree-upload-server
+    accepts on /upload, which skips multipart encoding on both ends. If
+    repo is set, it's passed along to select the remote's repo.
+
+    With stream_bundle set, the bundle isn't built as a file first.
+    It's generated from the repo's static delta of the commit as the
+    request body is sent, see DeltaBundle. If the delta can't be sent
+    as a bundle, the push falls back to a bundle file.
+
+    The bundle is read and sent in blocks of upload_chunk_size bytes
+    as the request body is written, rather than the 16 KiB blocks
+    urllib3 uses by default, so a multi-GB bundle isn't passed through
+    hundreds of thousands of reads and writes.
+
+    Connections are kept alive between pushes. Uploads that fail with a
+    connection error or a 5xx response are retried up to retries times,
+    waiting retry_backoff seconds and doubling that after each attempt.
+    The receiving server discards uploads of a commit it's already
+    importing, so sending a bundle again is safe.
+    """
     name = "http"
 
+    DEFAULT_RETRIES = 3
+    DEFAULT_RETRY_BACKOFF = 1
+    DEFAULT_TIMEOUT = 300
+    DEFAULT_POOL_SIZE = 4
+    DEFAULT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+    METHODS = ('post', 'put')
+
     def __init__(self, name, settings):
         super(HttpPushAdapter, self).__init__(name)
 
         self._url = settings.get('url')
+        self._repo = settings.get('repo')
+        self._method = settings.get('method', 'post').lower()
+        if self._method not in HttpPushAdapter.METHODS:
+            raise ValueError('Adapter {}: unknown method {}'.format(
+                name, self._method))
+        self._retries = int(settings.get('retries',
+                                         HttpPushAdapter.DEFAULT_RETRIES))
+        self._retry_backoff = float(settings.get(
+            'retry_backoff', HttpPushAdapter.DEFAULT_RETRY_BACKOFF))
+        self._timeout = float(settings.get('timeout',
+                                           HttpPushAdapter.DEFAULT_TIMEOUT))
+
+        stream_bundle = settings.get('stream_bundle', 'false').lower()
+        if stream_bundle not in ConfigParser.BOOLEAN_STATES:
+            raise ValueError('Adapter {}: invalid stream_bundle {}'.format(
+                name, stream_bundle))
+        if ConfigParser.BOOLEAN_STATES[stream_bundle]:
+            self.needs_bundle = False
+
+        self._session = requests.Session()
         username = settings.get('username')
         password = settings.get('password')
-
         if username and password:
-            self._auth = requests.auth.HTTPBasicAuth(username, password)
-        else:
-            self._auth = None
+            self._session.auth = requests.auth.HTTPBasicAuth(username,
+                                                             password)
+
+        # Pushes to the remote from several tasks share the pool
+        pool_size = int(settings.get('pool_size',
+                                     HttpPushAdapter.DEFAULT_POOL_SIZE))
+        upload_chunk_size = int(settings.get(
+            'upload_chunk_size', HttpPushAdapter.DEFAULT_UPLOAD_CHUNK_SIZE))
+        adapter = _BlockSizeHTTPAdapter(upload_chunk_size,
+                                        pool_connections=1,
+                                        pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
     def push(self, bundle):
         logging.debug("Http push {0} to {1}".format(bundle, self._url))
+        return self._push_body(os.path.basename(bundle),
+                               lambda: open(bundle, 'rb'))
+
+    def push_ref(self, repo_path, ref):
+        logging.debug("Http push {0} from {1} to {2}".format(
+            ref, repo_path, self._url))
+
+        try:
+            bundle = open_delta_bundle(repo_path, ref)
+        except DeltaNotBundleable as err:
+            raise BundleRequired(str(err)) from err
+        with bundle:
+            return self._push_body(bundle.name, bundle.open)
+
+    def _push_body(self, filename, open_body):
+        """Send the body returned by open_body, retrying on errors
+
+        open_body is called for each attempt since sending consumes
+        the body.
+        """
+        backoff = self._retry_backoff
+        for attempt in range(self._retries + 1):
+            if attempt > 0:
+                logging.info("Retrying http push of {0} to {1} in {2}s"
+                             .format(filename, self._url, backoff))
+                sleep(backoff)
+                backoff *= 2
+
+            try:
+                with open_body() as body:
+                    r = self._send(filename, body)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                logging.warning("Http push {0} to {1} failed: {2}".format(
+                    filename, self._url, err))
+                continue
+
+            logging.debug("Http push {0} response: {1}".format(filename,
+                                                               r.text))
+            if r.status_code < 500:
+                return r.status_code == requests.codes.ok
+
+            logging.warning("Http push {0} to {1} failed: HTTP {2}".format(
+                filename, self._url, r.status_code))
+
+        return False
+
+    def _send(self, filename, body):
+        if self._method == 'put':
+            params = {'filename': filename}
+            if self._repo:
+                params['repo'] = self._repo
+            return self._session.put(
+                self._url,
+                params=params,
+                data=body,
+                headers={'Content-Type': 'application/octet-stream'},
+                timeout=self._timeout)
 
-        encoder = MultipartEncoder({'file': (os.path.basename(bundle),
-                                             open(bundle, 'rb'),
-                                             'application/octet-stream')})
-        r = requests.post(self._url,
-                          data=encoder,
-                          auth=self._auth,
-                          headers={'Content-Type': encoder.content_type})
-        logging.debug("Http push {0} response: {1}".format(bundle, r.text))
-        return r.status_code == requests.codes.ok
+        fields = {'file': (filename, body, 'application/octet-stream')}
+        if self._repo:
+            fields['repo'] = self._repo
+        encoder = MultipartEncoder(fields)
+        return self._session.post(
+            self._url,
+            data=encoder,
+            headers={'Content-Type': encoder.content_type},
+            timeout=self._timeout)
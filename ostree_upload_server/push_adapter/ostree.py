@@ -0,0 +1,177 @@
+import logging
+import os
+import tarfile
+import tempfile
+
+from io import BytesIO
+from urllib.parse import urljoin
+
+import gi
+import requests
+
+from ostree_upload_server.importers.util import (
+    checkout_repository, find_new_objects, get_ref_commits
+)
+from ostree_upload_server.push_adapter.http import HttpPushAdapter
+from ostree_upload_server.repolock import RepoLock
+
+gi.require_version('OSTree', '1.0')
+from gi.repository import OSTree  # noqa: E402
+
+# Directories of a repo, which are needed to open the archive's repo
+# when the receiving server extracts it rather than streaming it
+ARCHIVE_REPO_DIRS = ['extensions', 'objects', 'refs', 'refs/heads',
+                     'refs/mirrors', 'refs/remotes', 'state', 'tmp']
+ARCHIVE_REPO_CONFIG = b'[core]\nrepo_version=1\nmode=archive-z2\n'
+
+
+def _add_bytes(tar_archive, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar_archive.addfile(info, BytesIO(data))
+
+
+def write_objects_tar(repo, repo_path, ref, commit, objects, tar_file):
+    """Write a tar of a repo holding objects with ref pointing to commit
+
+    This is the layout TarImporter imports. The commit's detached
+    metadata is included since it holds its GPG signatures. Objects are
+    added from the repo's object files as they are, so the repo has to
+    be in archive mode like the archive's repo.
+    """
+    if repo.get_mode() != OSTree.RepoMode.ARCHIVE_Z2:
+        raise RuntimeError('Pushing objects requires an archive mode repo')
+
+    with tarfile.open(fileobj=tar_file, mode='w') as tar_archive:
+        for dir_name in ARCHIVE_REPO_DIRS:
+            info = tarfile.TarInfo(dir_name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar_archive.addfile(info)
+        _add_bytes(tar_archive, 'config', ARCHIVE_REPO_CONFIG)
+        _add_bytes(tar_archive, 'refs/heads/' + ref,
+                   '{}\n'.format(commit).encode('ascii'))
+
+        commitmeta_name = OSTree.get_relative_object_path(
+            commit, OSTree.ObjectType.COMMIT_META, True)
+        if os.path.exists(os.path.join(repo_path, commitmeta_name)):
+            tar_archive.add(os.path.join(repo_path, commitmeta_name),
+                            arcname=commitmeta_name)
+
+        for objtype, checksum in objects:
+            object_name = OSTree.get_relative_object_path(checksum, objtype,
+                                                          True)
+            tar_archive.add(os.path.join(repo_path, object_name),
+                            arcname=object_name)
+
+
+class OstreePushAdapter(HttpPushAdapter):
+    """Push the objects of a ref that a remote doesn't have
+
+    The remote is asked which commit it has for the ref first. Servers
+    importing uploads make their own copy of each commit, so the /refs
+    endpoint of the remote ostree-upload-server also reports the commit
+    it was copied from. If that's in the local repo, only the objects
+    added since are sent, as a repo tar uploaded like a bundle with the
+    http adapter's put method. Otherwise all of the commit's objects
+    are sent.
+
+    With path set instead of url, the objects are written directly to
+    the repo there, which is useful for testing.
+    """
+    name = "ostree"
+
+    needs_bundle = False
+
+    def __init__(self, name, settings):
+        # Repo tars are sent as the raw body of a PUT
+        super(OstreePushAdapter, self).__init__(
+            name, dict(settings, method='put'))
+
+        self._path = settings.get('path')
+        if self._path is None and not (self._url and self._repo):
+            raise ValueError('Adapter {}: url and repo or path required'
+                             .format(name))
+
+    def push_ref(self, repo_path, ref):
+        logging.debug("Ostree push {0} from {1} to {2}".format(
+            ref, repo_path, self._path or self._url))
+
+        remote_commits = self._get_remote_commits(ref)
+        logging.debug("Remote commits for {0}: {1}".format(
+            ref, remote_commits))
+
+        with tempfile.NamedTemporaryFile(prefix='ostree-push-',
+                                         suffix='.tar') as tar_file:
+            with RepoLock(repo_path), \
+                    checkout_repository(repo_path) as repo:
+                _, commit = repo.resolve_rev(ref, True)
+                if commit is None:
+                    raise RuntimeError('Ref {} not found in {}'.format(
+                        ref, repo_path))
+                if commit in remote_commits:
+                    logging.info("{0} already has {1} at {2}".format(
+                        self, ref, commit))
+                    return True
+
+                # The remote's commit may have been pruned here or come
+                # from elsewhere
+                base_commit = next(
+                    (remote_commit for remote_commit in remote_commits
+                     if repo.has_object(OSTree.ObjectType.COMMIT,
+                                        remote_commit, None)[1]),
+                    None)
+                objects = find_new_objects(repo, commit, base_commit)
+                logging.info("Pushing {0} objects of {1} at {2} from base "
+                             "{3}".format(len(objects), ref, commit,
+                                          base_commit))
+
+                if self._path is not None:
+                    self._write_objects(repo, ref, commit, objects)
+                    return True
+
+                write_objects_tar(repo, repo_path, ref, commit, objects,
+                                  tar_file)
+
+            tar_file.flush()
+            return self.push(tar_file.name)
+
+    def _get_remote_commits(self, ref):
+        """Return the commits the remote has for ref, best base first"""
+        if self._path is not None:
+            commit, from_commit = get_ref_commits(self._path, ref)
+        else:
+            r = self._session.get(urljoin(self._url, 'refs'),
+                                  params={'ref': ref, 'repo': self._repo},
+                                  timeout=self._timeout)
+            # Servers without the ref, or without /refs, get everything
+            if r.status_code == requests.codes.not_found:
+                return []
+            r.raise_for_status()
+            response = r.json()
+            commit = response.get('commit')
+            from_commit = response.get('from_commit')
+
+        return [remote_commit for remote_commit in (from_commit, commit)
+                if remote_commit]
+
+    def _write_objects(self, repo, ref, commit, objects):
+        with RepoLock(self._path, exclusive=True), \
+                checkout_repository(self._path) as target_repo:
+            target_repo.prepare_transaction(None)
+            try:
+                for objtype, checksum in objects:
+                    target_repo.import_object_from(repo, objtype, checksum,
+                                                   None)
+
+                _, detached_metadata = repo.read_commit_detached_metadata(
+                    commit, None)
+                if detached_metadata is not None:
+                    target_repo.write_commit_detached_metadata(
+                        commit, detached_metadata, None)
+
+                target_repo.transaction_set_ref(None, ref, commit)
+                target_repo.commit_transaction(None)
+            except:  # noqa: E722
+                target_repo.abort_transaction(None)
+                raise
@@ -23,8 +23,21 @@ import logging
 import os
 import time
 
+from collections import deque
+
+from gevent import get_hub, sleep
+from gevent.event import Event
+from gevent.monkey import get_original
+
+from ostree_upload_server.metrics import REPO_LOCK_WAIT_SECONDS
+
 logger = logging.getLogger(__name__)
 
+# Locks are taken from both greenlets and native threads, so the shared
+# state is protected by a real lock even if threading has been monkey
+# patched by gevent
+_allocate_lock = get_original('_thread', 'allocate_lock')
+
 
 class EosOSTreeError(Exception):
     """Errors from the eosostree module"""
@@ -35,7 +48,78 @@ class EosOSTreeError(Exception):
         return str(self.msg)
 
 
+class _LockWaiter(object):
+    """A queued request for a RepoLock
+
+    The waiter can be woken from any thread. The wakeup is handed to
+    the event loop of the thread that's waiting, so waiting greenlets
+    only block themselves.
+    """
+    def __init__(self, exclusive):
+        self.exclusive = exclusive
+        self.granted = False
+        self._event = Event()
+        self._loop = get_hub().loop
+
+    def wake(self):
+        self.granted = True
+        self._loop.run_callback_threadsafe(self._event.set)
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+class _LockState(object):
+    """Holders and waiters of the locks for a repo in this process
+
+    Waiters are granted the lock in the order they asked for it. A
+    queued exclusive waiter holds back shared waiters that came after
+    it, so a steady stream of shared locks can't starve it.
+    """
+    def __init__(self):
+        self.shared_holders = 0
+        self.exclusive_held = False
+        self.waiters = deque()
+
+    def is_idle(self):
+        return not (self.shared_holders or self.exclusive_held or
+                    self.waiters)
+
+    def grant(self):
+        """Wake the waiters at the head of the queue that can proceed"""
+        while self.waiters:
+            waiter = self.waiters[0]
+            if waiter.exclusive:
+                if self.shared_holders or self.exclusive_held:
+                    break
+                self.exclusive_held = True
+            else:
+                if self.exclusive_held:
+                    break
+                self.shared_holders += 1
+
+            self.waiters.popleft()
+            waiter.wake()
+
+    def release(self, exclusive):
+        if exclusive:
+            self.exclusive_held = False
+        else:
+            self.shared_holders -= 1
+        self.grant()
+
+
 class RepoLock(object):
+    """Shared or exclusive lock on a repository
+
+    The lock is a flock on a file in the repo, so it works between
+    processes. Within a process, requests are first queued fairly by
+    _LockState so that exclusive locks aren't starved, and only then is
+    the flock taken. Waiting for the flock polls with an increasing
+    interval. All waiting is cooperative, so locking from a greenlet
+    doesn't block the rest of the server. The time spent waiting is
+    recorded in the repo lock wait metrics.
+    """
     # Repo lock file name. This intentionally chosen to be different
     # than the name used in the upstream locking work ($repo/lock) so
     # that deadlocks aren't introduced when that's landed and deployed.
@@ -44,16 +128,30 @@ class RepoLock(object):
     # Wait 30 minutes until locking timeout by default.
     LOCK_TIMEOUT = 30 * 60
 
+    # Range of intervals between attempts to take the flock when
+    # another process holds it
+    MIN_POLL_INTERVAL = 0.01
+    MAX_POLL_INTERVAL = 1
+
+    # Map of lock file path to _LockState for locks in this process
+    _states = {}
+    _states_lock = _allocate_lock()
+
     def __init__(self, repo_path, exclusive=False, timeout=LOCK_TIMEOUT):
         self._repo_path = repo_path
         self._exclusive = exclusive
         self._timeout = timeout
         self._lock_file = None
+        self._state_key = None
 
     def __enter__(self):
         """Context manager for lock()"""
         self._open()
-        self._lock()
+        try:
+            self._lock()
+        except:  # noqa: E722
+            self._close()
+            raise
 
     def __exit__(self, *args):
         self._unlock()
@@ -82,39 +180,106 @@ class RepoLock(object):
         indefinitely.
         """
         lock_path = self._lock_file.name
-        logger.info('Locking file %s %s', lock_path,
-                    'exclusive' if self._exclusive else 'shared')
+        mode_name = 'exclusive' if self._exclusive else 'shared'
+        logger.info('Locking file %s %s', lock_path, mode_name)
+        start = time.monotonic()
+        deadline = None
+        if self._timeout is not None:
+            deadline = start + self._timeout
+
+        self._wait_in_process(lock_path, deadline)
+        try:
+            self._wait_for_flock(lock_path, deadline)
+        except:  # noqa: E722
+            self._release_in_process()
+            raise
+
+        REPO_LOCK_WAIT_SECONDS.observe(time.monotonic() - start,
+                                       mode=mode_name)
+
+    def _wait_in_process(self, lock_path, deadline):
+        """Wait for this process's earlier lock requests to be served"""
+        key = os.path.realpath(lock_path)
+        waiter = _LockWaiter(self._exclusive)
+        with RepoLock._states_lock:
+            state = RepoLock._states.setdefault(key, _LockState())
+            state.waiters.append(waiter)
+            state.grant()
+        self._state_key = key
+
+        try:
+            while not waiter.granted:
+                timeout = None
+                if deadline is not None:
+                    timeout = max(deadline - time.monotonic(), 0)
+                if waiter.wait(timeout):
+                    continue
+
+                # The lock may have been granted just as the wait timed
+                # out
+                if waiter.granted:
+                    break
+                raise EosOSTreeError('Could not lock', lock_path, 'in',
+                                     self._timeout, 'seconds')
+        except BaseException:
+            # Leave the queue on timeouts and when the greenlet is
+            # killed, or the lock would be granted to nobody and never
+            # released
+            with RepoLock._states_lock:
+                if waiter.granted:
+                    state.release(self._exclusive)
+                else:
+                    state.waiters.remove(waiter)
+                    state.grant()
+                if state.is_idle():
+                    del RepoLock._states[key]
+            self._state_key = None
+            raise
+
+    def _release_in_process(self):
+        if self._state_key is None:
+            return
+
+        with RepoLock._states_lock:
+            state = RepoLock._states[self._state_key]
+            state.release(self._exclusive)
+            if state.is_idle():
+                del RepoLock._states[self._state_key]
+        self._state_key = None
+
+    def _wait_for_flock(self, lock_path, deadline):
+        """Take the flock, waiting for other processes to release it"""
         mode = fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH
         lock_fd = self._lock_file.fileno()
-        if self._timeout is None:
-            # Full blocking lock
-            fcntl.flock(lock_fd, mode)
-        else:
-            # Try non-blocking lock and sleep until timeout exhausted
-            mode |= fcntl.LOCK_NB
-            wait = self._timeout
-            while True:
-                try:
-                    fcntl.flock(lock_fd, mode)
-                    break
-                except IOError as err:
-                    if err.errno != errno.EWOULDBLOCK:
-                        raise
-
-                # Fail if the timeout has been reached
-                if wait <= 0:
-                    raise EosOSTreeError('Could not lock', lock_path,
-                                         'in', self._timeout, 'seconds')
-
-                # Try again in 1 second
-                if wait % 30 == 0:
-                    logger.debug('Could not acquire lock %s, %d second%s '
-                                 'until timeout', lock_path, wait,
-                                 's' if wait > 1 else '')
-                wait -= 1
-                time.sleep(1)
+        interval = RepoLock.MIN_POLL_INTERVAL
+        next_log = time.monotonic() + 30
+        while True:
+            try:
+                fcntl.flock(lock_fd, mode | fcntl.LOCK_NB)
+                return
+            except IOError as err:
+                if err.errno != errno.EWOULDBLOCK:
+                    raise
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise EosOSTreeError('Could not lock', lock_path, 'in',
+                                     self._timeout, 'seconds')
+            if now >= next_log:
+                logger.debug('Could not acquire lock %s held by another '
+                             'process, still waiting', lock_path)
+                next_log = now + 30
+
+            delay = interval
+            if deadline is not None:
+                delay = min(delay, deadline - now)
+            sleep(delay)
+            interval = min(interval * 2, RepoLock.MAX_POLL_INTERVAL)
 
     def _unlock(self):
         """Remove the repository flock"""
         logger.info('Unlocking file %s', self._lock_file.name)
-        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._release_in_process()
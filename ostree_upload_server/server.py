@@ -9,59 +9,200 @@ import shutil
 import signal
 import tempfile
 
+from collections import OrderedDict
 from configparser import ConfigParser
 from time import time
 
+from gevent import get_hub
 from gevent import signal as gsignal
 from gevent import sleep as gsleep
-from gevent import subprocess
+from gevent.pool import Group
 from gevent.pywsgi import WSGIServer
+from gevent.queue import Empty, Queue
 
-from flask import Flask, json, jsonify, request, Response, url_for
+from flask import (
+    current_app, Flask, json, jsonify, request, Request, Response, url_for
+)
 
 from ostree_upload_server.authenticator import Authenticator
+from ostree_upload_server.bundle_cache import BundleCache
+from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.delta_generator import DeltaGenerator
+from ostree_upload_server.import_executor import ImportExecutor
+from ostree_upload_server.importers.base import InvalidBundle
+from ostree_upload_server.importers.util import (
+    get_ref_commits, invalidate_repository, perform_repo_maintenance
+)
+from ostree_upload_server import metrics
+from ostree_upload_server.metadata_updater import MetadataUpdater
 from ostree_upload_server.push_adapter.dummy import DummyPushAdapter
 from ostree_upload_server.push_adapter.http import HttpPushAdapter
+from ostree_upload_server.push_adapter.ostree import OstreePushAdapter
 from ostree_upload_server.push_adapter.scp import ScpPushAdapter
 from ostree_upload_server.repolock import RepoLock
 from ostree_upload_server.task.push import PushTask
-from ostree_upload_server.task.receive import ReceiveTask
+from ostree_upload_server.task.receive import BatchReceiveTask, ReceiveTask
+from ostree_upload_server.task.state import TaskState
 from ostree_upload_server.task_queue import TaskQueue
+from ostree_upload_server.task_registry import TaskRegistry
+from ostree_upload_server.task_store import TaskStore
 from ostree_upload_server.threadsafe_counter import ThreadsafeCounter
+from ostree_upload_server.upload_deduplicator import UploadDeduplicator
 from ostree_upload_server.worker_pool_executor import WorkerPoolExecutor
 
 
 DEFAULT_LISTEN_PORT = 5000
 MAINTENANCE_WAIT = 10
+DEFAULT_MAINTENANCE_CONCURRENCY = 1
+DEFAULT_UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-# Flask (really werzkeug) saves uploads with TemporaryFile, so they go
-# in tempfile.tempdir. Our uploads can be very large, so make that
-# /var/tmp in case /tmp is a tmpfs.
+# Longest time a status request may wait for a task state change
+MAX_TASK_WAIT = 300
+
+# Interval between comments sent on idle event streams so proxies
+# don't close them
+EVENT_KEEPALIVE_INTERVAL = 15
+
+# Anything werkzeug spools to disk other than uploaded files (see
+# UploadRequest) goes in tempfile.tempdir. Requests can be very large,
+# so make that /var/tmp in case /tmp is a tmpfs.
 tempfile.tempdir = '/var/tmp'
 
 global latest_task_complete
 
 
+def maintain_repo(repo_path, gpg_homedir, sign_key, generate_deltas):
+    """Perform repo maintenance with an exclusive lock
+
+    This blocks until complete, so it should be run in a thread.
+    """
+    with RepoLock(repo_path, exclusive=True):
+        try:
+            return perform_repo_maintenance(repo_path, gpg_homedir,
+                                            sign_key, generate_deltas)
+        finally:
+            # Pruning and regenerating the metadata happen behind the
+            # back of any open repo handles
+            invalidate_repository(repo_path)
+
+
+def check_upload(path):
+    """Check an uploaded bundle with BundleImporter.check_bundle
+
+    Returns the (ref, commit) tuple or None and the InvalidBundle error
+    if the bundle is invalid. This is run in a thread, where raising
+    would make gevent report the error a second time.
+    """
+    try:
+        return BundleImporter.check_bundle(path), None
+    except InvalidBundle as err:
+        return None, err
+
+
+class UploadRequest(Request):
+    """Request that streams uploaded files into the upload directory
+
+    werkzeug normally spools uploaded files into an anonymous
+    TemporaryFile, which then has to be copied to a file the import
+    task can use. Instead, the multipart parser writes each file
+    directly to its final location so the body only hits the disk once.
+    Files that haven't been handed to a task when the request ends are
+    deleted.
+    """
+    def __init__(self, *args, **kwargs):
+        super(UploadRequest, self).__init__(*args, **kwargs)
+        self.upload_paths = []
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        upload_file = current_app.create_upload_file()
+        self.upload_paths.append(upload_file.name)
+        return upload_file
+
+
 class UploadWebApp(Flask):
+    request_class = UploadRequest
+
     def __init__(self, import_name, users, repos, upload_counter,
-                 remote_push_adapter_map, import_config, task_queue):
+                 remote_push_adapter_map, import_config, task_queue,
+                 import_executor, metadata_updater, delta_generator,
+                 upload_chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE,
+                 upload_dir=None,
+                 auth_cache_ttl=Authenticator.DEFAULT_CACHE_TTL,
+                 auth_cache_size=Authenticator.DEFAULT_CACHE_SIZE,
+                 upload_dedupe_ttl=UploadDeduplicator.DEFAULT_TTL,
+                 push_cache_dir=None,
+                 push_cache_size=BundleCache.DEFAULT_MAX_SIZE,
+                 push_groups=None,
+                 push_concurrency=PushTask.DEFAULT_CONCURRENCY):
         super(UploadWebApp, self).__init__(import_name)
-        self._authenticator = Authenticator(users)
+        self._authenticator = Authenticator(users, auth_cache_ttl,
+                                            auth_cache_size)
         self._repos = repos
         self._upload_counter = upload_counter
         self._remote_push_adapter_map = remote_push_adapter_map
         self._import_config = import_config
         self._task_queue = task_queue
+        self._import_executor = import_executor
+        self._metadata_updater = metadata_updater
+        self._delta_generator = delta_generator
+        self._upload_chunk_size = upload_chunk_size
+        self._push_groups = push_groups or {}
+        self._push_concurrency = push_concurrency
+        if upload_dedupe_ttl > 0:
+            self._upload_deduplicator = UploadDeduplicator(
+                task_queue, upload_dedupe_ttl)
+        else:
+            self._upload_deduplicator = None
 
         self.route("/")(self.__class__.index)
-        self.route("/upload", methods=["GET", "POST"])(self.upload)
+        self.route("/upload", methods=["GET", "POST", "PUT"])(self.upload)
         self.route("/push", methods=["GET", "PUT"])(self.push)
+        self.route("/refs")(self.refs)
+        self.route("/stats")(self.stats)
+        self.route("/metrics")(self.metrics)
+        self.route("/events")(self.events)
+        self.teardown_request(self._remove_unclaimed_uploads)
 
         # These files might be huge and /tmp might be mounted on tmpfs
-        # so to avoid RAM exhaustion, we use /var/tmp
-        self._tempdir = tempfile.mkdtemp(dir="/var/tmp",
-                                         prefix="ostree-upload-server-")
-        atexit.register(shutil.rmtree, self._tempdir)
+        # so to avoid RAM exhaustion, we use /var/tmp. A configured
+        # upload directory is kept so uploads survive restarts.
+        if upload_dir:
+            os.makedirs(upload_dir, exist_ok=True)
+            self._tempdir = upload_dir
+        else:
+            self._tempdir = tempfile.mkdtemp(dir="/var/tmp",
+                                             prefix="ostree-upload-server-")
+            atexit.register(shutil.rmtree, self._tempdir)
+
+        # Bundles built for pushes are kept in the upload directory by
+        # default. Only files in it are considered uploads.
+        if not push_cache_dir:
+            push_cache_dir = os.path.join(self._tempdir, 'push-cache')
+        self._bundle_cache = BundleCache(push_cache_dir, push_cache_size)
+
+    @property
+    def tempdir(self):
+        return self._tempdir
+
+    @property
+    def bundle_cache(self):
+        return self._bundle_cache
+
+    def create_upload_file(self):
+        """Create and open a new file for receiving an upload"""
+        (file_ptr, real_name) = tempfile.mkstemp(dir=self._tempdir)
+        os.close(file_ptr)
+        return open(real_name, 'w+b', buffering=self._upload_chunk_size)
+
+    @staticmethod
+    def _remove_unclaimed_uploads(exc):
+        for path in getattr(request, 'upload_paths', []):
+            logging.debug('Removing unclaimed upload %s', path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
     @staticmethod
     def request_authentication():
@@ -86,6 +227,16 @@ class UploadWebApp(Flask):
         except ValueError:
             return self.build_response(400, "Task argument must be integer")
 
+        # Parse the optional wait parameter
+        try:
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            return self.build_response(400, "Wait argument must be a number")
+        if wait < 0:
+            return self.build_response(400, "Wait argument must not be "
+                                            "negative")
+        wait = min(wait, MAX_TASK_WAIT)
+
         # Lookup the task ID
         task = self._task_queue.get_task(task_id)
 
@@ -93,20 +244,32 @@ class UploadWebApp(Flask):
             return self.build_response(
                 404, "Task {} does not exist".format(task_id))
 
-        if not isinstance(task, allowed_task):
+        # Finished tasks are compact records, so check the class they
+        # were created from
+        if not issubclass(task.task_class, allowed_task):
             err_message = "Task {} is not a {} task".format(task_id,
                                                             request.path)
             return self.build_response(400, err_message)
 
+        # Long poll for the next state change of an unfinished task
+        # rather than having the client poll repeatedly
+        if wait > 0 and not TaskState.is_finished(task.get_state()):
+            task.wait_for_state_change(wait)
+
         # Format the task state
-        state = task.get_state_name()
-        msg = 'Task {} state is {}'.format(task_id, state)
-        return self.build_response(200, msg, state=state)
+        status = task.get_status()
+        msg = 'Task {} state is {}'.format(task_id, status['state'])
+        return self.build_response(200, msg, **status)
 
     @staticmethod
     def index():
         links = "<a href='{0}'>upload</a>".format(url_for("upload"))
         links += "<br /><a href='{0}'>push</a>".format(url_for("push"))
+        links += "<br /><a href='{0}'>refs</a>".format(url_for("refs"))
+        links += "<br /><a href='{0}'>stats</a>".format(url_for("stats"))
+        links += "<br /><a href='{0}'>metrics</a>".format(
+            url_for("metrics"))
+        links += "<br /><a href='{0}'>events</a>".format(url_for("events"))
         return links
 
     def upload(self):
@@ -124,55 +287,197 @@ class UploadWebApp(Flask):
             logging.debug("/upload: POST request start")
 
             with self._upload_counter:
-                if 'file' not in request.files:
+                # Several files can be uploaded at once to import them
+                # together. The files are received while the form is
+                # parsed.
+                with metrics.IMPORT_PHASE_SECONDS.time(phase='save'):
+                    uploads = request.files.getlist('file')
+                if not uploads:
                     return cls.build_generic_error("No file in request")
 
-                upload = request.files['file']
-                if upload.filename == "":
+                if any(upload.filename == "" for upload in uploads):
                     return cls.build_generic_error("No filename in request")
 
                 repo_name = request.form.get('repo', None)
-                logging.info("Target repo: %s", repo_name)
-
-                if not repo_name:
-                    return cls.build_generic_error(
-                        "ERROR! 'repo' parameter not set!")
-
-                if repo_name not in self._repos:
-                    error_msg = ("ERROR! Target repo '{}' is invalid!"
-                                 .format(repo_name))
+                repo_path, error_msg = self._get_repo_path(repo_name)
+                if error_msg:
                     return cls.build_generic_error(error_msg)
 
-                repo_path = self._repos[repo_name]
+                # The multipart parser already wrote the files to their
+                # final location, so they only need to be flushed
+                for upload in uploads:
+                    metrics.RECEIVED_BYTES.inc(upload.stream.tell())
+                    upload.stream.close()
 
-                if not os.path.exists(repo_path):
-                    logging.warning("Directory %s not present. Creating it...",
-                                    repo_path)
-                    try:
-                        os.makedirs(repo_path)
-                    except OSError as err:
-                        if err.errno != errno.EEXIST:
-                            raise
+                if len(uploads) > 1:
+                    return self._queue_batch_upload(
+                        [(upload.filename, upload.stream.name)
+                         for upload in uploads],
+                        repo_path)
 
-                (file_ptr, real_name) = tempfile.mkstemp(dir=self._tempdir)
-                os.close(file_ptr)
-                upload.save(real_name)
+                return self._queue_upload(uploads[0].filename,
+                                          uploads[0].stream.name,
+                                          repo_path)
+        elif request.method == "PUT":
+            logging.debug("/upload: PUT request start")
 
-                task = ReceiveTask(upload.filename, real_name, repo_path,
-                                   self._import_config)
-                self._task_queue.add_task(task)
+            with self._upload_counter:
+                filename = request.args.get('filename', '')
+                if filename == "":
+                    return cls.build_generic_error("No filename in request")
 
-                logging.debug("/upload: POST request completed for %s",
-                              upload.filename)
+                # Check the repo before reading what might be a huge
+                # request body
+                repo_name = request.args.get('repo', None)
+                repo_path, error_msg = self._get_repo_path(repo_name)
+                if error_msg:
+                    return cls.build_generic_error(error_msg)
 
-                return cls.build_response(200, "Importing bundle",
-                                          task=task.get_id())
+                with self.create_upload_file() as upload_file, \
+                        metrics.IMPORT_PHASE_SECONDS.time(phase='save'):
+                    request.upload_paths.append(upload_file.name)
+                    while True:
+                        chunk = request.stream.read(self._upload_chunk_size)
+                        if not chunk:
+                            break
+                        upload_file.write(chunk)
+                        metrics.RECEIVED_BYTES.inc(len(chunk))
+
+                    if upload_file.tell() == 0:
+                        return cls.build_generic_error("No data in request")
+
+                return self._queue_upload(filename, upload_file.name,
+                                          repo_path)
         elif request.method == "GET":
             logging.debug("/upload: GET request %s", request.full_path)
             return self._get_request_task(ReceiveTask)
         else:
             return cls.build_generic_error(
-                "Only GET and POST methods supported")
+                "Only GET, POST and PUT methods supported")
+
+    def _get_repo_path(self, repo_name):
+        """Lookup the path of an upload's target repo
+
+        Returns a tuple of the repo path and an error message. The repo
+        directory is created if it doesn't exist.
+        """
+        logging.info("Target repo: %s", repo_name)
+
+        if not repo_name:
+            return None, "ERROR! 'repo' parameter not set!"
+
+        if repo_name not in self._repos:
+            return None, ("ERROR! Target repo '{}' is invalid!"
+                          .format(repo_name))
+
+        repo_path = self._repos[repo_name]
+
+        if not os.path.exists(repo_path):
+            logging.warning("Directory %s not present. Creating it...",
+                            repo_path)
+            try:
+                os.makedirs(repo_path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+        return repo_path, None
+
+    def _queue_upload(self, filename, real_name, repo_path):
+        """Hand a received upload to a new ReceiveTask
+
+        Normally the repo metadata update is coalesced with other
+        imports. Setting the sync_metadata parameter makes the task
+        update it before completing.
+
+        The bundle's headers are checked first so that invalid bundles
+        are rejected without taking a worker. If the same commit is
+        already being imported into the repo or was recently, the
+        upload is discarded and the existing task is returned.
+        """
+        # Reading the headers may touch much of the file, so keep it off
+        # the event loop
+        peeked, err = get_hub().threadpool.apply(check_upload, (real_name,))
+        if err is not None:
+            return self.build_generic_error(
+                "Invalid bundle {}: {}".format(filename, err))
+
+        if peeked is None or self._upload_deduplicator is None:
+            task = self._add_receive_task(filename, real_name, repo_path)
+        else:
+            # Adding the task yields, so keep concurrent uploads of the
+            # commit from missing it
+            _, commit = peeked
+            with self._upload_deduplicator.lock(repo_path, commit):
+                task = self._upload_deduplicator.find(repo_path, commit)
+                if task is not None:
+                    logging.info('Upload %s of commit %s duplicates task '
+                                 '%d', filename, commit, task.get_id())
+                    return self.build_response(200,
+                                               "Bundle already imported",
+                                               task=task.get_id(),
+                                               duplicate=True)
+
+                task = self._add_receive_task(filename, real_name,
+                                              repo_path)
+                self._upload_deduplicator.add(repo_path, commit, task)
+
+        # The task now owns the file
+        request.upload_paths.remove(real_name)
+
+        logging.debug("/upload: %s request completed for %s",
+                      request.method, filename)
+
+        return self.build_response(200, "Importing bundle",
+                                   task=task.get_id())
+
+    def _add_receive_task(self, filename, real_name, repo_path):
+        task = ReceiveTask(filename, real_name, repo_path,
+                           self._import_config,
+                           self._import_executor,
+                           self._metadata_updater,
+                           self._delta_generator,
+                           self._get_sync_metadata())
+        self._task_queue.add_task(task)
+        return task
+
+    def _queue_batch_upload(self, uploads, repo_path):
+        """Hand several received uploads to a new BatchReceiveTask
+
+        uploads is a list of (filename, path) pairs. All of the bundles
+        are checked first and the whole batch is rejected if any is
+        invalid.
+        """
+        for filename, real_name in uploads:
+            _, err = get_hub().threadpool.apply(check_upload, (real_name,))
+            if err is not None:
+                return self.build_generic_error(
+                    "Invalid bundle {}: {}".format(filename, err))
+
+        taskname = "batch of {} bundles".format(len(uploads))
+        task = BatchReceiveTask(taskname, uploads, repo_path,
+                                self._import_config,
+                                self._import_executor,
+                                self._metadata_updater,
+                                self._delta_generator,
+                                self._get_sync_metadata())
+        self._task_queue.add_task(task)
+
+        # The task now owns the files
+        for _, real_name in uploads:
+            request.upload_paths.remove(real_name)
+
+        logging.debug("/upload: %s request completed for %s",
+                      request.method, taskname)
+
+        return self.build_response(200,
+                                   "Importing {}".format(taskname),
+                                   task=task.get_id())
+
+    @staticmethod
+    def _get_sync_metadata():
+        sync_metadata = request.values.get('sync_metadata', '').lower()
+        return sync_metadata in ('1', 'yes', 'true', 'on')
 
     def push(self):
         """
@@ -186,24 +491,42 @@ class UploadWebApp(Flask):
 
         logging.debug(request.args)
         if request.method == 'PUT':
-            try:
-                ref = request.args['ref']
-                remote = request.args['remote']
-            except KeyError:
+            ref = request.args.get('ref')
+            remotes = request.args.getlist('remote')
+            if not ref or not remotes:
                 return cls.build_generic_error(
                     "ref and remote arguments required")
 
-            logging.debug("/push: %s to %s", ref, remote)
-            if remote not in self._remote_push_adapter_map:
+            repo_name = request.args.get('repo', None)
+            if not repo_name:
+                return cls.build_generic_error(
+                    "ERROR! 'repo' parameter not set!")
+            if repo_name not in self._repos:
                 return cls.build_generic_error(
-                    "Remote is not in the whitelist")
+                    "ERROR! Target repo '{}' is invalid!".format(repo_name))
+            repo_path = self._repos[repo_name]
+
+            # Several remotes or groups of remotes can be given to push
+            # to all of them in one task
+            remotes = [member for remote in remotes
+                       for member in self._push_groups.get(remote, [remote])]
+            remotes = list(OrderedDict.fromkeys(remotes))
+            logging.debug("/push: %s from %s to %s", ref, repo_path,
+                          ', '.join(remotes))
+            for remote in remotes:
+                if remote not in self._remote_push_adapter_map:
+                    return cls.build_generic_error(
+                        "Remote {} is not in the whitelist".format(remote))
 
-            adapter = self._remote_push_adapter_map[remote]
-            task = PushTask(ref, self._repo, ref, adapter, self._tempdir)
+            adapters = [self._remote_push_adapter_map[remote]
+                        for remote in remotes]
+            task = PushTask(ref, repo_path, ref, adapters,
+                            self._bundle_cache, self._push_concurrency)
             self._task_queue.add_task(task)
 
             return cls.build_response(200,
-                                      "Pushing {0} to {1}".format(ref, remote),
+                                      "Pushing {0} to {1}".format(
+                                          ref, ', '.join(remotes)),
                                       task=task.get_id())
 
         elif request.method == "GET":
@@ -213,6 +536,140 @@ class UploadWebApp(Flask):
             return cls.build_generic_error(
                 "Only GET and PUT methods supported")
 
+    def refs(self):
+        """
+        Report the commit a ref in a repo points to
+
+        from_commit is the commit that was uploaded to make it, which
+        ostree push adapters use to send only what's changed since.
+        """
+        cls = self.__class__
+
+        if not self._authenticator.authenticate(request):
+            return cls.request_authentication()
+
+        ref = request.args.get('ref')
+        if not ref:
+            return cls.build_generic_error("ref argument required")
+
+        repo_path, error_msg = self._get_repo_path(request.args.get('repo'))
+        if error_msg:
+            return cls.build_generic_error(error_msg)
+
+        # Opening the repo makes blocking libostree calls
+        commit, from_commit = get_hub().threadpool.apply(get_ref_commits,
+                                                         (repo_path, ref))
+        if commit is None:
+            return cls.build_response(404, "Ref {} not found".format(ref),
+                                      ref=ref)
+
+        return cls.build_response(200, "Ref {}".format(ref), ref=ref,
+                                  commit=commit, from_commit=from_commit)
+
+    def stats(self):
+        """
+        Report server statistics
+        """
+        if not self._authenticator.authenticate(request):
+            return self.request_authentication()
+
+        stats = self._task_queue.get_stats()
+        stats['active_uploads'] = self._upload_counter.count
+        return self.build_response(200, "Server statistics", **stats)
+
+    def metrics(self):
+        """
+        Report server metrics in the Prometheus text format
+        """
+        if not self._authenticator.authenticate(request):
+            return self.request_authentication()
+
+        # Gauges for the server's current state are sampled now
+        metrics.QUEUE_DEPTH.clear()
+        for task_type, depth in self._task_queue.get_queue_depths().items():
+            metrics.QUEUE_DEPTH.set(depth, type=task_type)
+        metrics.ACTIVE_UPLOADS.set(self._upload_counter.count)
+        metrics.TASK_REGISTRY_SIZE.set(
+            self._task_queue.get_stats()['registry_size'])
+
+        return Response(metrics.REGISTRY.render(),
+                        mimetype=metrics.CONTENT_TYPE)
+
+    def events(self):
+        """
+        Stream task state changes as server-sent events
+
+        Each task given with a task argument has its current status sent
+        immediately and again after every state change. The stream ends
+        once all of the tasks have finished.
+        """
+        if not self._authenticator.authenticate(request):
+            return self.request_authentication()
+
+        task_args = request.args.getlist('task')
+        if not task_args:
+            return self.build_response(400, "Task argument required")
+        try:
+            task_ids = [int(task_arg) for task_arg in task_args]
+        except ValueError:
+            return self.build_response(400, "Task argument must be integer")
+
+        tasks = []
+        for task_id in task_ids:
+            task = self._task_queue.get_task(task_id)
+            if task is None:
+                return self.build_response(
+                    404, "Task {} does not exist".format(task_id))
+            tasks.append(task)
+
+        return Response(self._task_event_stream(tasks),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    @staticmethod
+    def _format_task_event(task):
+        data = dict(task.get_status(), task=task.get_id())
+        return 'event: state\ndata: {}\n\n'.format(json.dumps(data))
+
+    @classmethod
+    def _task_event_stream(cls, tasks):
+        changes = Queue()
+        live_tasks = [task for task in tasks
+                      if not TaskState.is_finished(task.get_state())]
+
+        # Format the event when the state changes since the task may
+        # have moved on by the time the stream sends it
+        def listener(task):
+            finished = TaskState.is_finished(task.get_state())
+            changes.put((task.get_id(), finished,
+                         cls._format_task_event(task)))
+
+        # Subscribe before sending the current states so no change can
+        # be missed in between
+        for task in live_tasks:
+            task.add_state_listener(listener)
+        try:
+            for task in tasks:
+                yield cls._format_task_event(task)
+
+            pending = set(task.get_id() for task in live_tasks
+                          if not TaskState.is_finished(task.get_state()))
+            while pending:
+                try:
+                    task_id, finished, event = changes.get(
+                        timeout=EVENT_KEEPALIVE_INTERVAL)
+                except Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if task_id in pending:
+                    yield event
+                if finished:
+                    pending.discard(task_id)
+        finally:
+            for task in live_tasks:
+                task.remove_state_listener(listener)
+
     @staticmethod
     def build_generic_error(message):
         logging.error(message)
@@ -237,6 +694,7 @@ class OstreeUploadServer(object):
 
     ADAPTER_IMPL_CLASSES = [DummyPushAdapter,
                             HttpPushAdapter,
+                            OstreePushAdapter,
                             ScpPushAdapter]
 
     def __init__(self, port, num_workers, config_path=None):
@@ -253,21 +711,80 @@ class OstreeUploadServer(object):
         self._users = {}
         self._import_config = {}
         self._do_maintenance = True
+        self._import_executor_type = ImportExecutor.DEFAULT_EXECUTOR_TYPE
+        self._import_worker_count = num_workers
+        self._upload_chunk_size = DEFAULT_UPLOAD_CHUNK_SIZE
+        self._metadata_debounce = MetadataUpdater.DEFAULT_DEBOUNCE
+        self._metadata_max_staleness = MetadataUpdater.DEFAULT_MAX_STALENESS
+        self._maintenance_concurrency = DEFAULT_MAINTENANCE_CONCURRENCY
+        self._incremental_deltas = False
+        self._delta_delay = DeltaGenerator.DEFAULT_DELAY
+        self._task_registry_size = TaskRegistry.DEFAULT_MAX_TASKS
+        self._task_ttl = TaskRegistry.DEFAULT_TTL
+        self._task_store_path = None
+        self._upload_dir = None
+        self._auth_cache_ttl = Authenticator.DEFAULT_CACHE_TTL
+        self._auth_cache_size = Authenticator.DEFAULT_CACHE_SIZE
+        self._upload_dedupe_ttl = UploadDeduplicator.DEFAULT_TTL
+        self._push_cache_dir = None
+        self._push_cache_size = BundleCache.DEFAULT_MAX_SIZE
+        self._push_groups = {}
+        self._push_concurrency = PushTask.DEFAULT_CONCURRENCY
         self.parse_config()
 
-        self._last_task_complete = time()
-        self._last_maintenance_complete = time()
+        self._start_time = time()
+        self._last_task_complete = {}
+        self._last_maintenance_complete = {}
+        self._repos_in_maintenance = set()
+        self._maintenance_greenlets = Group()
         self._active_upload_counter = ThreadsafeCounter()
-        self._task_queue = TaskQueue()
+        if self._task_store_path:
+            self._task_store = TaskStore(self._task_store_path)
+            if not self._upload_dir:
+                logging.warning('No upload_dir configured, uploads will '
+                                'not be restored after restarting')
+        else:
+            self._task_store = None
+        self._task_queue = TaskQueue(self._task_registry_size,
+                                     self._task_ttl,
+                                     self._task_store,
+                                     (ReceiveTask, BatchReceiveTask,
+                                      PushTask))
         self._workers = WorkerPoolExecutor(self._task_completed_callback)
-        webapp = UploadWebApp(__name__,
-                              self._users,
-                              self._managed_repos,
-                              self._active_upload_counter,
-                              self._remote_push_adapter_map,
-                              self._import_config,
-                              self._task_queue)
-        self._http_server = WSGIServer(('', self._port), webapp)
+        self._import_executor = ImportExecutor(self._import_executor_type,
+                                               self._import_worker_count)
+        self._metadata_updater = MetadataUpdater(
+            self._import_executor,
+            self._import_config.get('gpg_homedir'),
+            self._import_config.get('sign_key'),
+            self._metadata_debounce,
+            self._metadata_max_staleness)
+        if self._incremental_deltas:
+            self._delta_generator = DeltaGenerator(self._import_executor,
+                                                   self._metadata_updater,
+                                                   self._delta_delay)
+        else:
+            self._delta_generator = None
+        self._webapp = UploadWebApp(__name__,
+                                    self._users,
+                                    self._managed_repos,
+                                    self._active_upload_counter,
+                                    self._remote_push_adapter_map,
+                                    self._import_config,
+                                    self._task_queue,
+                                    self._import_executor,
+                                    self._metadata_updater,
+                                    self._delta_generator,
+                                    self._upload_chunk_size,
+                                    self._upload_dir,
+                                    self._auth_cache_ttl,
+                                    self._auth_cache_size,
+                                    self._upload_dedupe_ttl,
+                                    self._push_cache_dir,
+                                    self._push_cache_size,
+                                    self._push_groups,
+                                    self._push_concurrency)
+        self._http_server = WSGIServer(('', self._port), self._webapp)
 
     def parse_config(self):
         config = ConfigParser(allow_no_value=True)
@@ -294,6 +811,14 @@ class OstreeUploadServer(object):
                 logging.error("Adapter %s: unknown type %s", remote_name,
                               adapter_type)
 
+        # Groups of remotes that can be pushed to by name
+        if config.has_section('push-groups'):
+            for group, members in config.items('push-groups'):
+                self._push_groups[group] = (members or '').replace(
+                    ',', ' ').split()
+                logging.debug("Push group %s: %s", group,
+                              ', '.join(self._push_groups[group]))
+
         # Enumerate all the allowed repos
         for section in config.sections():
             if not section.startswith('repo-'):
@@ -332,69 +857,216 @@ class OstreeUploadServer(object):
             logging.warning('No import configuration!')
 
         if config.has_section('server'):
-            self._do_maintenance = config.getboolean('server', 'maintenance')
+            self._do_maintenance = config.getboolean(
+                'server', 'maintenance', fallback=self._do_maintenance)
+            self._maintenance_concurrency = config.getint(
+                'server', 'maintenance_concurrency',
+                fallback=self._maintenance_concurrency)
+            self._incremental_deltas = config.getboolean(
+                'server', 'incremental_deltas',
+                fallback=self._incremental_deltas)
+            self._delta_delay = config.getfloat(
+                'server', 'delta_delay', fallback=self._delta_delay)
+            self._task_registry_size = config.getint(
+                'server', 'task_registry_size',
+                fallback=self._task_registry_size)
+            self._task_ttl = config.getfloat(
+                'server', 'task_ttl', fallback=self._task_ttl)
+            self._task_store_path = config.get(
+                'server', 'task_store', fallback=self._task_store_path)
+            self._upload_dir = config.get(
+                'server', 'upload_dir', fallback=self._upload_dir)
+            self._import_executor_type = config.get(
+                'server', 'import_executor',
+                fallback=self._import_executor_type)
+            self._import_worker_count = config.getint(
+                'server', 'import_workers',
+                fallback=self._import_worker_count)
+            self._upload_chunk_size = config.getint(
+                'server', 'upload_chunk_size',
+                fallback=self._upload_chunk_size)
+            self._metadata_debounce = config.getfloat(
+                'server', 'metadata_debounce',
+                fallback=self._metadata_debounce)
+            self._metadata_max_staleness = config.getfloat(
+                'server', 'metadata_max_staleness',
+                fallback=self._metadata_max_staleness)
+            self._auth_cache_ttl = config.getfloat(
+                'server', 'auth_cache_ttl', fallback=self._auth_cache_ttl)
+            self._auth_cache_size = config.getint(
+                'server', 'auth_cache_size',
+                fallback=self._auth_cache_size)
+            self._upload_dedupe_ttl = config.getfloat(
+                'server', 'upload_dedupe_ttl',
+                fallback=self._upload_dedupe_ttl)
+            self._push_cache_dir = config.get(
+                'server', 'push_cache_dir', fallback=self._push_cache_dir)
+            self._push_cache_size = config.getint(
+                'server', 'push_cache_size',
+                fallback=self._push_cache_size)
+            self._push_concurrency = config.getint(
+                'server', 'push_concurrency',
+                fallback=self._push_concurrency)
+
+        if self._import_executor_type not in ImportExecutor.EXECUTOR_TYPES:
+            raise Exception('Invalid import_executor {}, must be one of {}'
+                            .format(self._import_executor_type,
+                                    ', '.join(ImportExecutor.EXECUTOR_TYPES)))
 
     def perform_maintenance(self):
-        time_since_maintenance = time() - self._last_maintenance_complete
-        time_since_task = time() - self._last_task_complete
-        logging.debug("{:.1f} complete".format(time_since_task))
-
-        maintenance_msg_format = ("{:.1f} since last task, {:.1f}/{} since "
-                                  "last maintenance")
-        logging.debug(maintenance_msg_format.format(time_since_task,
-                                                    time_since_maintenance,
-                                                    MAINTENANCE_WAIT))
-        if time_since_maintenance > time_since_task:
-            # Uploads have been processed since last maintenance
-            logging.debug("Maintenance needed")
-            if time_since_task >= MAINTENANCE_WAIT:
-                logging.debug("Idle. Performing maintenance")
-                self._workers.stop()
-
-                repo_paths = list(self._managed_repos.values())
-                logging.info("Performing maintenance on repos: %s", repo_paths)
-                for active_repo in repo_paths:
-                    logging.info("Performing maintenance on %s", active_repo)
-
-                    if not os.path.isdir(active_repo):
-                        logging.warning(
-                            "Repo %s doesn't exist - skipping mainenance!",
-                            active_repo)
-                        continue
-
-                    # Run flatpak build-update-repo
-                    cmd = [
-                        "flatpak",
-                        "build-update-repo",
-                        "--generate-static-deltas",
-                        "--prune",
-                    ]
-                    gpg_homedir = self._import_config.get('gpg_homedir')
-                    sign_key = self._import_config.get('sign_key')
-                    if gpg_homedir:
-                        cmd.append('--gpg-homedir=' + gpg_homedir)
-                    if sign_key:
-                        cmd.append('--gpg-sign=' + sign_key)
-                    cmd.append(active_repo)
-
-                    with RepoLock(active_repo, exclusive=True):
-                        logging.debug('Executing %s', ' '.join(cmd))
-                        ret = subprocess.call(cmd)
-                        if ret == 0:
-                            logging.info("Completed maintenance on %s",
-                                         active_repo)
-                        else:
-                            logging.error(
-                                "Maintenance task failed on %s with code %d",
-                                active_repo, ret)
-
-                self._workers.start(self._task_queue, self._num_workers)
-
-                self._last_maintenance_complete = time()
-
-    def _task_completed_callback(self):
-        logging.debug("Task completed callback %s", self._last_task_complete)
-        self._last_task_complete = time()
+        """Start maintenance on repos that have gone idle after imports
+
+        Each repo is maintained in its own greenlet with only its own
+        tasks held back, so tasks for other repos continue to run.
+        """
+        maintenance_msg_format = ("{}: {:.1f} since last task, {:.1f}/{} "
+                                  "since last maintenance")
+        for repo_path, last_task_complete in \
+                sorted(self._last_task_complete.items()):
+            if repo_path in self._repos_in_maintenance:
+                continue
+
+            time_since_task = time() - last_task_complete
+            time_since_maintenance = time() - \
+                self._last_maintenance_complete.get(repo_path,
+                                                    self._start_time)
+            logging.debug(maintenance_msg_format.format(repo_path,
+                                                        time_since_task,
+                                                        time_since_maintenance,
+                                                        MAINTENANCE_WAIT))
+
+            # Skip repos without tasks processed since last maintenance
+            if time_since_maintenance <= time_since_task:
+                continue
+
+            logging.debug("Maintenance needed on %s", repo_path)
+            if (time_since_task < MAINTENANCE_WAIT or
+                    self._task_queue.is_repo_busy(repo_path)):
+                continue
+
+            if (len(self._repos_in_maintenance) >=
+                    self._maintenance_concurrency):
+                logging.debug("%d repos already in maintenance",
+                              len(self._repos_in_maintenance))
+                break
+
+            logging.debug("%s idle. Performing maintenance", repo_path)
+            self._repos_in_maintenance.add(repo_path)
+            self._maintenance_greenlets.spawn(self._maintain_repo, repo_path)
+
+    def _maintain_repo(self, repo_path):
+        try:
+            if not os.path.isdir(repo_path):
+                logging.warning("Repo %s doesn't exist - skipping mainenance!",
+                                repo_path)
+                return
+
+            # Hold back new tasks for this repo and let running ones
+            # finish so the exclusive lock can be taken right away
+            self._task_queue.pause_repo(repo_path)
+            self._task_queue.wait_repo_idle(repo_path)
+
+            # flatpak build-update-repo regenerates the metadata, so
+            # keep the metadata updater off the repo meanwhile. The
+            # maintenance command and lock block, so they run in a
+            # thread.
+            logging.info("Performing maintenance on %s", repo_path)
+            gpg_homedir = self._import_config.get('gpg_homedir')
+            sign_key = self._import_config.get('sign_key')
+            # Static deltas are generated after each import when
+            # incremental deltas are enabled
+            generate_deltas = not self._incremental_deltas
+            with self._metadata_updater.repo_lock(repo_path):
+                ret = get_hub().threadpool.apply(
+                    maintain_repo,
+                    (repo_path, gpg_homedir, sign_key, generate_deltas))
+            if ret == 0:
+                logging.info("Completed maintenance on %s", repo_path)
+            else:
+                logging.error("Maintenance task failed on %s with code %d",
+                              repo_path, ret)
+        finally:
+            self._task_queue.resume_repo(repo_path)
+            self._last_maintenance_complete[repo_path] = time()
+            self._repos_in_maintenance.discard(repo_path)
+
+    def _task_completed_callback(self, task):
+        repo_path = task.get_repo()
+        logging.debug("Task completed callback %s %s", repo_path,
+                      self._last_task_complete.get(repo_path))
+        self._last_task_complete[repo_path] = time()
+
+    def _restore_tasks(self):
+        """Requeue the unfinished tasks from the task store"""
+        if self._task_store is None:
+            return
+
+        restored_uploads = set()
+        for row in self._task_store.load_unfinished():
+            task = self._restore_task(row)
+            if task is None:
+                logging.warning("Cannot restore task %d, marking it failed",
+                                row['id'])
+                self._task_store.mark_failed(row['id'])
+                continue
+
+            logging.info("Restoring task %d", row['id'])
+            if isinstance(task, ReceiveTask):
+                restored_uploads.update(task.get_uploads())
+            task.set_id(row['id'])
+            self._task_queue.add_task(task)
+
+        # Remove uploads that no task will ever import
+        if self._upload_dir:
+            for entry in os.scandir(self._upload_dir):
+                if entry.is_file() and entry.path not in restored_uploads:
+                    logging.info("Removing orphaned upload %s", entry.path)
+                    os.unlink(entry.path)
+
+    def _restore_task(self, row):
+        """Recreate a task from a task store row
+
+        Returns None if the task can't be run anymore.
+        """
+        repo_path = row['repo']
+        if repo_path not in self._managed_repos.values():
+            return None
+
+        params = row['params']
+        if row['type'] == ReceiveTask.TASK_TYPE:
+            if not os.path.exists(params['upload']):
+                return None
+
+            return ReceiveTask(row['name'], params['upload'], repo_path,
+                               self._import_config,
+                               self._import_executor,
+                               self._metadata_updater,
+                               self._delta_generator,
+                               params['sync_metadata'])
+        elif row['type'] == BatchReceiveTask.TASK_TYPE:
+            if not all(os.path.exists(path)
+                       for _, path in params['uploads']):
+                return None
+
+            return BatchReceiveTask(row['name'], params['uploads'],
+                                    repo_path, self._import_config,
+                                    self._import_executor,
+                                    self._metadata_updater,
+                                    self._delta_generator,
+                                    params['sync_metadata'])
+        elif row['type'] == PushTask.TASK_TYPE:
+            # Push tasks used to have a single remote
+            remotes = params.get('remotes', [params.get('remote')])
+            adapters = [self._remote_push_adapter_map.get(remote)
+                        for remote in remotes]
+            if None in adapters:
+                return None
+
+            return PushTask(row['name'], repo_path, params['ref'], adapters,
+                            self._webapp.bundle_cache,
+                            self._push_concurrency)
+
+        return None
 
     @staticmethod
     def _sighandler(signum, frame):
@@ -405,6 +1077,13 @@ class OstreeUploadServer(object):
     def _start(self):
         logging.info("Starting server on %d...", self._port)
 
+        if self._task_store is not None:
+            self._task_store.start()
+        self._import_executor.start()
+        self._metadata_updater.start()
+        if self._delta_generator is not None:
+            self._delta_generator.start()
+        self._restore_tasks()
         self._workers.start(self._task_queue, self._num_workers)
         self._http_server.start()
 
@@ -414,7 +1093,14 @@ class OstreeUploadServer(object):
         logging.info("Cleaning up resources...")
 
         self._http_server.stop()
+        self._maintenance_greenlets.kill()
         self._workers.stop()
+        if self._delta_generator is not None:
+            self._delta_generator.stop()
+        self._metadata_updater.stop()
+        self._import_executor.stop()
+        if self._task_store is not None:
+            self._task_store.stop()
 
     def run(self):
         try:
@@ -426,8 +1112,10 @@ class OstreeUploadServer(object):
             # loop until interrupted
             while True:
                 gsleep(5)
-                self._task_queue.join()
-                logging.debug("Task queue empty, %s uploads ongoing",
+                stats = self._task_queue.get_stats()
+                logging.debug("%d tasks queued, %d tasks registered, %s "
+                              "uploads ongoing", stats['queued'],
+                              stats['registry_size'],
                               str(self._active_upload_counter.count))
 
                 # Continue looping if maintenance not desired
@@ -1,5 +1,6 @@
 from gevent import sleep as gsleep
 from abc import ABCMeta, abstractmethod
+from time import time
 
 from gevent.event import Event
 
@@ -7,18 +8,76 @@ from ostree_upload_server.task.state import TaskState
 
 
 class BaseTask(metaclass=ABCMeta):
-    _next_task_id = 0
+    # Name used to identify the type of the task in the task store
+    TASK_TYPE = None
 
-    def __init__(self, name):
+    def __init__(self, name, repo):
         self._name = name
+        self._repo = repo
         self._state = TaskState.PENDING
         self._state_change = Event()
+        self._state_listeners = []
 
-        self._task_id = BaseTask._next_task_id
-        BaseTask._next_task_id += 1
+        # Assigned when the task is queued
+        self._task_id = None
+
+        # List of phases the task has been through, each a dict with the
+        # phase name, start and end times and optionally a progress dict
+        self._phases = []
+        self.start_phase('queued')
+
+    def add_state_listener(self, callback):
+        """Call callback with the task after each state change"""
+        self._state_listeners.append(callback)
+
+    def remove_state_listener(self, callback):
+        self._state_listeners.remove(callback)
+
+    def wait_for_state_change(self, timeout=None):
+        """Wait until the task state changes
+
+        Returns True if the state changed before the timeout expired.
+        """
+        changed = Event()
+
+        def listener(task):
+            changed.set()
+
+        self.add_state_listener(listener)
+        try:
+            return changed.wait(timeout)
+        finally:
+            self.remove_state_listener(listener)
+
+    def start_phase(self, name):
+        """Record that the task has moved on to the named phase"""
+        now = time()
+        self._end_phase(now)
+        self._phases.append({'name': name, 'start': now, 'end': None})
+
+    def update_progress(self, **progress):
+        """Update the progress counters of the current phase"""
+        if self._phases:
+            phase = self._phases[-1]
+            phase['progress'] = dict(phase.get('progress', {}), **progress)
+
+    def report_progress(self, phase, progress):
+        """Callback for the progress reported by importers"""
+        if phase is not None:
+            self.start_phase(phase)
+        if progress:
+            self.update_progress(**progress)
+
+    def _end_phase(self, now):
+        if self._phases and self._phases[-1]['end'] is None:
+            self._phases[-1]['end'] = now
 
     def set_state(self, state):
         self._state = state
+        if TaskState.is_finished(state):
+            self._end_phase(time())
+        for callback in self._state_listeners:
+            callback(self)
         self._state_change.set()
 
         # Wake up anyone waiting
@@ -29,6 +88,9 @@ class BaseTask(metaclass=ABCMeta):
     def get_name(self):
         return self._name
 
+    def get_repo(self):
+        return self._repo
+
     def get_state(self):
         return self._state
 
@@ -38,6 +100,76 @@ class BaseTask(metaclass=ABCMeta):
     def get_id(self):
         return self._task_id
 
+    def set_id(self, task_id):
+        self._task_id = task_id
+
+    @property
+    def task_class(self):
+        return type(self)
+
+    def get_status(self):
+        """Return a dict describing the task for status requests"""
+        return {
+            'state': self.get_state_name(),
+            'phases': [dict(phase) for phase in self._phases],
+        }
+
+    def get_params(self):
+        """Return a JSON serializable dict for recreating the task
+
+        This is saved in the task store so that unfinished tasks can be
+        restarted.
+        """
+        return {}
+
     @abstractmethod
     def run(self):
         raise NotImplementedError('Cannot invoke BaseTask.run() method!')
+
+
+class TaskRecord:
+    """Compact record of a finished task
+
+    Finished tasks no longer need the state used to run them, so the
+    task registry replaces them with these to keep memory use low.
+    """
+    __slots__ = ('_task_id', '_name', '_repo', '_task_class', '_state',
+                 '_status', 'finished_time')
+
+    def __init__(self, task_id, name, repo, task_class, state, status,
+                 finished_time):
+        self._task_id = task_id
+        self._name = name
+        self._repo = repo
+        self._task_class = task_class
+        self._state = state
+        self._status = status
+        self.finished_time = finished_time
+
+    @classmethod
+    def from_task(cls, task):
+        return cls(task.get_id(), task.get_name(), task.get_repo(),
+                   task.task_class, task.get_state(), task.get_status(),
+                   time())
+
+    def get_name(self):
+        return self._name
+
+    def get_repo(self):
+        return self._repo
+
+    def get_state(self):
+        return self._state
+
+    def get_state_name(self):
+        return TaskState.name(self._state)
+
+    def get_id(self):
+        return self._task_id
+
+    @property
+    def task_class(self):
+        return self._task_class
+
+    def get_status(self):
+        return self._status
@@ -1,66 +1,139 @@
 import logging
-import os
-import tempfile
 
-from gevent.subprocess import check_output, CalledProcessError, STDOUT
+from contextlib import ExitStack
+from time import monotonic
 
-from ostree_upload_server.repolock import RepoLock
+from gevent import get_hub
+from gevent.pool import Pool
+
+from ostree_upload_server.metrics import PUSH_SECONDS
+from ostree_upload_server.push_adapter.base import BundleRequired
 from ostree_upload_server.task.base import BaseTask
 from ostree_upload_server.task.state import TaskState
 
 
+def _run_push(push, *args):
+    """Run an adapter's push method and return whether it succeeded
+
+    Returns the result and the exception raised, if any. This is run in
+    a thread, where raising would make gevent report the error a second
+    time.
+    """
+    try:
+        return push(*args), None
+    except Exception as err:
+        return False, err
+
+
 class PushTask(BaseTask):
-    def __init__(self, taskname, repo, ref, adapter, tempdir):
-        super(PushTask, self).__init__(taskname)
+    """Push a ref from a repo to one or more remotes
+
+    The bundle is built once and pushed to up to concurrency remotes at
+    a time. It's only built if one of the adapters needs it, as others
+    push the ref from the repo themselves. Adapters block, so each push
+    runs in the hub's threadpool. Adapters that push the ref themselves
+    can still ask for the bundle by raising BundleRequired, in which
+    case it's built then. The status reports the result of each
+    push in a remotes list. The task fails if the push to any of the
+    remotes failed.
+    """
+    TASK_TYPE = 'push'
+
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, taskname, repo, ref, adapters, bundle_cache,
+                 concurrency=DEFAULT_CONCURRENCY):
+        super(PushTask, self).__init__(taskname, repo)
 
-        self._repo = repo
         self._ref = ref
-        self._adapter = adapter
-        self._tempdir = tempdir
+        self._adapters = list(adapters)
+        self._bundle_cache = bundle_cache
+        self._concurrency = concurrency
+
+        pending = TaskState.name(TaskState.PENDING)
+        self._results = [{'remote': adapter.remote_name, 'state': pending}
+                         for adapter in self._adapters]
+
+    def get_params(self):
+        return {
+            'ref': self._ref,
+            'remotes': [adapter.remote_name for adapter in self._adapters],
+        }
+
+    def get_status(self):
+        status = super(PushTask, self).get_status()
+        status['remotes'] = self._results
+        return status
 
     def run(self):
         logging.info("Processing task {}".format(self.get_name()))
-        logging.debug("Push {0} to {1} ".format(self._ref, self._adapter))
+        logging.debug("Push {0} to {1}".format(
+            self._ref, ', '.join(map(str, self._adapters))))
+
+        try:
+            with ExitStack() as stack:
+                bundle = None
+                if any(adapter.needs_bundle for adapter in self._adapters):
+                    self.start_phase('build_bundle')
+                    bundle = stack.enter_context(
+                        self._bundle_cache.bundle(self._repo, self._ref))
 
-        bundle = self._rebuild_bundle()
-        if not bundle:
-            logging.error("Failed to extract {0}".format(self._ref))
+                self.start_phase('push')
+                pool = Pool(self._concurrency)
+                for adapter, result in zip(self._adapters, self._results):
+                    pool.spawn(self._push, adapter, result, bundle)
+                pool.join(raise_error=True)
+        except Exception as err:
+            logging.error("Failed to push {0}: {1}".format(self._ref, err))
+            for result in self._results:
+                if not TaskState.is_finished(
+                        getattr(TaskState, result['state'])):
+                    result.update(state=TaskState.name(TaskState.FAILED),
+                                  error=str(err))
             self.set_state(TaskState.FAILED)
             return
-        if not self._adapter.push(bundle):
-            logging.error("Failed to push {0} to {1}".format(bundle,
-                                                             self._adapter))
+
+        completed = TaskState.name(TaskState.COMPLETED)
+        if not all(result['state'] == completed for result in self._results):
             self.set_state(TaskState.FAILED)
-            return
 
-        os.unlink(bundle)
+            logging.error("Failed task %s", self.get_name())
+            return
 
         self.set_state(TaskState.COMPLETED)
 
         logging.info("Completed task %s", self.get_name())
 
-    def _rebuild_bundle(self):
-        (f, filename) = tempfile.mkstemp(dir=self._tempdir)
-        os.close(f)
-
-        with RepoLock(self._repo):
-            output = None
+    def _push(self, adapter, result, bundle):
+        result['state'] = TaskState.name(TaskState.PROCESSING)
+        start = monotonic()
+        if adapter.needs_bundle:
+            push_args = (adapter.push, bundle)
+        else:
+            push_args = (adapter.push_ref, self._repo, self._ref)
+        pushed, err = get_hub().threadpool.apply(_run_push, push_args)
+        if isinstance(err, BundleRequired):
+            logging.info("Pushing {0} to {1} as a bundle: {2}".format(
+                self._ref, adapter, err))
             try:
-                output = check_output(["flatpak",
-                                       "build-bundle",
-                                       self._repo,
-                                       filename,
-                                       self._ref],
-                                      stderr=STDOUT)
-                logging.info("Extracted {0} as {1}".format(self._ref,
-                                                           filename))
-                return filename
-            except CalledProcessError as e:
-                logging.info("Failed extraction {}".format(self.get_name()))
-
-                logging.error("Failed task {}\n{}".format(e, e.output))
-                os.unlink(filename)
-                return None
-            finally:
-                if output:
-                    logging.error("Task output: {}".format(output))
+                with self._bundle_cache.bundle(self._repo,
+                                               self._ref) as bundle:
+                    pushed, err = get_hub().threadpool.apply(
+                        _run_push, (adapter.push, bundle))
+            except Exception as bundle_err:
+                pushed, err = False, bundle_err
+        PUSH_SECONDS.observe(monotonic() - start,
+                             adapter=adapter.name,
+                             remote=adapter.remote_name,
+                             result='success' if pushed else 'failure')
+
+        if pushed:
+            logging.info("Pushed {0} to {1}".format(self._ref, adapter))
+            result['state'] = TaskState.name(TaskState.COMPLETED)
+            return
+
+        logging.error("Failed to push {0} to {1}{2}".format(
+            self._ref, adapter, ': {}'.format(err) if err else ''))
+        result['state'] = TaskState.name(TaskState.FAILED)
+        if err is not None:
+            result['error'] = str(err)
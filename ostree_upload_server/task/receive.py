@@ -8,33 +8,178 @@ from ostree_upload_server.task.state import TaskState
 
 
 class ReceiveTask(BaseTask):
-    def __init__(self, taskname, upload, repo, import_config):
-        super(ReceiveTask, self).__init__(taskname)
+    TASK_TYPE = 'receive'
+
+    def __init__(self, taskname, upload, repo, import_config, executor,
+                 metadata_updater, delta_generator=None,
+                 sync_metadata=False):
+        super(ReceiveTask, self).__init__(taskname, repo)
 
         self._upload = upload
-        self._repo = repo
         self._import_config = import_config
+        self._executor = executor
+        self._metadata_updater = metadata_updater
+        self._delta_generator = delta_generator
+        self._sync_metadata = sync_metadata
+        self._ref_updates = []
+
+    def get_params(self):
+        return {
+            'upload': self._upload,
+            'sync_metadata': self._sync_metadata,
+        }
+
+    def get_ref_updates(self):
+        """Return the RefUpdates made by the import"""
+        return self._ref_updates
+
+    def get_uploads(self):
+        """Return the paths of the uploaded files the task imports"""
+        return [self._upload]
+
+    def _import(self):
+        """Import the uploads and return the RefUpdates made"""
+        logging.info("Trying to import %s into %s", self._upload,
+                     self._repo)
+
+        # The import makes blocking libostree calls, so run it in the
+        # executor to keep the event loop responsive. The repo metadata
+        # is updated separately so that it can be coalesced with other
+        # imports. The importer reports its phases as it goes.
+        self.start_phase('import')
+        ref_update = self._executor.run_with_progress(
+            BundleImporter.import_bundle, self.report_progress,
+            self._upload, self._repo, update_metadata=False,
+            **self._import_config)
+        return [ref_update] if ref_update is not None else []
+
+    def _succeeded(self):
+        """Whether the task succeeded once the uploads were imported"""
+        return True
 
     def run(self):
         logging.info("Processing task %s", self.get_name())
 
         self.set_state(TaskState.PROCESSING)
 
+        self.start_phase('lock_wait')
         with RepoLock(self._repo):
             try:
-                logging.info("Trying to import %s into %s", self._upload,
-                             self._repo)
-                BundleImporter.import_bundle(self._upload, self._repo,
-                                             **self._import_config)
-                self.set_state(TaskState.COMPLETED)
-
-                logging.info("Completed task %s", self.get_name())
+                ref_updates = self._import()
             except Exception as err:
                 self.set_state(TaskState.FAILED)
 
                 logging.error("Failed task %s", err)
+                return
             finally:
                 # TODO: uploads are always deleted for now, but in the
                 # future it might want to be kept for inspection for
                 # failed tasks
-                os.unlink(self._upload)
+                for upload in self.get_uploads():
+                    os.unlink(upload)
+
+        for ref_update in ref_updates:
+            logging.info("Updated %s from %s to %s", ref_update.ref,
+                         ref_update.old_commit, ref_update.new_commit)
+            self._ref_updates.append(ref_update)
+
+            if self._delta_generator is not None:
+                self._delta_generator.add_ref_update(self._repo, ref_update)
+
+        # Only changed refs need the metadata updated. Do it outside of
+        # the import lock since the updater takes its own.
+        if ref_updates:
+            try:
+                if self._sync_metadata:
+                    self.start_phase('summary_update')
+                    self._metadata_updater.update_now(self._repo)
+                else:
+                    self._metadata_updater.mark_dirty(self._repo)
+            except Exception as err:
+                self.set_state(TaskState.FAILED)
+
+                logging.error("Failed task %s", err)
+                return
+
+        if not self._succeeded():
+            self.set_state(TaskState.FAILED)
+
+            logging.error("Failed task %s", self.get_name())
+            return
+
+        self.set_state(TaskState.COMPLETED)
+
+        logging.info("Completed task %s", self.get_name())
+
+
+class BatchReceiveTask(ReceiveTask):
+    """Import several uploads for a repo in one transaction
+
+    The status reports the result of each upload in a bundles list. The
+    task fails if any of the uploads couldn't be imported.
+    """
+    TASK_TYPE = 'batch-receive'
+
+    def __init__(self, taskname, uploads, repo, import_config, executor,
+                 metadata_updater, delta_generator=None,
+                 sync_metadata=False):
+        super(BatchReceiveTask, self).__init__(taskname, None, repo,
+                                               import_config, executor,
+                                               metadata_updater,
+                                               delta_generator,
+                                               sync_metadata)
+
+        # List of (filename, path) pairs
+        self._uploads = [tuple(upload) for upload in uploads]
+        pending = TaskState.name(TaskState.PENDING)
+        self._results = [{'filename': filename, 'state': pending}
+                         for filename, _ in self._uploads]
+
+    def get_params(self):
+        return {
+            'uploads': self._uploads,
+            'sync_metadata': self._sync_metadata,
+        }
+
+    def get_status(self):
+        status = super(BatchReceiveTask, self).get_status()
+        status['bundles'] = self._results
+        return status
+
+    def get_uploads(self):
+        return [path for _, path in self._uploads]
+
+    def _import(self):
+        logging.info("Trying to import %d uploads into %s",
+                     len(self._uploads), self._repo)
+
+        self.start_phase('import')
+        try:
+            results = self._executor.run_with_progress(
+                BundleImporter.import_bundles, self.report_progress,
+                self.get_uploads(), self._repo, update_metadata=False,
+                **self._import_config)
+        except Exception as err:
+            for result in self._results:
+                result.update(state=TaskState.name(TaskState.FAILED),
+                              error=str(err))
+            raise
+
+        ref_updates = []
+        for result, (ref_update, error) in zip(self._results, results):
+            if error is not None:
+                result.update(state=TaskState.name(TaskState.FAILED),
+                              error=error)
+                continue
+
+            result['state'] = TaskState.name(TaskState.COMPLETED)
+            if ref_update is not None:
+                result.update(ref=ref_update.ref,
+                              commit=ref_update.new_commit)
+                ref_updates.append(ref_update)
+
+        return ref_updates
+
+    def _succeeded(self):
+        completed = TaskState.name(TaskState.COMPLETED)
+        return all(result['state'] == completed for result in self._results)
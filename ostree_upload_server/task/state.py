@@ -11,6 +11,11 @@ class TaskState(object):
         """Return the name of the state"""
         return TaskState.TASK_STATES[state]
 
+    @staticmethod
+    def is_finished(state):
+        """Whether the state is final"""
+        return state in (TaskState.COMPLETED, TaskState.FAILED)
+
 
 # Dynamically enumerate all the options as consts on the class
 for index, task in enumerate(TaskState.TASK_STATES):
@@ -1,28 +1,177 @@
 import logging
 
+from collections import Counter, defaultdict
+
 from gevent import queue
+from gevent.event import Event
+
+from ostree_upload_server.task.base import TaskRecord
+from ostree_upload_server.task_registry import TaskRegistry
 
 
 class TaskQueue:
-    def __init__(self):
+    def __init__(self, max_tasks=TaskRegistry.DEFAULT_MAX_TASKS,
+                 task_ttl=TaskRegistry.DEFAULT_TTL, store=None,
+                 task_classes=()):
         self._queue = queue.JoinableQueue()
 
-        self._all_tasks = {}
+        self._all_tasks = TaskRegistry(max_tasks, task_ttl)
+        self._next_task_id = 0
+
+        # Optional TaskStore persisting tasks and the task classes that
+        # can be found in it
+        self._store = store
+        self._task_classes = {
+            task_class.TASK_TYPE: task_class for task_class in task_classes
+        }
+
+        # Tasks for paused repos are held back from the workers until
+        # the repo is resumed
+        self._paused_repos = set()
+        self._held_tasks = defaultdict(list)
+
+        # Number of queued or running tasks and number of running tasks
+        # per repo
+        self._repo_task_counts = Counter()
+        self._repo_running_counts = Counter()
+        self._repo_idle_events = {}
+
+        # Number of tasks waiting to run per task type
+        self._waiting_type_counts = Counter()
 
     def add_task(self, task):
+        # Restored tasks keep their ID
+        new_task = task.get_id() is None
+        if new_task:
+            task.set_id(self._allocate_task_id())
         task_id = task.get_id()
 
         logging.info('Adding task {}'.format(task_id))
 
-        self._all_tasks[task_id] = task
+        if self._store is not None:
+            self._store.save(task)
+
+            # The ID of a new task is handed out once this returns, so
+            # the task has to survive a restart by then
+            if new_task:
+                self._store.sync()
+            task.add_state_listener(self._store.save)
+
+        self._all_tasks.add(task)
+        self._repo_task_counts[task.get_repo()] += 1
+        self._waiting_type_counts[task.TASK_TYPE] += 1
 
         self._queue.put(task)
 
+    def get(self, timeout=None):
+        """Get the next task to run
+
+        Tasks for paused repos are set aside rather than returned.
+        """
+        while True:
+            task = self._queue.get(timeout=timeout)
+
+            repo = task.get_repo()
+            if repo not in self._paused_repos:
+                self._repo_running_counts[repo] += 1
+                self._waiting_type_counts[task.TASK_TYPE] -= 1
+                return task
+
+            logging.debug('Holding task %d while %s is paused',
+                          task.get_id(), repo)
+            self._held_tasks[repo].append(task)
+            self._queue.task_done()
+
+    def task_done(self, task):
+        """Mark a task returned from get() as finished"""
+        repo = task.get_repo()
+        self._repo_task_counts[repo] -= 1
+        self._repo_running_counts[repo] -= 1
+
+        if self._repo_running_counts[repo] == 0:
+            idle_event = self._repo_idle_events.pop(repo, None)
+            if idle_event is not None:
+                idle_event.set()
+
+        self._all_tasks.task_finished(task)
+        self._queue.task_done()
+
+    def pause_repo(self, repo):
+        """Stop handing out tasks for a repo"""
+        logging.info('Pausing tasks for %s', repo)
+        self._paused_repos.add(repo)
+
+    def resume_repo(self, repo):
+        """Requeue any tasks held while the repo was paused"""
+        logging.info('Resuming tasks for %s', repo)
+        self._paused_repos.discard(repo)
+
+        for task in self._held_tasks.pop(repo, []):
+            self._queue.put(task)
+
+    def wait_repo_idle(self, repo):
+        """Wait until no tasks for the repo are running"""
+        while self._repo_running_counts[repo] > 0:
+            idle_event = self._repo_idle_events.setdefault(repo, Event())
+            idle_event.wait()
+
+    def is_repo_busy(self, repo):
+        """Whether the repo has any queued, held or running tasks"""
+        return self._repo_task_counts[repo] > 0
+
     def get_task(self, task_id):
         if not isinstance(task_id, int):
             raise Exception('Task IDs must be integers')
 
-        return self._all_tasks.get(task_id)
+        task = self._all_tasks.get(task_id)
+        if task is None and self._store is not None:
+            task = self._load_task_record(task_id)
+
+        return task
+
+    def _allocate_task_id(self):
+        if self._store is not None:
+            return self._store.allocate_id()
+
+        task_id = self._next_task_id
+        self._next_task_id += 1
+        return task_id
+
+    def _load_task_record(self, task_id):
+        """Lookup a finished task that's no longer in the registry"""
+        row = self._store.load_status(task_id)
+        if row is None:
+            return None
+
+        task_class = self._task_classes.get(row['type'])
+        if task_class is None:
+            logging.warning('Task %d has unknown type %s', task_id,
+                            row['type'])
+            return None
+
+        # Keep the time the task finished so lookups don't extend how
+        # long the record is kept
+        record = TaskRecord(task_id, row['name'], row['repo'], task_class,
+                            row['state'], row['status'], row['updated'])
+        self._all_tasks.add_record(record)
+        return record
+
+    def get_stats(self):
+        registry_stats = self._all_tasks.get_stats()
+        return {
+            'queued': self._queue.qsize(),
+            'held': sum(map(len, self._held_tasks.values())),
+            'registry_size': len(self._all_tasks),
+            'registry_active': registry_stats['active'],
+            'registry_finished': registry_stats['finished'],
+        }
+
+    def get_queue_depths(self):
+        """Return the number of tasks waiting to run per task type
+
+        This includes tasks held back for paused repos.
+        """
+        return dict(self._waiting_type_counts)
 
     @property
     def queue(self):
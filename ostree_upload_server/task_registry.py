@@ -0,0 +1,93 @@
+import logging
+
+from collections import OrderedDict
+from time import time
+
+from ostree_upload_server.task.base import TaskRecord
+
+
+class TaskRegistry:
+    """Lookup of tasks by ID with a bounded size
+
+    Tasks are kept as is while they're pending or running. Once
+    finished, they're replaced with a compact TaskRecord that is kept
+    for at most ttl seconds. When the registry holds more than
+    max_tasks entries, the least recently used records are evicted.
+    Running tasks are never evicted.
+    """
+    DEFAULT_MAX_TASKS = 10000
+    DEFAULT_TTL = 24 * 60 * 60
+
+    def __init__(self, max_tasks=DEFAULT_MAX_TASKS, ttl=DEFAULT_TTL):
+        self._max_tasks = max_tasks
+        self._ttl = ttl
+
+        self._active_tasks = {}
+
+        # Finished task records in least recently used order and in
+        # finishing order for expiration
+        self._finished_lru = OrderedDict()
+        self._finished_expiry = OrderedDict()
+
+    def __len__(self):
+        return len(self._active_tasks) + len(self._finished_lru)
+
+    def add(self, task):
+        self._active_tasks[task.get_id()] = task
+        self._evict()
+
+    def add_record(self, record):
+        """Add a finished task record from elsewhere"""
+        # Records loaded from elsewhere may have expired already
+        if time() - record.finished_time > self._ttl:
+            return
+
+        task_id = record.get_id()
+        self._finished_lru[task_id] = record
+        self._finished_expiry[task_id] = record
+        self._evict()
+
+    def get(self, task_id):
+        task = self._active_tasks.get(task_id)
+        if task is not None:
+            return task
+
+        record = self._finished_lru.get(task_id)
+        if record is None:
+            return None
+
+        if time() - record.finished_time > self._ttl:
+            self._remove_record(task_id)
+            return None
+
+        self._finished_lru.move_to_end(task_id)
+        return record
+
+    def task_finished(self, task):
+        """Replace a finished task with a compact record"""
+        self._active_tasks.pop(task.get_id(), None)
+        self.add_record(TaskRecord.from_task(task))
+
+    def get_stats(self):
+        return {
+            'active': len(self._active_tasks),
+            'finished': len(self._finished_lru),
+        }
+
+    def _remove_record(self, task_id):
+        del self._finished_lru[task_id]
+        del self._finished_expiry[task_id]
+
+    def _evict(self):
+        now = time()
+        while self._finished_expiry:
+            task_id, record = next(iter(self._finished_expiry.items()))
+            if now - record.finished_time <= self._ttl:
+                break
+            logging.debug('Expiring task %d record', task_id)
+            self._remove_record(task_id)
+
+        while len(self) > self._max_tasks and self._finished_lru:
+            task_id = next(iter(self._finished_lru))
+            logging.debug('Evicting task %d record', task_id)
+            self._remove_record(task_id)
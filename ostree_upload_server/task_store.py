@@ -0,0 +1,285 @@
+import json
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from time import time
+
+from gevent import get_hub, Greenlet
+from gevent.event import Event
+from gevent.lock import Semaphore
+
+from ostree_upload_server.task.state import TaskState
+
+
+class TaskStore:
+    """Durable journal of tasks in an SQLite database
+
+    Task IDs are allocated from the store so they stay unique across
+    restarts. IDs are reserved in blocks so allocation rarely touches
+    the database.
+
+    Saving a task only queues its current state. The queued states are
+    written by a background greenlet every flush_interval seconds, or
+    sooner when batch_size tasks are waiting, in a single transaction
+    run from the hub's threadpool. The database uses WAL journaling so
+    these group commits are cheap and don't block status lookups.
+    Callers that need a state on disk before going on, like before
+    handing out a new task's ID, call sync(). Syncs waiting for a write
+    in progress are written together in the next one.
+
+    ID reservations and status lookups also run in the threadpool. IDs
+    that were looked up and not found are remembered, so polling for an
+    unknown task doesn't query the database every time.
+    """
+    DEFAULT_FLUSH_INTERVAL = 0.5
+    DEFAULT_BATCH_SIZE = 100
+    ID_BLOCK_SIZE = 100
+    MISSING_CACHE_SIZE = 1024
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            repo TEXT,
+            state INTEGER NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            updated REAL NOT NULL
+        )''',
+        '''CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)''',
+        '''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )''',
+    ]
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+
+        logging.info('Opening task store %s', path)
+
+        # The connection is used from the threadpool for flushes, so
+        # serialize all access with a lock. Transactions are managed
+        # explicitly.
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            for statement in TaskStore.SCHEMA:
+                self._db.execute(statement)
+
+            # Start after both the reserved IDs and any saved tasks in
+            # case the reservation was never written
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'id_limit'").fetchone()
+            id_limit = row[0] if row else 0
+            row = self._db.execute('SELECT MAX(id) FROM tasks').fetchone()
+            if row[0] is not None:
+                id_limit = max(id_limit, row[0] + 1)
+        self._next_id = id_limit
+        self._id_limit = id_limit
+        self._reserve_lock = Semaphore()
+
+        # IDs below _next_id that have no saved task, least recently
+        # looked up first
+        self._missing_ids = OrderedDict()
+
+        # IDs being looked up, set to False if saved in the meantime
+        self._lookups = {}
+
+        self._pending = OrderedDict()
+        self._flush_lock = Semaphore()
+        self._wakeup = Event()
+        self._stopping = False
+        self._greenlet = None
+
+    def start(self):
+        self._stopping = False
+        self._greenlet = Greenlet.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._greenlet.join()
+            self._greenlet = None
+
+        # Write anything saved after the last flush
+        self._write(self._take_pending())
+
+        with self._db_lock:
+            self._db.close()
+
+    def allocate_id(self):
+        """Return a task ID that has never been used"""
+        # Other greenlets can take IDs while a block is being reserved
+        while self._next_id >= self._id_limit:
+            with self._reserve_lock:
+                if self._next_id >= self._id_limit:
+                    id_limit = self._id_limit + TaskStore.ID_BLOCK_SIZE
+                    get_hub().threadpool.apply(self._reserve_ids,
+                                               (id_limit,))
+                    self._id_limit = id_limit
+
+        task_id = self._next_id
+        self._next_id += 1
+        return task_id
+
+    def _reserve_ids(self, id_limit):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) "
+                "VALUES ('id_limit', ?)", (id_limit,))
+
+    def save(self, task):
+        """Queue the current state of the task to be written"""
+        task_id = task.get_id()
+        self._missing_ids.pop(task_id, None)
+        if task_id in self._lookups:
+            self._lookups[task_id] = False
+        self._pending.pop(task_id, None)
+        self._pending[task_id] = (
+            task_id,
+            task.TASK_TYPE,
+            task.get_name(),
+            task.get_repo(),
+            task.get_state(),
+            json.dumps(task.get_params()),
+            json.dumps(task.get_status()),
+            time(),
+        )
+
+        if len(self._pending) >= self._batch_size:
+            self._wakeup.set()
+
+    def sync(self):
+        """Write all saved states before returning"""
+        # States saved while another flush was writing are left for
+        # the next one, which any waiting caller then writes
+        with self._flush_lock:
+            self._flush()
+
+    def load_unfinished(self):
+        """Return rows for tasks that had not finished as dicts"""
+        self.sync()
+        with self._db_lock:
+            cursor = self._db.execute(
+                'SELECT id, type, name, repo, state, params FROM tasks '
+                'WHERE state NOT IN (?, ?) ORDER BY id',
+                (TaskState.COMPLETED, TaskState.FAILED))
+            rows = cursor.fetchall()
+
+        return [
+            {
+                'id': task_id,
+                'type': task_type,
+                'name': name,
+                'repo': repo,
+                'state': state,
+                'params': json.loads(params),
+            }
+            for task_id, task_type, name, repo, state, params in rows
+        ]
+
+    def load_status(self, task_id):
+        """Return the saved row for a task as a dict or None"""
+        # IDs that haven't been allocated can't have been saved
+        if task_id >= self._next_id or task_id < 0:
+            return None
+        if task_id in self._missing_ids:
+            self._missing_ids.move_to_end(task_id)
+            return None
+
+        self._lookups[task_id] = True
+        try:
+            row = get_hub().threadpool.apply(self._select_status,
+                                             (task_id,))
+        finally:
+            unchanged = self._lookups.pop(task_id, False)
+        if row is None:
+            # Unless it was saved while being looked up
+            if unchanged:
+                self._missing_ids[task_id] = None
+                if len(self._missing_ids) > TaskStore.MISSING_CACHE_SIZE:
+                    self._missing_ids.popitem(last=False)
+            return None
+
+        task_type, name, repo, state, status, updated = row
+        return {
+            'id': task_id,
+            'type': task_type,
+            'name': name,
+            'repo': repo,
+            'state': state,
+            'status': json.loads(status),
+            'updated': updated,
+        }
+
+    def _select_status(self, task_id):
+        with self._db_lock:
+            return self._db.execute(
+                'SELECT type, name, repo, state, status, updated FROM tasks '
+                'WHERE id = ?', (task_id,)).fetchone()
+
+    def mark_failed(self, task_id):
+        """Fail a saved task that can't be restarted"""
+        status = json.dumps({'state': TaskState.name(TaskState.FAILED)})
+        with self._db_lock:
+            self._db.execute(
+                'UPDATE tasks SET state = ?, status = ?, updated = ? '
+                'WHERE id = ?',
+                (TaskState.FAILED, status, time(), task_id))
+
+    def _take_pending(self):
+        rows = list(self._pending.values())
+        self._pending.clear()
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return
+
+        with self._db_lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO tasks '
+                    '(id, type, name, repo, state, params, status, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+        logging.debug('Wrote %d task states', len(rows))
+
+    def _flush(self):
+        """Write all queued states without blocking the event loop"""
+        rows = self._take_pending()
+        if not rows:
+            return
+
+        try:
+            get_hub().threadpool.apply(self._write, (rows,))
+        except Exception:
+            # Requeue the states unless they've been superseded
+            for row in rows:
+                self._pending.setdefault(row[0], row)
+            raise
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.sync()
+            except Exception as err:
+                logging.error('Writing task states failed: %s', err)
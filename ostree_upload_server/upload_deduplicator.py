@@ -0,0 +1,89 @@
+import logging
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+
+from gevent.lock import Semaphore
+
+from ostree_upload_server.task.state import TaskState
+
+
+class UploadDeduplicator:
+    """Track which task imports each commit into each repo
+
+    When several machines upload the same bundle, only the first upload
+    needs to be imported. Later uploads of the same commit to the same
+    repo can use the first task while it's pending or running, or for
+    ttl seconds after it completed. Failed tasks are never reused so the
+    bundle can be uploaded again. At most max_entries imports are
+    tracked, dropping the oldest first.
+
+    Adding a task can yield to other greenlets, so uploads hold lock()
+    for their commit from find() until add().
+    """
+    DEFAULT_TTL = 600
+    DEFAULT_MAX_ENTRIES = 10000
+
+    def __init__(self, task_queue, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self._task_queue = task_queue
+        self._ttl = ttl
+        self._max_entries = max_entries
+
+        # Map of (repo path, commit) to task ID in insertion order
+        self._imports = OrderedDict()
+
+        # Map of (repo path, commit) to a lock and its number of users
+        self._locks = {}
+
+    @contextmanager
+    def lock(self, repo_path, commit):
+        """Serialize looking up and adding imports of commit"""
+        key = (repo_path, commit)
+        if key not in self._locks:
+            self._locks[key] = [Semaphore(), 0]
+        entry = self._locks[key]
+        entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def find(self, repo_path, commit):
+        """Return the task importing commit into the repo or None"""
+        key = (repo_path, commit)
+        task_id = self._imports.get(key)
+        if task_id is None:
+            return None
+
+        task = self._task_queue.get_task(task_id)
+        if task is None or not self._is_reusable(task):
+            del self._imports[key]
+            return None
+
+        return task
+
+    def add(self, repo_path, commit, task):
+        """Record that task imports commit into the repo"""
+        key = (repo_path, commit)
+        self._imports.pop(key, None)
+        self._imports[key] = task.get_id()
+        while len(self._imports) > self._max_entries:
+            _, task_id = self._imports.popitem(last=False)
+            logging.debug('Forgetting import task %d', task_id)
+
+    def _is_reusable(self, task):
+        state = task.get_state()
+        if state == TaskState.FAILED:
+            return False
+
+        # Finished tasks are records with the time they finished
+        finished_time = getattr(task, 'finished_time', None)
+        if state == TaskState.COMPLETED and finished_time is not None:
+            return time() - finished_time <= self._ttl
+
+        return True
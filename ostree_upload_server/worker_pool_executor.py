@@ -16,7 +16,7 @@ class WorkerPoolExecutor:
     def start(self, task_queue, worker_count=DEFAULT_WORKER_COUNT):
         for _ in range(worker_count):
             worker = Greenlet.spawn(self._work,
-                                    task_queue.queue,
+                                    task_queue,
                                     self._exit_event)
             self._workers.append(worker)
 
@@ -37,9 +37,9 @@ class WorkerPoolExecutor:
                 task = task_queue.get(timeout=1)
                 task.run()
 
-                task_queue.task_done()
+                task_queue.task_done(task)
 
-                self._callback()
+                self._callback(task)
 
                 processed_count += 1
             except queue.Empty:
@@ -23,14 +23,12 @@ def repo(tmp_path):
     return repo
 
 
-@pytest.fixture
-def repo_gpg_homedir(tmp_path):
-    homedir = tmp_path / 'gnupg'
+def _gpg_homedir(homedir, private_key):
     homedir.mkdir(mode=0o700)
 
-    # Import the repo private key
+    # Import the private key
     cmd = ('gpg', '--batch', '--homedir', str(homedir),
-           '--import', str(GPG_KEYS['server']['private']))
+           '--import', str(private_key))
     subprocess.run(cmd, check=True)
 
     yield homedir
@@ -40,3 +38,15 @@ def repo_gpg_homedir(tmp_path):
     cmd = ('gpg-connect-agent', '--no-autostart', '--homedir', str(homedir),
            'killagent', '/bye')
     subprocess.run(cmd, check=True)
+
+
+@pytest.fixture
+def repo_gpg_homedir(tmp_path):
+    yield from _gpg_homedir(tmp_path / 'gnupg', GPG_KEYS['server']['private'])
+
+
+@pytest.fixture
+def upload_gpg_homedir(tmp_path):
+    """GPG homedir with the upload key, to sign commits remotes accept"""
+    yield from _gpg_homedir(tmp_path / 'gnupg-upload',
+                            GPG_KEYS['upload']['private'])
@@ -0,0 +1,62 @@
+from base64 import b64encode
+
+from passlib.hash import pbkdf2_sha256
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from ostree_upload_server.authenticator import Authenticator
+
+
+def make_request(username, password):
+    credentials = '{}:{}'.format(username, password).encode('utf-8')
+    auth = 'Basic ' + b64encode(credentials).decode('ascii')
+    builder = EnvironBuilder(headers={'Authorization': auth})
+    return Request(builder.get_environ())
+
+
+def test_cache(monkeypatch):
+    users = {'user': pbkdf2_sha256.hash('secret')}
+    authenticator = Authenticator(users)
+
+    verify_calls = []
+    real_verify = pbkdf2_sha256.verify
+
+    def verify(*args):
+        verify_calls.append(args)
+        return real_verify(*args)
+
+    monkeypatch.setattr(pbkdf2_sha256, 'verify', verify)
+
+    # Only the first successful check is verified
+    assert authenticator.authenticate(make_request('user', 'secret'))
+    assert authenticator.authenticate(make_request('user', 'secret'))
+    assert len(verify_calls) == 1
+
+    # Failures are never cached
+    assert not authenticator.authenticate(make_request('user', 'wrong'))
+    assert not authenticator.authenticate(make_request('user', 'wrong'))
+    assert len(verify_calls) == 3
+
+    # Changing the user's password invalidates the cached credentials
+    users['user'] = pbkdf2_sha256.hash('changed')
+    assert not authenticator.authenticate(make_request('user', 'secret'))
+    assert authenticator.authenticate(make_request('user', 'changed'))
+    assert len(verify_calls) == 5
+
+
+def test_cache_limits(monkeypatch):
+    users = {
+        'user1': pbkdf2_sha256.hash('secret1'),
+        'user2': pbkdf2_sha256.hash('secret2'),
+    }
+    authenticator = Authenticator(users, cache_ttl=60, cache_size=1)
+    assert authenticator.authenticate(make_request('user1', 'secret1'))
+    assert authenticator.authenticate(make_request('user2', 'secret2'))
+    assert len(authenticator._cache) == 1
+
+    # Expired entries are dropped
+    monkeypatch.setattr('ostree_upload_server.authenticator.time',
+                        lambda: float('inf'))
+    monkeypatch.setattr(pbkdf2_sha256, 'verify', lambda *args: False)
+    assert not authenticator.authenticate(make_request('user2', 'secret2'))
+    assert len(authenticator._cache) == 0
@@ -0,0 +1,80 @@
+import os
+
+import gevent
+import pytest
+
+from ostree_upload_server.bundle_cache import BundleCache
+from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.importers.flatpak import read_bundle_header
+
+from .util import BUNDLES, GPG_KEYS
+
+REF = 'app/org.ostree.Hello/x86_64/master'
+
+
+@pytest.fixture
+def imported_repo(repo, repo_gpg_homedir):
+    repo_path = repo.get_path().get_path()
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES['flatpak']), repo_path, str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['server']['id'])
+    return repo_path, ref_update.new_commit
+
+
+@pytest.fixture
+def build_counter(monkeypatch):
+    builds = []
+    build_bundle = BundleCache._build_bundle
+
+    def counting_build_bundle(self, *args):
+        builds.append(args)
+        return build_bundle(self, *args)
+
+    monkeypatch.setattr(BundleCache, '_build_bundle', counting_build_bundle)
+    return builds
+
+
+def test_bundle_cached(imported_repo, build_counter, tmp_path):
+    repo_path, commit = imported_repo
+    cache = BundleCache(str(tmp_path / 'cache'))
+
+    with cache.bundle(repo_path, REF) as first:
+        assert read_bundle_header(first)[0] == commit
+    with cache.bundle(repo_path, REF) as second:
+        assert second == first
+    assert len(build_counter) == 1
+
+    # Concurrent requests share one build
+    cache = BundleCache(str(tmp_path / 'cache2'))
+
+    def get_bundle():
+        with cache.bundle(repo_path, REF) as path:
+            return path
+
+    greenlets = [gevent.spawn(get_bundle) for _ in range(3)]
+    gevent.joinall(greenlets, raise_error=True)
+    assert len(set(greenlet.value for greenlet in greenlets)) == 1
+    assert len(build_counter) == 2
+
+    # Cached bundles are found again
+    cache = BundleCache(str(tmp_path / 'cache2'))
+    assert len(cache) == 1
+
+
+def test_bundle_evicted(imported_repo, build_counter, tmp_path):
+    repo_path, _ = imported_repo
+    cache = BundleCache(str(tmp_path / 'cache'), max_size=0)
+
+    # Bundles aren't removed while in use
+    with cache.bundle(repo_path, REF) as path:
+        assert os.path.exists(path)
+    assert not os.path.exists(path)
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_missing_ref(repo, tmp_path):
+    cache = BundleCache(str(tmp_path / 'cache'))
+    with pytest.raises(RuntimeError):
+        with cache.bundle(repo.get_path().get_path(), REF):
+            pass
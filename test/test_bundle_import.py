@@ -1,7 +1,26 @@
 from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.importers import tar as tar_importer
+from ostree_upload_server.importers import util as importers_util
+from ostree_upload_server.importers.flatpak import FlatpakImporter
+from ostree_upload_server.importers.tar import (
+    TarImporter, TgzImporter, open_decompressed
+)
+from ostree_upload_server.importers.util import find_new_objects
+from ostree_upload_server.push_adapter.ostree import write_objects_tar
+import gi
+import gzip
+import os
 import pytest
+import runpy
+import shutil
+import sys
 
-from .util import BUNDLES, GPG_KEYS
+from .util import BUNDLES, GPG_KEYS, TESTDIR
+
+gi.require_version('OSTree', '1.0')
+from gi.repository import Gio, OSTree  # noqa: E402
+
+REF = 'app/org.ostree.Hello/x86_64/master'
 
 
 @pytest.mark.parametrize('bundle_type', ['flatpak', 'tar', 'tgz'])
@@ -11,3 +30,235 @@ def test_import(bundle_type, repo, repo_gpg_homedir):
                                  str(repo_gpg_homedir),
                                  str(GPG_KEYS['upload']['keyring']),
                                  GPG_KEYS['server']['id'])
+
+
+@pytest.mark.parametrize('bundle_type', ['tar', 'tgz'])
+def test_import_tar_stream(bundle_type, repo, repo_gpg_homedir):
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES[bundle_type]),
+        repo.get_path().get_path(),
+        str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']),
+        GPG_KEYS['server']['id'],
+        tar_import_mode='stream')
+    assert ref_update.ref == REF
+    assert ref_update.old_commit is None
+
+
+@pytest.mark.parametrize('import_mode', TarImporter.IMPORT_MODES)
+def test_import_tar_progress(import_mode, repo, repo_gpg_homedir,
+                             monkeypatch):
+    monkeypatch.setattr(TarImporter, 'PROGRESS_INTERVAL', 1)
+    reports = []
+
+    def progress_callback(phase, progress):
+        if progress:
+            reports.append(progress)
+
+    BundleImporter.import_bundle(
+        str(BUNDLES['tar']),
+        repo.get_path().get_path(),
+        str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']),
+        GPG_KEYS['server']['id'],
+        tar_import_mode=import_mode,
+        progress_callback=progress_callback)
+
+    if import_mode == TarImporter.EXTRACT:
+        # Local pulls may import objects without counting them as
+        # fetched, so only check the pull reported
+        pulled = [report for report in reports
+                  if 'objects_fetched' in report]
+        assert pulled
+        assert set(pulled[-1]) == {'objects_fetched', 'objects_requested',
+                                   'bytes_transferred'}
+    else:
+        streamed = [report for report in reports
+                    if 'objects_written' in report and 'bytes_read' in report]
+        assert streamed[-1]['objects_written'] > 0
+        # Each object is reported once
+        for previous, report in zip(streamed, streamed[1:]):
+            assert report != previous
+
+
+@pytest.mark.parametrize('bundle_type,importer_class', [
+    ('flatpak', FlatpakImporter),
+    ('tar', TarImporter),
+    ('tgz', TgzImporter),
+])
+def test_sniff(bundle_type, importer_class):
+    with open(BUNDLES[bundle_type], 'rb') as bundle:
+        header = bundle.read(BundleImporter.SNIFF_SIZE)
+    matches = [cls for cls in BundleImporter.BUNDLE_IMPORTERS
+               if cls.sniff(header)]
+    assert matches == [importer_class]
+
+
+@pytest.mark.parametrize('same_device', [True, False])
+def test_staging_dir(same_device, monkeypatch, tmp_path):
+    repo_path = tmp_path / 'repo'
+    (repo_path / 'tmp').mkdir(parents=True)
+    (repo_path / 'objects').mkdir()
+    temp_dir = tmp_path / 'staging'
+    monkeypatch.setattr(TarImporter, 'TEMP_DIR_PREFIX', str(temp_dir))
+
+    # Put the repo's objects on another device unless same_device
+    real_stat = os.stat
+
+    def fake_stat(path, *args, **kwargs):
+        st = real_stat(path, *args, **kwargs)
+        if same_device or str(path) != str(repo_path / 'objects'):
+            return st
+        fields = list(st)
+        fields[2] = st.st_dev + 1
+        return os.stat_result(fields)
+
+    monkeypatch.setattr(tar_importer, 'stat', fake_stat)
+
+    importer = TarImporter('bundle.tar', str(repo_path), None, None, None)
+    staging_dir = importer._get_staging_dir()
+    if same_device:
+        assert staging_dir == str(repo_path / 'tmp')
+        assert not temp_dir.exists()
+    else:
+        assert staging_dir == str(temp_dir)
+        assert temp_dir.is_dir()
+
+
+@pytest.fixture
+def truncated_gzip(tmp_path):
+    gz_path = tmp_path / 'truncated.gz'
+    data = gzip.compress(os.urandom(64 * 1024))
+    gz_path.write_bytes(data[:len(data) // 2])
+    return str(gz_path)
+
+
+def test_decompress_error(truncated_gzip):
+    with pytest.raises(EOFError):
+        with open_decompressed(truncated_gzip) as stream:
+            stream.read()
+
+
+def test_decompress_error_not_masking(truncated_gzip):
+    # The error raised by the body wins over the decompression error
+    with pytest.raises(ValueError, match='bad member'):
+        with open_decompressed(truncated_gzip) as stream:
+            stream.read()
+            raise ValueError('bad member')
+
+
+def test_import_script(repo, repo_gpg_homedir, monkeypatch, tmp_path,
+                       capsys):
+    metadata_updates = []
+    monkeypatch.setattr(importers_util, 'update_repo_metadata',
+                        lambda *args: metadata_updates.append(args))
+
+    # Tar bundles and a broken one in a directory, the flatpak directly
+    bundle_dir = tmp_path / 'bundles'
+    bundle_dir.mkdir()
+    for bundle_type in ('tar', 'tgz'):
+        shutil.copy(str(BUNDLES[bundle_type]), str(bundle_dir))
+    broken = bundle_dir / 'broken.tar'
+    broken.write_bytes(b'not a bundle')
+
+    repo_path = repo.get_path().get_path()
+    monkeypatch.setattr(sys, 'argv', [
+        'bundle-import.py', '-j', '2',
+        '--gpg-homedir', str(repo_gpg_homedir),
+        '--keyring', str(GPG_KEYS['upload']['keyring']),
+        '--sign-key', GPG_KEYS['server']['id'],
+        '--dir', str(bundle_dir),
+        repo_path, str(BUNDLES['flatpak']),
+    ])
+    with pytest.raises(SystemExit) as excinfo:
+        runpy.run_path(str(TESTDIR.parent / 'bundle-import.py'),
+                       run_name='__main__')
+    assert excinfo.value.code == 1
+
+    statuses = {}
+    for line in capsys.readouterr().out.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) >= 2 and os.path.isabs(fields[0]):
+            statuses[os.path.basename(fields[0])] = fields[1]
+    assert statuses.pop('broken.tar') == 'failed'
+    assert sorted(statuses) == ['hello.flatpak', 'hello.tar', 'hello.tgz']
+    assert 'failed' not in statuses.values()
+
+    _, refs = repo.list_refs(None, None)
+    assert list(refs) == [REF]
+    assert metadata_updates == [
+        (repo_path, str(repo_gpg_homedir), GPG_KEYS['server']['id'])]
+
+
+@pytest.fixture
+def unsigned_tar(tmp_path, repo_gpg_homedir):
+    """Tar bundle of a commit of REF without signatures"""
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    source_repo = OSTree.Repo.new(Gio.File.new_for_path(str(source_path)))
+    source_repo.create(OSTree.RepoMode.ARCHIVE_Z2)
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES['flatpak']), str(source_path), str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), None)
+    commit = ref_update.new_commit
+
+    tar_path = tmp_path / 'unsigned.tar'
+    with open(tar_path, 'wb') as tar_file:
+        write_objects_tar(source_repo, str(source_path), REF, commit,
+                          find_new_objects(source_repo, commit), tar_file)
+    return str(tar_path), commit
+
+
+def list_object_files(repo):
+    objects_path = os.path.join(repo.get_path().get_path(), 'objects')
+    return [name for _, _, names in os.walk(objects_path) for name in names]
+
+
+@pytest.mark.parametrize('import_mode', TarImporter.IMPORT_MODES)
+def test_import_bundles_failed_objects(import_mode, repo, repo_gpg_homedir,
+                                       unsigned_tar):
+    tar_path, unsigned_commit = unsigned_tar
+    import_args = (repo.get_path().get_path(), str(repo_gpg_homedir),
+                   str(GPG_KEYS['upload']['keyring']),
+                   GPG_KEYS['server']['id'])
+
+    # Nothing of a bundle failing verification is committed
+    results = BundleImporter.import_bundles(
+        [tar_path], *import_args, update_metadata=False,
+        tar_import_mode=import_mode)
+    assert results[0][0] is None
+    assert results[0][1]
+    assert list_object_files(repo) == []
+
+    # Even with other bundles succeeding in the batch
+    results = BundleImporter.import_bundles(
+        [tar_path, str(BUNDLES['flatpak'])], *import_args,
+        update_metadata=False, tar_import_mode=import_mode)
+    (_, error), (ref_update, flatpak_error) = results
+    assert error
+    assert flatpak_error is None
+    assert ref_update.ref == REF
+    assert not repo.has_object(OSTree.ObjectType.COMMIT, unsigned_commit,
+                               None)[1]
+    _, commit = repo.resolve_rev(REF, False)
+    assert commit == ref_update.new_commit
+
+
+def test_import_bundles_same_ref(repo, repo_gpg_homedir, monkeypatch):
+    # Bundles whose ref can't be peeked are checked after the import
+    monkeypatch.setattr(TarImporter, 'peek_commit',
+                        classmethod(lambda cls, src_path: None))
+
+    results = BundleImporter.import_bundles(
+        [str(BUNDLES['tar']), str(BUNDLES['tgz'])],
+        repo.get_path().get_path(), str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['server']['id'],
+        update_metadata=False)
+    (ref_update, error), (tgz_update, tgz_error) = results
+    assert error is None
+    assert ref_update.old_commit is None
+    assert tgz_update is None
+    assert 'already imported' in tgz_error
+
+    _, commit = repo.resolve_rev(REF, False)
+    assert commit == ref_update.new_commit
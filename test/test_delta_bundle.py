@@ -0,0 +1,123 @@
+import os
+
+import gi
+import pytest
+
+from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.delta_bundle import (
+    _BundleWriter, DeltaBundleReader, open_delta_bundle
+)
+from ostree_upload_server.importers.flatpak import (
+    OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT, read_bundle_header
+)
+from ostree_upload_server.importers.util import (
+    get_from_commit, get_static_delta_path
+)
+
+from .util import BUNDLES, GPG_KEYS
+
+gi.require_version('OSTree', '1.0')
+from gi.repository import Gio, GLib, OSTree  # noqa: E402
+
+REF = 'app/org.ostree.Hello/x86_64/master'
+
+
+def read_all(reader, block_size=1000):
+    chunks = []
+    while True:
+        chunk = reader.read(block_size)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+@pytest.mark.parametrize('part_sizes', [
+    [],
+    [10, 100],
+    [300, 70000],
+])
+def test_writer(part_sizes, tmp_path):
+    commit = bytes(range(32))
+    parts = [bytes([ord('x')]) + os.urandom(size) for size in part_sizes]
+    members = (
+        1234,
+        b'',
+        commit,
+        ({}, b'', [], 'subject', 'body', 5678, commit, commit),
+        b'',
+        [(0, commit, len(part), 2 * len(part), b'') for part in parts],
+        [],
+    )
+    metadata = {'ostree.endianness': GLib.Variant('y', ord('l'))}
+    part_keys = ['deltas/AA/part/{}'.format(i) for i in range(len(parts))]
+
+    # What GLib makes of the superblock with the parts inline
+    inline_metadata = dict(metadata)
+    for key, part in zip(part_keys, parts):
+        inline_metadata[key] = GLib.Variant('(yay)', (part[0], part[1:]))
+    expected = GLib.Variant(OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT,
+                            (inline_metadata,) + members)
+    expected = expected.get_data_as_bytes().get_data()
+
+    superblock = GLib.Variant(OSTREE_STATIC_DELTA_SUPERBLOCK_FORMAT,
+                              (metadata,) + members)
+    entries = [GLib.Variant('{sv}', (key, value)).get_data_as_bytes()
+               .get_data() for key, value in metadata.items()]
+    files = []
+    for key, part in zip(part_keys, parts):
+        part_file = open(tmp_path / key.replace('/', '_'), 'w+b')
+        files.append(part_file)
+        part_file.write(part)
+        part_file.flush()
+        entries.append((key, part_file.fileno(), len(part)))
+
+    try:
+        writer = _BundleWriter()
+        writer.write_superblock(superblock, entries)
+        reader = DeltaBundleReader(writer.segments, writer.size)
+        assert len(reader) == len(expected)
+        assert read_all(reader) == expected
+        assert len(reader) == 0
+    finally:
+        for part_file in files:
+            part_file.close()
+
+
+def test_bundle_import(repo, upload_gpg_homedir, repo_gpg_homedir,
+                       tmp_path):
+    # Sign the commit with the upload key so the bundle can be imported
+    repo_path = repo.get_path().get_path()
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES['flatpak']), repo_path, str(upload_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['upload']['id'])
+    commit = ref_update.new_commit
+
+    bundle_path = tmp_path / 'streamed.flatpak'
+    with open_delta_bundle(repo_path, REF) as bundle:
+        assert bundle.name == commit + '.flatpak'
+        with bundle.open() as reader:
+            bundle_path.write_bytes(read_all(reader, 4096))
+        assert bundle_path.stat().st_size == len(bundle)
+
+        # Every reader starts from the beginning
+        with bundle.open() as reader:
+            assert reader.read() == bundle_path.read_bytes()
+
+    # The repo's delta was generated with the parts in separate files
+    assert os.path.exists(os.path.join(
+        repo_path, get_static_delta_path(None, commit, '0')))
+
+    header_commit, metadata = read_bundle_header(str(bundle_path))
+    assert header_commit == commit
+    assert metadata['ref'] == REF
+    assert metadata['metadata'].startswith('[Application]')
+
+    target_path = tmp_path / 'target'
+    target_path.mkdir()
+    target_repo = OSTree.Repo.new(Gio.File.new_for_path(str(target_path)))
+    target_repo.create(OSTree.RepoMode.ARCHIVE_Z2)
+    target_update = BundleImporter.import_bundle(
+        str(bundle_path), str(target_path), str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['server']['id'])
+    assert target_update.ref == REF
+    assert get_from_commit(target_repo, target_update.new_commit) == commit
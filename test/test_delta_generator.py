@@ -0,0 +1,87 @@
+import gevent
+import pytest
+
+from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.delta_generator import (
+    DeltaGenerator, generate_repo_deltas
+)
+from ostree_upload_server.importers.base import RefUpdate
+from ostree_upload_server.importers.util import (
+    checkout_repository, generate_static_deltas
+)
+
+from .util import BUNDLES, GPG_KEYS
+
+REF = 'app/org.ostree.Hello/x86_64/master'
+
+
+class StubExecutor:
+    """Executor recording the deltas requested instead of generating them"""
+    def __init__(self):
+        self.deltas = []
+
+    def run(self, func, repo_path, deltas):
+        assert func is generate_repo_deltas
+        self.deltas.append((repo_path, deltas))
+
+
+class StubMetadataUpdater:
+    def __init__(self):
+        self.dirty = []
+
+    def mark_dirty(self, repo_path):
+        self.dirty.append(repo_path)
+
+
+@pytest.fixture
+def executor():
+    return StubExecutor()
+
+
+@pytest.fixture
+def metadata_updater():
+    return StubMetadataUpdater()
+
+
+def test_deltas_coalesced(executor, metadata_updater):
+    generator = DeltaGenerator(executor, metadata_updater, delay=0.1)
+    generator.start()
+    try:
+        generator.add_ref_update('/repo', RefUpdate(REF, 'a', 'b'))
+        generator.add_ref_update('/repo', RefUpdate(REF, 'b', 'c'))
+        assert executor.deltas == []
+
+        gevent.sleep(0.2)
+        assert executor.deltas == [
+            ('/repo', [(None, 'c'), ('a', 'c'), ('b', 'c')])]
+        assert metadata_updater.dirty == ['/repo']
+    finally:
+        generator.stop()
+
+
+def test_stop_generates_pending(executor, metadata_updater):
+    generator = DeltaGenerator(executor, metadata_updater, delay=10)
+    generator.start()
+    generator.add_ref_update('/repo', RefUpdate(REF, None, 'a'))
+    gevent.sleep(0.05)
+    assert executor.deltas == []
+
+    generator.stop()
+    assert executor.deltas == [('/repo', [(None, 'a')])]
+    assert metadata_updater.dirty == ['/repo']
+
+
+def test_generate_static_deltas(repo, repo_gpg_homedir):
+    repo_path = repo.get_path().get_path()
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES['flatpak']), repo_path, str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['server']['id'])
+    commit = ref_update.new_commit
+
+    with checkout_repository(repo_path) as checkout:
+        generate_static_deltas(checkout, [(None, commit)])
+        assert checkout.list_static_delta_names()[1] == [commit]
+
+        # Existing deltas are skipped
+        generate_static_deltas(checkout, [(None, commit)])
+        assert checkout.list_static_delta_names()[1] == [commit]
@@ -0,0 +1,66 @@
+import gevent
+import pytest
+
+from gevent.monkey import get_original
+
+from ostree_upload_server.import_executor import ImportExecutor
+
+# Block the worker for real even if time has been monkey patched
+_sleep = get_original('time', 'sleep')
+
+
+def add(a, b):
+    return a + b
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def block(seconds):
+    _sleep(seconds)
+    return seconds
+
+
+@pytest.fixture(params=ImportExecutor.EXECUTOR_TYPES)
+def executor(request):
+    executor = ImportExecutor(request.param, 2)
+    executor.start()
+    yield executor
+    executor.stop()
+
+
+def test_result(executor):
+    assert executor.run(add, 1, b=2) == 3
+
+
+def test_exception(executor):
+    with pytest.raises(ValueError, match='import failed'):
+        executor.run(fail, 'import failed')
+
+
+def test_loop_runs_while_blocked(executor):
+    # Start the workers so spawning processes isn't counted
+    executor.run(add, 0, 0)
+
+    ticks = []
+
+    def tick():
+        while True:
+            ticks.append(None)
+            gevent.sleep(0.01)
+
+    ticker = gevent.spawn(tick)
+    try:
+        assert executor.run(block, 0.3) == 0.3
+    finally:
+        ticker.kill()
+    assert len(ticks) >= 10
+
+
+def test_not_started():
+    executor = ImportExecutor()
+    with pytest.raises(RuntimeError):
+        executor.run(add, 1, 2)
+    with pytest.raises(ValueError):
+        ImportExecutor('fork')
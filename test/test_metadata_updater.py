@@ -0,0 +1,91 @@
+import gevent
+import pytest
+
+from ostree_upload_server.importers.util import update_repo_metadata
+from ostree_upload_server.metadata_updater import MetadataUpdater
+
+
+class StubExecutor:
+    """Executor recording the metadata updates instead of running them"""
+    def __init__(self):
+        self.updates = []
+
+    def run(self, func, *args):
+        assert func is update_repo_metadata
+        self.updates.append(args[0])
+
+
+@pytest.fixture
+def executor():
+    return StubExecutor()
+
+
+@pytest.fixture
+def updater(executor):
+    updaters = []
+
+    def make_updater(**kwargs):
+        updater = MetadataUpdater(executor, **kwargs)
+        updater.start()
+        updaters.append(updater)
+        return updater
+
+    yield make_updater
+    for updater in updaters:
+        updater.stop()
+
+
+def test_debounce(updater, executor, tmp_path):
+    repo_path = str(tmp_path)
+    metadata_updater = updater(debounce=0.2, max_staleness=10)
+
+    for _ in range(3):
+        metadata_updater.mark_dirty(repo_path)
+        gevent.sleep(0.05)
+    assert executor.updates == []
+
+    gevent.sleep(0.3)
+    assert executor.updates == [repo_path]
+
+
+def test_max_staleness(updater, executor, tmp_path):
+    repo_path = str(tmp_path)
+    metadata_updater = updater(debounce=0.2, max_staleness=0.3)
+
+    # Marking more often than the debounce still updates periodically
+    for _ in range(20):
+        metadata_updater.mark_dirty(repo_path)
+        gevent.sleep(0.05)
+    assert 2 <= len(executor.updates) <= 3
+
+
+def test_update_now(updater, executor, tmp_path):
+    repo_path = str(tmp_path)
+    metadata_updater = updater(debounce=0.1, max_staleness=10)
+
+    metadata_updater.mark_dirty(repo_path)
+    metadata_updater.mark_dirty(repo_path)
+    metadata_updater.update_now(repo_path)
+    assert executor.updates == [repo_path]
+
+    # The pending update was included
+    gevent.sleep(0.2)
+    assert executor.updates == [repo_path]
+
+
+def test_stop_flushes(executor, tmp_path):
+    repo_paths = [str(tmp_path / name) for name in ('a', 'b')]
+    for repo_path in repo_paths:
+        (tmp_path / repo_path).mkdir()
+    metadata_updater = MetadataUpdater(executor, debounce=10,
+                                       max_staleness=10)
+    metadata_updater.start()
+
+    for repo_path in repo_paths:
+        metadata_updater.mark_dirty(repo_path)
+        metadata_updater.mark_dirty(repo_path)
+    gevent.sleep(0.05)
+    assert executor.updates == []
+
+    metadata_updater.stop()
+    assert sorted(executor.updates) == repo_paths
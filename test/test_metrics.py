@@ -0,0 +1,55 @@
+import pytest
+
+from ostree_upload_server.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_and_gauge():
+    registry = Registry()
+    counter = Counter('test_total', 'Test counter', ['kind'],
+                      registry=registry)
+    gauge = Gauge('test_gauge', 'Test gauge', registry=registry)
+
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    counter.inc(kind='b"\n')
+    gauge.set(5)
+    gauge.dec(2)
+
+    assert registry.render() == (
+        '# HELP test_gauge Test gauge\n'
+        '# TYPE test_gauge gauge\n'
+        'test_gauge 3\n'
+        '# HELP test_total Test counter\n'
+        '# TYPE test_total counter\n'
+        'test_total{kind="a"} 3\n'
+        'test_total{kind="b\\"\\n"} 1\n'
+    )
+
+    with pytest.raises(ValueError):
+        counter.inc(-1, kind='a')
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        Gauge('test_gauge', 'Duplicate gauge', registry=registry)
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram('test_seconds', 'Test histogram', ['phase'],
+                          buckets=(0.5, 1), registry=registry)
+
+    histogram.observe(0.25, phase='a')
+    histogram.observe(1, phase='a')
+    histogram.observe(2, phase='a')
+    with histogram.time(phase='b'):
+        pass
+
+    lines = registry.render().splitlines()
+    assert lines[2:7] == [
+        'test_seconds_bucket{phase="a",le="0.5"} 1',
+        'test_seconds_bucket{phase="a",le="1"} 2',
+        'test_seconds_bucket{phase="a",le="+Inf"} 3',
+        'test_seconds_sum{phase="a"} 3.25',
+        'test_seconds_count{phase="a"} 3',
+    ]
+    assert 'test_seconds_count{phase="b"} 1' in lines
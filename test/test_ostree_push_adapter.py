@@ -0,0 +1,103 @@
+import tarfile
+
+from io import BytesIO
+
+import gi
+import pytest
+
+from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.importers.util import (
+    copy_commit, find_missing_objects, find_new_objects
+)
+from ostree_upload_server.push_adapter.ostree import (
+    OstreePushAdapter, write_objects_tar
+)
+
+from .util import BUNDLES, GPG_KEYS
+
+gi.require_version('OSTree', '1.0')
+from gi.repository import Gio, OSTree  # noqa: E402
+
+REF = 'app/org.ostree.Hello/x86_64/master'
+
+
+@pytest.fixture
+def imported_repo(repo, repo_gpg_homedir):
+    repo_path = repo.get_path().get_path()
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES['flatpak']), repo_path, str(repo_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['server']['id'])
+    return repo, ref_update.new_commit
+
+
+@pytest.fixture
+def target_repo(tmp_path):
+    repodir = tmp_path / 'target'
+    repodir.mkdir()
+    repo = OSTree.Repo.new(Gio.File.new_for_path(str(repodir)))
+    repo.create(OSTree.RepoMode.ARCHIVE_Z2)
+    return repo
+
+
+def recommit(repo, commit):
+    """Make a new commit of commit's tree at REF"""
+    repo.prepare_transaction(None)
+    new_commit = copy_commit(repo, commit, REF)
+    repo.transaction_set_ref(None, REF, new_commit)
+    repo.commit_transaction(None)
+    return new_commit
+
+
+def test_find_new_objects(imported_repo):
+    repo, commit = imported_repo
+
+    objects = find_new_objects(repo, commit)
+    assert objects[0] == (OSTree.ObjectType.COMMIT, commit)
+    assert (OSTree.ObjectType.FILE in
+            set(objtype for objtype, _ in objects))
+
+    # Only the commit is new when the tree is the same
+    new_commit = recommit(repo, commit)
+    assert find_new_objects(repo, new_commit, commit) == [
+        (OSTree.ObjectType.COMMIT, new_commit)]
+
+
+def test_objects_tar(imported_repo):
+    repo, commit = imported_repo
+    objects = find_new_objects(repo, commit)
+
+    tar_file = BytesIO()
+    write_objects_tar(repo, repo.get_path().get_path(), REF, commit,
+                      objects, tar_file)
+    tar_file.seek(0)
+    with tarfile.open(fileobj=tar_file) as tar_archive:
+        names = tar_archive.getnames()
+        ref_file = tar_archive.extractfile('refs/heads/' + REF)
+        assert ref_file.read().decode('ascii').strip() == commit
+
+    assert 'config' in names
+    for objtype, checksum in objects:
+        assert OSTree.get_relative_object_path(checksum, objtype,
+                                               True) in names
+
+
+def test_push_to_path(imported_repo, target_repo):
+    repo, commit = imported_repo
+    repo_path = repo.get_path().get_path()
+    adapter = OstreePushAdapter('local', {
+        'path': target_repo.get_path().get_path(),
+    })
+    assert not adapter.needs_bundle
+
+    assert adapter.push_ref(repo_path, REF)
+    _, target_commit = target_repo.resolve_rev(REF, False)
+    assert target_commit == commit
+    assert find_missing_objects(target_repo, commit) == []
+
+    # Already pushed
+    assert adapter.push_ref(repo_path, REF)
+
+    new_commit = recommit(repo, commit)
+    assert adapter.push_ref(repo_path, REF)
+    _, target_commit = target_repo.resolve_rev(REF, False)
+    assert target_commit == new_commit
@@ -0,0 +1,212 @@
+import http.client
+import os
+
+import pytest
+
+from gevent import get_hub
+from gevent.pywsgi import WSGIServer
+
+from ostree_upload_server.delta_bundle import (
+    _FileSegment, DeltaBundle, DeltaNotBundleable
+)
+from ostree_upload_server.push_adapter import http as http_adapter
+from ostree_upload_server.push_adapter.base import BundleRequired
+from ostree_upload_server.push_adapter.http import HttpPushAdapter
+
+
+class StandInServer:
+    """Local HTTP server recording the uploads it receives
+
+    The status of each response is taken from statuses, and is 200 once
+    they've run out.
+    """
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        self._server = WSGIServer(('127.0.0.1', 0), self._app, log=None)
+
+    def _app(self, environ, start_response):
+        body = environ['wsgi.input'].read()
+        self.requests.append({
+            'method': environ['REQUEST_METHOD'],
+            'query': environ['QUERY_STRING'],
+            'content_type': environ.get('CONTENT_TYPE'),
+            'body': body,
+            'remote_port': environ['REMOTE_PORT'],
+        })
+        status = self.statuses.pop(0) if self.statuses else 200
+        start_response('{} Status'.format(status),
+                       [('Content-Type', 'application/json')])
+        return [b'{}']
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/upload'.format(self._server.server_port)
+
+    def __enter__(self):
+        self._server.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.stop()
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    path = tmp_path / 'hello.flatpak'
+    path.write_bytes(b'bundle data' * 1000)
+    return str(path)
+
+
+def push(adapter, bundle):
+    # Pushes run in the threadpool like in PushTask
+    return get_hub().threadpool.apply(adapter.push, (bundle,))
+
+
+def test_multipart_push(bundle):
+    with StandInServer() as server:
+        adapter = HttpPushAdapter('test', {'url': server.url,
+                                           'repo': 'main'})
+        assert push(adapter, bundle)
+        assert push(adapter, bundle)
+
+    assert len(server.requests) == 2
+    request = server.requests[0]
+    assert request['method'] == 'POST'
+    assert request['content_type'].startswith('multipart/form-data')
+    assert b'name="repo"\r\n\r\nmain\r\n' in request['body']
+    assert b'filename="hello.flatpak"' in request['body']
+    assert b'bundle data' * 1000 in request['body']
+
+    # The connection was kept alive for the second push
+    assert server.requests[1]['remote_port'] == request['remote_port']
+
+
+def test_put_push(bundle):
+    with StandInServer() as server:
+        adapter = HttpPushAdapter('test', {'url': server.url,
+                                           'method': 'put',
+                                           'repo': 'main'})
+        assert push(adapter, bundle)
+
+    request, = server.requests
+    assert request['method'] == 'PUT'
+    assert request['query'] == 'filename=hello.flatpak&repo=main'
+    assert request['body'] == b'bundle data' * 1000
+
+
+def test_retries(bundle):
+    settings = {'retries': 2, 'retry_backoff': 0.01}
+
+    with StandInServer([503, 502]) as server:
+        adapter = HttpPushAdapter('test', dict(settings, url=server.url))
+        assert push(adapter, bundle)
+    assert len(server.requests) == 3
+    assert b'bundle data' * 1000 in server.requests[2]['body']
+
+    with StandInServer([500, 500, 500]) as server:
+        adapter = HttpPushAdapter('test', dict(settings, url=server.url))
+        assert not push(adapter, bundle)
+    assert len(server.requests) == 3
+
+    # Client errors aren't retried
+    with StandInServer([403]) as server:
+        adapter = HttpPushAdapter('test', dict(settings, url=server.url))
+        assert not push(adapter, bundle)
+    assert len(server.requests) == 1
+
+
+def test_connection_error_retried(bundle):
+    with StandInServer() as server:
+        url = server.url
+    adapter = HttpPushAdapter('test', {'url': url, 'retries': 1,
+                                       'retry_backoff': 0.01})
+    assert not push(adapter, bundle)
+
+
+def test_upload_chunk_size(tmp_path, monkeypatch):
+    bundle = tmp_path / 'large.flatpak'
+    bundle.write_bytes(os.urandom(200000))
+
+    # Record the writes to the connection after the headers
+    writes = []
+    send = http.client.HTTPConnection.send
+
+    def record_send(self, data):
+        writes.append(len(data))
+        return send(self, data)
+
+    monkeypatch.setattr(http.client.HTTPConnection, 'send', record_send)
+
+    with StandInServer() as server:
+        adapter = HttpPushAdapter('test', {'url': server.url,
+                                           'method': 'put',
+                                           'upload_chunk_size': 65536})
+        assert push(adapter, str(bundle))
+
+    assert server.requests[0]['body'] == bundle.read_bytes()
+    assert writes[1:] == [65536, 65536, 65536, 200000 - 3 * 65536]
+
+
+@pytest.fixture
+def delta_bundle(tmp_path):
+    part_path = tmp_path / 'part'
+    part_path.write_bytes(b'part data' * 1000)
+    fd = os.open(str(part_path), os.O_RDONLY)
+    segments = [b'superblock', _FileSegment(fd, 9000), b'offsets']
+    bundle = DeltaBundle('abc.flatpak', segments, 9017, [fd])
+    yield bundle
+    bundle.close()
+
+
+def push_ref(adapter, repo_path, ref):
+    return get_hub().threadpool.apply(adapter.push_ref, (repo_path, ref))
+
+
+@pytest.mark.parametrize('method', HttpPushAdapter.METHODS)
+def test_stream_bundle(method, delta_bundle, monkeypatch):
+    def open_delta_bundle(repo_path, ref):
+        assert (repo_path, ref) == ('/repo', 'app/org.example.App')
+        return delta_bundle
+
+    monkeypatch.setattr(http_adapter, 'open_delta_bundle', open_delta_bundle)
+
+    with StandInServer([503]) as server:
+        adapter = HttpPushAdapter('test', {'url': server.url,
+                                           'method': method,
+                                           'stream_bundle': 'true',
+                                           'retry_backoff': 0.01})
+        assert not adapter.needs_bundle
+        assert push_ref(adapter, '/repo', 'app/org.example.App')
+
+    # The retry sent the whole bundle again
+    expected = b'superblock' + b'part data' * 1000 + b'offsets'
+    assert len(server.requests) == 2
+    for request in server.requests:
+        if method == 'put':
+            assert request['query'] == 'filename=abc.flatpak'
+            assert request['body'] == expected
+        else:
+            assert b'filename="abc.flatpak"' in request['body']
+            assert expected in request['body']
+
+
+def test_stream_bundle_required(monkeypatch):
+    def open_delta_bundle(repo_path, ref):
+        raise DeltaNotBundleable('has fallback objects')
+
+    monkeypatch.setattr(http_adapter, 'open_delta_bundle', open_delta_bundle)
+
+    adapter = HttpPushAdapter('test', {'url': 'http://127.0.0.1/upload',
+                                       'stream_bundle': 'yes'})
+    with pytest.raises(BundleRequired, match='has fallback objects'):
+        adapter.push_ref('/repo', 'app/org.example.App')
+
+
+def test_stream_bundle_setting():
+    url = 'http://127.0.0.1/upload'
+    assert HttpPushAdapter('test', {'url': url}).needs_bundle
+    assert HttpPushAdapter('test', {'url': url,
+                                    'stream_bundle': 'off'}).needs_bundle
+    with pytest.raises(ValueError):
+        HttpPushAdapter('test', {'url': url, 'stream_bundle': 'maybe'})
@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+
+from ostree_upload_server.push_adapter.base import (
+    BasePushAdapter, BundleRequired
+)
+from ostree_upload_server.push_adapter.dummy import DummyPushAdapter
+from ostree_upload_server.task.push import PushTask
+from ostree_upload_server.task.state import TaskState
+
+REF = 'app/org.ostree.Hello/x86_64/master'
+
+
+class FakeBundleCache:
+    def __init__(self):
+        self.builds = []
+
+    @contextmanager
+    def bundle(self, repo_path, ref):
+        self.builds.append((repo_path, ref))
+        yield '/bundles/hello.flatpak'
+
+
+class FailingPushAdapter(BasePushAdapter):
+    name = 'failing'
+
+    def push(self, bundle):
+        raise RuntimeError('remote unreachable')
+
+
+def test_push_to_remotes():
+    cache = FakeBundleCache()
+    adapters = [DummyPushAdapter(name, {}) for name in ('a', 'b', 'c')]
+    task = PushTask(REF, '/repo', REF, adapters, cache, concurrency=2)
+    assert task.get_params() == {'ref': REF, 'remotes': ['a', 'b', 'c']}
+
+    task.run()
+    assert task.get_state() == TaskState.COMPLETED
+    assert cache.builds == [('/repo', REF)]
+    assert task.get_status()['remotes'] == [
+        {'remote': name, 'state': 'COMPLETED'} for name in ('a', 'b', 'c')]
+
+
+def test_push_failure_reported_per_remote():
+    adapters = [DummyPushAdapter('a', {}), FailingPushAdapter('b')]
+    task = PushTask(REF, '/repo', REF, adapters, FakeBundleCache())
+
+    task.run()
+    assert task.get_state() == TaskState.FAILED
+    assert task.get_status()['remotes'] == [
+        {'remote': 'a', 'state': 'COMPLETED'},
+        {'remote': 'b', 'state': 'FAILED', 'error': 'remote unreachable'},
+    ]
+
+
+class RefPushAdapter(BasePushAdapter):
+    name = 'ref'
+
+    needs_bundle = False
+
+    def push(self, bundle):
+        raise AssertionError('push_ref should be used')
+
+    def push_ref(self, repo_path, ref):
+        return (repo_path, ref) == ('/repo', REF)
+
+
+def test_push_without_bundle():
+    cache = FakeBundleCache()
+    task = PushTask(REF, '/repo', REF, [RefPushAdapter('a')], cache)
+
+    task.run()
+    assert task.get_state() == TaskState.COMPLETED
+    assert cache.builds == []
+    assert [phase['name'] for phase in task.get_status()['phases']] == [
+        'queued', 'push']
+
+
+class BundleRequiredPushAdapter(BasePushAdapter):
+    name = 'bundle-required'
+
+    needs_bundle = False
+
+    def __init__(self, name):
+        super(BundleRequiredPushAdapter, self).__init__(name)
+        self.bundles = []
+
+    def push(self, bundle):
+        self.bundles.append(bundle)
+        return True
+
+    def push_ref(self, repo_path, ref):
+        raise BundleRequired('delta has fallback objects')
+
+
+def test_push_ref_falls_back_to_bundle():
+    cache = FakeBundleCache()
+    adapter = BundleRequiredPushAdapter('a')
+    task = PushTask(REF, '/repo', REF, [adapter], cache)
+
+    task.run()
+    assert task.get_state() == TaskState.COMPLETED
+    assert cache.builds == [('/repo', REF)]
+    assert adapter.bundles == ['/bundles/hello.flatpak']
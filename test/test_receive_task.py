@@ -0,0 +1,48 @@
+import pytest
+
+from ostree_upload_server.importers.base import RefUpdate
+from ostree_upload_server.task.receive import ReceiveTask
+from ostree_upload_server.task.state import TaskState
+
+REF = 'app/org.ostree.Hello/x86_64/master'
+
+
+class StubExecutor:
+    """Executor returning a fixed import result"""
+    def __init__(self, result):
+        self.result = result
+
+    def run_with_progress(self, func, progress_callback, *args, **kwargs):
+        return self.result
+
+
+class StubMetadataUpdater:
+    def __init__(self):
+        self.dirty = []
+
+    def mark_dirty(self, repo_path):
+        self.dirty.append(repo_path)
+
+
+@pytest.mark.parametrize('ref_update', [
+    RefUpdate(REF, None, 'abc'),
+    None,
+])
+def test_metadata_marked_dirty(ref_update, tmp_path):
+    upload = tmp_path / 'hello.flatpak'
+    upload.write_bytes(b'')
+    repo_path = str(tmp_path)
+    metadata_updater = StubMetadataUpdater()
+    task = ReceiveTask(upload.name, str(upload), repo_path, {},
+                       StubExecutor(ref_update), metadata_updater)
+
+    task.run()
+    assert task.get_state() == TaskState.COMPLETED
+    assert not upload.exists()
+
+    # Imports that didn't change a ref leave the metadata alone
+    if ref_update is None:
+        assert metadata_updater.dirty == []
+    else:
+        assert task.get_ref_updates() == [ref_update]
+        assert metadata_updater.dirty == [repo_path]
@@ -0,0 +1,98 @@
+import fcntl
+import os
+
+import gevent
+import pytest
+
+from gevent import get_hub
+
+from ostree_upload_server.repolock import EosOSTreeError, RepoLock
+
+
+def test_exclusive_not_starved(tmp_path):
+    order = []
+
+    def lock(name, exclusive):
+        with RepoLock(str(tmp_path), exclusive=exclusive):
+            order.append(name)
+            gevent.sleep(0.05)
+
+    # Shared locks requested after the exclusive lock wait for it even
+    # though they could share with the first lock
+    with RepoLock(str(tmp_path)):
+        greenlets = [gevent.spawn(lock, 'exclusive', True)]
+        gevent.sleep(0)
+        greenlets.append(gevent.spawn(lock, 'shared', False))
+        gevent.sleep(0.05)
+        assert order == []
+
+    gevent.joinall(greenlets, raise_error=True)
+    assert order == ['exclusive', 'shared']
+
+
+def test_shared_locks(tmp_path):
+    with RepoLock(str(tmp_path)), RepoLock(str(tmp_path)):
+        pass
+
+
+def test_wait_does_not_block_loop(tmp_path):
+    ticks = []
+
+    def tick():
+        for _ in range(5):
+            ticks.append(None)
+            gevent.sleep(0.01)
+
+    def lock(exclusive):
+        with RepoLock(str(tmp_path), exclusive=exclusive):
+            pass
+
+    # Waiting in a thread and a greenlet lets other greenlets run
+    with RepoLock(str(tmp_path), exclusive=True):
+        ticker = gevent.spawn(tick)
+        waiter = gevent.spawn(lock, False)
+        thread_result = get_hub().threadpool.spawn(lock, True)
+        ticker.join()
+        assert len(ticks) == 5
+        assert not waiter.ready()
+        assert not thread_result.ready()
+    waiter.get(timeout=1)
+    thread_result.get(timeout=1)
+
+
+def test_timeout(tmp_path):
+    with RepoLock(str(tmp_path), exclusive=True):
+        with pytest.raises(EosOSTreeError):
+            with RepoLock(str(tmp_path), timeout=0.05):
+                pass
+
+    # The timed out request doesn't hold up later ones
+    with RepoLock(str(tmp_path), exclusive=True, timeout=0):
+        pass
+
+
+def test_killed_waiter(tmp_path):
+    def lock():
+        with RepoLock(str(tmp_path), exclusive=True):
+            pass
+
+    with RepoLock(str(tmp_path), exclusive=True):
+        waiter = gevent.spawn(lock)
+        gevent.sleep(0.01)
+        waiter.kill()
+
+    # The killed request isn't granted the lock and left holding it
+    with RepoLock(str(tmp_path), exclusive=True, timeout=0):
+        pass
+    assert RepoLock._states == {}
+
+
+def test_other_process(tmp_path):
+    # Another open file description stands in for another process
+    lock_path = os.path.join(str(tmp_path), RepoLock.LOCK_FILE)
+    with open(lock_path, 'w') as other:
+        fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+        gevent.spawn_later(0.05, fcntl.flock, other.fileno(),
+                           fcntl.LOCK_UN)
+        with RepoLock(str(tmp_path), timeout=1):
+            pass
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from ostree_upload_server.importers.util import RepositoryCache
+
+
+def test_checkout_reuse(repo):
+    repo_path = repo.get_path().get_path()
+    cache = RepositoryCache()
+
+    with cache.checkout(repo_path) as first:
+        # Concurrent checkouts get their own handles
+        with cache.checkout(repo_path) as second:
+            assert second is not first
+    with cache.checkout(repo_path) as third:
+        assert third in (first, second)
+
+
+def test_checkout_invalidate(repo):
+    repo_path = repo.get_path().get_path()
+    cache = RepositoryCache(max_idle=1)
+
+    config_path = os.path.join(repo_path, 'config')
+    config_stat = os.stat(config_path)
+    with cache.checkout(repo_path) as first:
+        pass
+    cache.invalidate(repo_path)
+    with cache.checkout(repo_path) as second:
+        assert second is not first
+
+    # The repo's config is left alone
+    assert os.stat(config_path).st_mtime_ns == config_stat.st_mtime_ns
+
+    # Caches in other processes see the invalidation too
+    other_cache = RepositoryCache(max_idle=1)
+    with other_cache.checkout(repo_path) as other:
+        pass
+    cache.invalidate(repo_path)
+    with other_cache.checkout(repo_path) as other_second:
+        assert other_second is not other
+
+    # Changing the config reopens the repo
+    stat = os.stat(config_path)
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    with cache.checkout(repo_path) as third:
+        assert third is not second
+
+
+def test_checkout_error(repo):
+    repo_path = repo.get_path().get_path()
+    cache = RepositoryCache()
+
+    # Handles used when an error was raised aren't reused
+    with pytest.raises(RuntimeError):
+        with cache.checkout(repo_path) as first:
+            raise RuntimeError('failed')
+    with cache.checkout(repo_path) as second:
+        assert second is not first
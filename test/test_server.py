@@ -16,20 +16,38 @@
 # server as needed, which also uses gevent.
 
 import grequests
+import gevent
+import gi
+import json
 import logging
+from ostree_upload_server.bundle_importer import BundleImporter
+from ostree_upload_server.importers.flatpak import read_bundle_header
+from ostree_upload_server.importers.util import copy_commit
+from ostree_upload_server.push_adapter.ostree import OstreePushAdapter
 from ostree_upload_server.server import OstreeUploadServer
 from passlib.hash import pbkdf2_sha256
 import pytest
 import requests
+import tarfile
 from textwrap import dedent
+import time
 
 from .util import BUNDLES, GPG_KEYS
 
+gi.require_version('OSTree', '1.0')
+from gi.repository import Gio, OSTree  # noqa: E402
+
 logger = logging.getLogger(__name__)
 
 
 @pytest.fixture
-def server_conf(tmp_path, repo, repo_gpg_homedir):
+def tar_import_mode():
+    """How the server imports tars, override by parametrizing tests"""
+    return 'extract'
+
+
+@pytest.fixture
+def server_conf(tmp_path, repo, repo_gpg_homedir, tar_import_mode):
     """Generate a config file for the server"""
     conf_args = {
         'gpg_homedir': str(repo_gpg_homedir),
@@ -37,12 +55,14 @@ def server_conf(tmp_path, repo, repo_gpg_homedir):
         'sign_key': GPG_KEYS['server']['id'],
         'repo_path': repo.get_path().get_path(),
         'password_hash': pbkdf2_sha256.hash('secret'),
+        'tar_import_mode': tar_import_mode,
     }
     conf = dedent('''\
     [import]
     gpg_homedir = {gpg_homedir}
     keyring = {keyring}
     sign_key = {sign_key}
+    tar_import_mode = {tar_import_mode}
 
     [repo-main]
     path = {repo_path}
@@ -67,6 +87,21 @@ def server(server_conf):
     server._stop()
 
 
+def wait_for_task(session, url, task):
+    """Poll the task until it completes and return its final state"""
+    state = ''
+    params = {'task': task}
+    while state not in ('COMPLETED', 'FAILED'):
+        req = grequests.request('GET', url, session=session,
+                                params=params, timeout=5)
+        resp = grequests.map([req])[0]
+        resp.raise_for_status()
+        state = resp.json()['state']
+        logger.info('Current state: %s', state)
+
+    return state
+
+
 @pytest.mark.parametrize('bundle_type', ['flatpak', 'tar', 'tgz'])
 def test_upload(bundle_type, server):
     port = server._http_server.server_port
@@ -85,18 +120,375 @@ def test_upload(bundle_type, server):
             resp = grequests.map([req])[0]
             resp.raise_for_status()
 
-        # Get the task ID from the response
+        # Get the task ID from the response and loop until the task
+        # completes
+        task = resp.json()['task']
+        state = wait_for_task(session, url, task)
+        assert state == 'COMPLETED'
+
+        # The status has the phases of the import
+        req = grequests.request('GET', url, session=session,
+                                params={'task': task}, timeout=5)
+        resp = grequests.map([req])[0]
+        phases = resp.json()['phases']
+        names = [phase['name'] for phase in phases]
+        assert names[:3] == ['queued', 'lock_wait', 'import']
+        assert 'apply' in names
+        assert 'commit' in names
+        assert all(phase['end'] >= phase['start'] for phase in phases)
+
+
+@pytest.mark.parametrize('bundle_type', ['flatpak', 'tar', 'tgz'])
+def test_upload_put(bundle_type, server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}/upload'.format(port)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        # PUT the bundle as the raw request body with the repo and
+        # filename in the query parameters.
+        with open(BUNDLES[bundle_type], 'rb') as bundle:
+            params = {
+                'repo': 'main',
+                'filename': BUNDLES[bundle_type].name,
+            }
+            req = grequests.request('PUT', url, session=session,
+                                    params=params, data=bundle, timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
+
+        task = resp.json()['task']
+        state = wait_for_task(session, url, task)
+        assert state == 'COMPLETED'
+
+
+def test_upload_wait_and_events(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}/upload'.format(port)
+    events_url = 'http://127.0.0.1:{}/events'.format(port)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        with open(BUNDLES['flatpak'], 'rb') as bundle:
+            data = {'repo': 'main'}
+            files = {'file': bundle}
+            req = grequests.request('POST', url, session=session, data=data,
+                                    files=files, timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
         task = resp.json()['task']
 
-        # Loop until the task completes
-        state = ''
+        # Follow the task with server-sent events until the stream ends
         params = {'task': task}
+        req = grequests.request('GET', events_url, session=session,
+                                params=params, timeout=30)
+        resp = grequests.map([req])[0]
+        resp.raise_for_status()
+        assert resp.headers['Content-Type'].startswith('text/event-stream')
+        states = [json.loads(line[len('data: '):])['state']
+                  for line in resp.text.splitlines()
+                  if line.startswith('data: ')]
+        assert states[-1] == 'COMPLETED'
+
+        # Waiting on a finished task returns immediately
+        params = {'task': task, 'wait': 60}
+        req = grequests.request('GET', url, session=session,
+                                params=params, timeout=5)
+        resp = grequests.map([req])[0]
+        resp.raise_for_status()
+        assert resp.json()['state'] == 'COMPLETED'
+
+        params = {'task': task, 'wait': 'forever'}
+        req = grequests.request('GET', url, session=session,
+                                params=params, timeout=5)
+        resp = grequests.map([req])[0]
+        assert resp.status_code == 400
+
+
+def test_wait_and_events_pending(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}/upload'.format(port)
+    events_url = 'http://127.0.0.1:{}/events'.format(port)
+    repo_path = server._managed_repos['main']
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        # Hold the task in the queue until the repo is resumed
+        server._task_queue.pause_repo(repo_path)
+        with open(BUNDLES['flatpak'], 'rb') as bundle:
+            data = {'repo': 'main'}
+            files = {'file': bundle}
+            req = grequests.request('POST', url, session=session, data=data,
+                                    files=files, timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
+        task = resp.json()['task']
+
+        req = grequests.request('GET', url, session=session,
+                                params={'task': task}, timeout=5)
+        resp = grequests.map([req])[0]
+        resp.raise_for_status()
+        assert resp.json()['state'] == 'PENDING'
+
+        # Both the wait and the event stream are open when the task
+        # moves on
+        gevent.spawn_later(0.5, server._task_queue.resume_repo, repo_path)
+        params = {'task': task, 'wait': 30}
+        start = time.monotonic()
+        wait_req = grequests.request('GET', url, session=session,
+                                     params=params, timeout=10)
+        events_req = grequests.request('GET', events_url, session=session,
+                                       params={'task': task}, timeout=30)
+        wait_resp, events_resp = grequests.map([wait_req, events_req])
+
+        wait_resp.raise_for_status()
+        assert time.monotonic() - start >= 0.5
+        state = wait_resp.json()['state']
+        assert state != 'PENDING'
+
+        events_resp.raise_for_status()
+        states = [json.loads(line[len('data: '):])['state']
+                  for line in events_resp.text.splitlines()
+                  if line.startswith('data: ')]
+        assert states[0] == 'PENDING'
+        assert states[-1] == 'COMPLETED'
+
+        # Each wait returns on the next change until the task finishes
         while state not in ('COMPLETED', 'FAILED'):
             req = grequests.request('GET', url, session=session,
-                                    params=params, timeout=5)
+                                    params=params, timeout=35)
             resp = grequests.map([req])[0]
             resp.raise_for_status()
             state = resp.json()['state']
-            logger.info('Current state: %s', state)
+        assert state == 'COMPLETED'
+
+
+def test_upload_duplicate(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}/upload'.format(port)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        # Upload the same bundle twice. The second upload is answered
+        # with the first task.
+        tasks = []
+        for _ in range(2):
+            with open(BUNDLES['flatpak'], 'rb') as bundle:
+                data = {'repo': 'main'}
+                files = {'file': bundle}
+                req = grequests.request('POST', url, session=session,
+                                        data=data, files=files, timeout=5)
+                resp = grequests.map([req])[0]
+                resp.raise_for_status()
+                tasks.append(resp.json()['task'])
+
+        assert tasks[0] == tasks[1]
+        assert resp.json()['duplicate']
+        state = wait_for_task(session, url, tasks[0])
+        assert state == 'COMPLETED'
+
+
+def test_upload_invalid(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}/upload'.format(port)
+
+    # A truncated flatpak bundle is rejected before being queued
+    with open(BUNDLES['flatpak'], 'rb') as bundle:
+        data = bundle.read(64)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+        params = {'repo': 'main', 'filename': 'bad.flatpak'}
+        req = grequests.request('PUT', url, session=session,
+                                params=params, data=data, timeout=5)
+        resp = grequests.map([req])[0]
+        assert resp.status_code == 400
+        assert 'task' not in resp.json()
+
+
+def test_upload_batch(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}/upload'.format(port)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        # POST two bundles in one request. They're for the same ref, so
+        # only the first one can be imported in the batch.
+        with open(BUNDLES['flatpak'], 'rb') as flatpak_bundle, \
+                open(BUNDLES['tar'], 'rb') as tar_bundle:
+            data = {'repo': 'main'}
+            files = [('file', flatpak_bundle), ('file', tar_bundle)]
+            req = grequests.request('POST', url, session=session, data=data,
+                                    files=files, timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
+
+        task = resp.json()['task']
+        state = wait_for_task(session, url, task)
+        assert state == 'FAILED'
+
+        req = grequests.request('GET', url, session=session,
+                                params={'task': task}, timeout=5)
+        resp = grequests.map([req])[0]
+        bundles = resp.json()['bundles']
+        assert [bundle['state'] for bundle in bundles] == \
+            ['COMPLETED', 'FAILED']
+        assert bundles[0]['ref'] == 'app/org.ostree.Hello/x86_64/master'
+
+
+def test_metrics(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}'.format(port)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        with open(BUNDLES['flatpak'], 'rb') as bundle:
+            data = {'repo': 'main'}
+            files = {'file': bundle}
+            req = grequests.request('POST', url + '/upload',
+                                    session=session, data=data,
+                                    files=files, timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
+
+        task = resp.json()['task']
+        state = wait_for_task(session, url + '/upload', task)
+        assert state == 'COMPLETED'
+
+        req = grequests.request('GET', url + '/metrics', session=session,
+                                timeout=5)
+        resp = grequests.map([req])[0]
+        resp.raise_for_status()
+        assert resp.headers['Content-Type'].startswith('text/plain')
+        assert 'ostree_upload_received_bytes_total ' in resp.text
+        assert 'ostree_upload_import_phase_seconds_count{phase="apply"}' \
+            in resp.text
+        assert 'ostree_upload_active_uploads 0' in resp.text
+
+
+def test_refs(server):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}'.format(port)
+    params = {'repo': 'main', 'ref': 'app/org.ostree.Hello/x86_64/master'}
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        req = grequests.request('GET', url + '/refs', session=session,
+                                params=params, timeout=5)
+        resp = grequests.map([req])[0]
+        assert resp.status_code == 404
+
+        with open(BUNDLES['flatpak'], 'rb') as bundle:
+            data = {'repo': 'main'}
+            files = {'file': bundle}
+            req = grequests.request('POST', url + '/upload',
+                                    session=session, data=data,
+                                    files=files, timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
+
+        task = resp.json()['task']
+        state = wait_for_task(session, url + '/upload', task)
+        assert state == 'COMPLETED'
+
+        # The server made its own commit from the uploaded one
+        req = grequests.request('GET', url + '/refs', session=session,
+                                params=params, timeout=5)
+        resp = grequests.map([req])[0]
+        resp.raise_for_status()
+        bundle_commit, _ = read_bundle_header(str(BUNDLES['flatpak']))
+        assert resp.json()['from_commit'] == bundle_commit
+        assert resp.json()['commit'] != bundle_commit
+
+
+@pytest.mark.parametrize('tar_import_mode', ['extract', 'stream'])
+def test_ostree_push(server, tmp_path, upload_gpg_homedir, monkeypatch):
+    port = server._http_server.server_port
+    url = 'http://127.0.0.1:{}'.format(port)
+    ref = 'app/org.ostree.Hello/x86_64/master'
+
+    # Commits in the pushing repo are signed with the upload key the
+    # server trusts
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    source_repo = OSTree.Repo.new(Gio.File.new_for_path(str(source_path)))
+    source_repo.create(OSTree.RepoMode.ARCHIVE_Z2)
+    ref_update = BundleImporter.import_bundle(
+        str(BUNDLES['flatpak']), str(source_path), str(upload_gpg_homedir),
+        str(GPG_KEYS['upload']['keyring']), GPG_KEYS['upload']['id'])
+    commit = ref_update.new_commit
+
+    adapter = OstreePushAdapter('server', {
+        'url': url + '/upload',
+        'repo': 'main',
+        'username': 'user',
+        'password': 'secret',
+    })
+
+    # Record the objects in each uploaded tar and its import task
+    uploads = []
+    tasks = []
+    push = adapter.push
+    send = adapter._send
+
+    def record_push(bundle):
+        with tarfile.open(bundle) as tar_archive:
+            uploads.append(set(name for name in tar_archive.getnames()
+                               if name.startswith('objects/')))
+        return push(bundle)
+
+    def record_send(filename, body):
+        r = send(filename, body)
+        tasks.append(r.json()['task'])
+        return r
+
+    monkeypatch.setattr(adapter, 'push', record_push)
+    monkeypatch.setattr(adapter, '_send', record_send)
+
+    with requests.Session() as session:
+        session.auth = ('user', 'secret')
+
+        def get_remote_ref():
+            req = grequests.request('GET', url + '/refs', session=session,
+                                    params={'repo': 'main', 'ref': ref},
+                                    timeout=5)
+            resp = grequests.map([req])[0]
+            resp.raise_for_status()
+            return resp.json()
+
+        assert adapter.push_ref(str(source_path), ref)
+        state = wait_for_task(session, url + '/upload', tasks[-1])
+        assert state == 'COMPLETED'
+        assert get_remote_ref()['from_commit'] == commit
+        assert (OSTree.get_relative_object_path(
+            commit, OSTree.ObjectType.COMMIT, True) in uploads[0])
+
+        # Make a new commit of the same tree
+        source_repo.prepare_transaction(None)
+        new_commit = copy_commit(source_repo, commit, ref)
+        source_repo.transaction_set_ref(None, ref, new_commit)
+        source_repo.commit_transaction(None)
+        source_repo.sign_commit(commit_checksum=new_commit,
+                                key_id=GPG_KEYS['upload']['id'],
+                                homedir=str(upload_gpg_homedir),
+                                cancellable=None)
 
+        # Only the new commit and its signatures are sent
+        assert adapter.push_ref(str(source_path), ref)
+        assert len(uploads) == 2
+        assert uploads[1] == {
+            OSTree.get_relative_object_path(new_commit, objtype, True)
+            for objtype in (OSTree.ObjectType.COMMIT,
+                            OSTree.ObjectType.COMMIT_META)
+        }
+        assert len(uploads[1]) < len(uploads[0])
+        state = wait_for_task(session, url + '/upload', tasks[-1])
         assert state == 'COMPLETED'
+        assert get_remote_ref()['from_commit'] == new_commit
@@ -0,0 +1,35 @@
+from gevent import queue
+from ostree_upload_server.task.base import BaseTask
+from ostree_upload_server.task_queue import TaskQueue
+import pytest
+
+
+class DummyTask(BaseTask):
+    def run(self):
+        pass
+
+
+def test_pause_repo():
+    task_queue = TaskQueue()
+    main_task = DummyTask('main', '/repo/main')
+    other_task = DummyTask('other', '/repo/other')
+    task_queue.add_task(main_task)
+    task_queue.add_task(other_task)
+
+    # Tasks for the paused repo are held back
+    task_queue.pause_repo('/repo/main')
+    task = task_queue.get(timeout=0)
+    assert task is other_task
+    with pytest.raises(queue.Empty):
+        task_queue.get(timeout=0)
+    task_queue.task_done(task)
+    assert task_queue.is_repo_busy('/repo/main')
+    assert not task_queue.is_repo_busy('/repo/other')
+
+    # Held tasks are requeued when the repo is resumed
+    task_queue.resume_repo('/repo/main')
+    task = task_queue.get(timeout=0)
+    assert task is main_task
+    task_queue.task_done(task)
+    assert not task_queue.is_repo_busy('/repo/main')
+    task_queue.wait_repo_idle('/repo/main')
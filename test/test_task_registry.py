@@ -0,0 +1,95 @@
+from ostree_upload_server.task.base import BaseTask, TaskRecord
+from ostree_upload_server.task.state import TaskState
+from ostree_upload_server.task_registry import TaskRegistry
+
+
+class DummyTask(BaseTask):
+    next_id = 0
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.set_id(DummyTask.next_id)
+        DummyTask.next_id += 1
+
+    def run(self):
+        pass
+
+
+def test_finished_records():
+    registry = TaskRegistry()
+    task = DummyTask('dummy', '/repo')
+    task_id = task.get_id()
+    registry.add(task)
+    assert registry.get(task_id) is task
+
+    task.set_state(TaskState.COMPLETED)
+    registry.task_finished(task)
+    record = registry.get(task_id)
+    assert isinstance(record, TaskRecord)
+    assert record.task_class is DummyTask
+    assert record.get_status() == task.get_status()
+    assert record.get_status()['state'] == 'COMPLETED'
+
+
+def test_phases():
+    task = DummyTask('dummy', '/repo')
+    task.start_phase('import')
+    task.report_progress('apply', None)
+    task.report_progress(None, {'objects_written': 1})
+    task.report_progress(None, {'bytes_written': 2})
+    task.set_state(TaskState.COMPLETED)
+
+    phases = task.get_status()['phases']
+    assert [phase['name'] for phase in phases] == \
+        ['queued', 'import', 'apply']
+    assert all(phase['end'] >= phase['start'] for phase in phases)
+    assert phases[-1]['progress'] == {'objects_written': 1,
+                                      'bytes_written': 2}
+
+
+def test_lru_eviction():
+    registry = TaskRegistry(max_tasks=2)
+    tasks = [DummyTask('dummy', '/repo') for _ in range(3)]
+    for task in tasks[:2]:
+        registry.add(task)
+        registry.task_finished(task)
+
+    # Using the first task makes the second the least recently used
+    registry.get(tasks[0].get_id())
+    registry.add(tasks[2])
+    assert len(registry) == 2
+    assert registry.get(tasks[0].get_id()) is not None
+    assert registry.get(tasks[1].get_id()) is None
+    assert registry.get(tasks[2].get_id()) is tasks[2]
+
+
+def test_active_tasks_not_evicted():
+    registry = TaskRegistry(max_tasks=1)
+    tasks = [DummyTask('dummy', '/repo') for _ in range(2)]
+    for task in tasks:
+        registry.add(task)
+
+    assert len(registry) == 2
+    assert all(registry.get(task.get_id()) is task for task in tasks)
+
+
+def test_ttl_expiry():
+    registry = TaskRegistry(ttl=60)
+    task = DummyTask('dummy', '/repo')
+    registry.add(task)
+    registry.task_finished(task)
+
+    # Age the record past the TTL
+    registry.get(task.get_id()).finished_time -= 120
+    assert registry.get(task.get_id()) is None
+    assert len(registry) == 0
+
+
+def test_expired_record_not_added():
+    registry = TaskRegistry(ttl=60)
+    task = DummyTask('dummy', '/repo')
+    record = TaskRecord.from_task(task)
+    record.finished_time -= 120
+    registry.add_record(record)
+    assert registry.get(task.get_id()) is None
+    assert len(registry) == 0
@@ -0,0 +1,109 @@
+from ostree_upload_server.task.base import BaseTask, TaskRecord
+from ostree_upload_server.task.state import TaskState
+from ostree_upload_server.task_queue import TaskQueue
+from ostree_upload_server.task_store import TaskStore
+from time import time
+
+
+class DummyTask(BaseTask):
+    TASK_TYPE = 'dummy'
+
+    def __init__(self, name, repo, value):
+        super().__init__(name, repo)
+        self.value = value
+
+    def get_params(self):
+        return {'value': self.value}
+
+    def run(self):
+        pass
+
+
+def test_restart(tmp_path):
+    db_path = str(tmp_path / 'tasks.db')
+
+    store = TaskStore(db_path)
+    store.start()
+    task_queue = TaskQueue(store=store, task_classes=[DummyTask])
+    tasks = [DummyTask('dummy', '/repo', value) for value in range(3)]
+    for task in tasks:
+        task_queue.add_task(task)
+    tasks[0].set_state(TaskState.COMPLETED)
+    store.stop()
+    restart_time = time()
+
+    # Unfinished tasks are returned with their parameters
+    store = TaskStore(db_path)
+    store.start()
+    rows = store.load_unfinished()
+    assert [row['id'] for row in rows] == [task.get_id()
+                                           for task in tasks[1:]]
+    assert [row['params'] for row in rows] == [{'value': 1}, {'value': 2}]
+
+    # IDs are never reused
+    task_queue = TaskQueue(store=store, task_classes=[DummyTask])
+    task = DummyTask('dummy', '/repo', 3)
+    task_queue.add_task(task)
+    assert task.get_id() > max(task.get_id() for task in tasks)
+
+    # Finished tasks from before the restart can be looked up
+    record = task_queue.get_task(tasks[0].get_id())
+    assert isinstance(record, TaskRecord)
+    assert record.task_class is DummyTask
+    assert record.get_state() == TaskState.COMPLETED
+
+    # Looking it up doesn't make it look like it finished just now
+    assert record.finished_time < restart_time
+
+    store.mark_failed(tasks[1].get_id())
+    assert len(store.load_unfinished()) == 2
+    store.stop()
+
+
+def test_new_tasks_written(tmp_path):
+    db_path = str(tmp_path / 'tasks.db')
+    store = TaskStore(db_path, flush_interval=60)
+    store.start()
+    task_queue = TaskQueue(store=store, task_classes=[DummyTask])
+    task = DummyTask('dummy', '/repo', 0)
+    task_queue.add_task(task)
+
+    # The task is on disk before its ID is handed out, without waiting
+    # for the periodic flush
+    other_store = TaskStore(db_path)
+    rows = other_store.load_unfinished()
+    other_store.stop()
+    assert [row['id'] for row in rows] == [task.get_id()]
+    store.stop()
+
+
+def test_missing_lookups_cached(tmp_path, monkeypatch):
+    store = TaskStore(str(tmp_path / 'tasks.db'))
+    store.start()
+
+    selects = []
+    select_status = store._select_status
+
+    def counting_select_status(task_id):
+        selects.append(task_id)
+        return select_status(task_id)
+
+    monkeypatch.setattr(store, '_select_status', counting_select_status)
+
+    # IDs that were never allocated aren't looked up
+    assert store.load_status(1000) is None
+    assert selects == []
+
+    task_id = store.allocate_id()
+    assert store.load_status(task_id) is None
+    assert store.load_status(task_id) is None
+    assert selects == [task_id]
+
+    # Saving a task forgets that it was missing
+    task = DummyTask('dummy', '/repo', 0)
+    task.set_id(task_id)
+    task.set_state(TaskState.COMPLETED)
+    store.save(task)
+    store._flush()
+    assert store.load_status(task_id)['state'] == TaskState.COMPLETED
+    store.stop()
@@ -0,0 +1,60 @@
+import gevent
+from ostree_upload_server.task.base import BaseTask
+from ostree_upload_server.task.state import TaskState
+from ostree_upload_server.task_queue import TaskQueue
+from ostree_upload_server.upload_deduplicator import UploadDeduplicator
+
+
+class DummyTask(BaseTask):
+    def run(self):
+        pass
+
+
+def test_find():
+    task_queue = TaskQueue()
+    dedup = UploadDeduplicator(task_queue, ttl=60)
+
+    task = DummyTask('dummy', '/repo')
+    task_queue.add_task(task)
+    dedup.add('/repo', 'abc', task)
+    assert dedup.find('/repo', 'abc') is task
+    assert dedup.find('/repo', 'def') is None
+    assert dedup.find('/other', 'abc') is None
+
+    # Completed tasks are reused until the TTL expires
+    assert task_queue.get() is task
+    task.set_state(TaskState.COMPLETED)
+    task_queue.task_done(task)
+    record = dedup.find('/repo', 'abc')
+    assert record.get_id() == task.get_id()
+    record.finished_time -= 120
+    assert dedup.find('/repo', 'abc') is None
+
+    # Failed tasks are never reused
+    task = DummyTask('dummy', '/repo')
+    task_queue.add_task(task)
+    dedup.add('/repo', 'abc', task)
+    task.set_state(TaskState.FAILED)
+    assert dedup.find('/repo', 'abc') is None
+
+
+def test_lock():
+    task_queue = TaskQueue()
+    dedup = UploadDeduplicator(task_queue, ttl=60)
+    tasks = []
+
+    def upload():
+        with dedup.lock('/repo', 'abc'):
+            task = dedup.find('/repo', 'abc')
+            if task is None:
+                # Adding a task can yield to the other upload
+                gevent.sleep(0.01)
+                task = DummyTask('dummy', '/repo')
+                task_queue.add_task(task)
+                dedup.add('/repo', 'abc', task)
+            tasks.append(task)
+
+    gevent.joinall([gevent.spawn(upload), gevent.spawn(upload)])
+    assert len(tasks) == 2
+    assert tasks[0] is tasks[1]
+    assert dedup._locks == {}
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""Measure how many authenticated requests per second the Authenticator
+can check with and without the verified credential cache"""
+
+import argparse
+import os
+import sys
+from time import perf_counter
+
+from passlib.hash import pbkdf2_sha256
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from ostree_upload_server.authenticator import Authenticator  # noqa: E402
+
+
+def benchmark(authenticator, request, duration):
+    count = 0
+    start = perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        if not authenticator.authenticate(request):
+            raise Exception('Authentication failed')
+        count += 1
+        elapsed = perf_counter() - start
+    return count / elapsed
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('-d', '--duration', type=float, default=5,
+                    help='seconds to run each benchmark (default: 5)')
+parser.add_argument('-r', '--rounds', type=int, default=29000,
+                    help='PBKDF2 rounds for the password hash '
+                         '(default: 29000)')
+args = parser.parse_args()
+
+users = {'user': pbkdf2_sha256.using(rounds=args.rounds).hash('secret')}
+builder = EnvironBuilder(path='/upload', query_string='task=1',
+                         headers={'Authorization': 'Basic dXNlcjpzZWNyZXQ='})
+request = Request(builder.get_environ())
+
+uncached = benchmark(Authenticator(users, cache_ttl=0), request,
+                     args.duration)
+cached = benchmark(Authenticator(users), request, args.duration)
+
+print('{:<10} {:>14}'.format('cache', 'requests/sec'))
+print('{:<10} {:>14.1f}'.format('disabled', uncached))
+print('{:<10} {:>14.1f}'.format('enabled', cached))
+print('speedup: {:.0f}x'.format(cached / uncached))